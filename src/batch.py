@@ -0,0 +1,268 @@
+"""Non-interactive batch runner: runs the pipeline for many projects at once.
+
+Usage (from the root directory, like main.py):
+    python src/batch.py data/projects/shot-010/config.json data/projects/shot-020/config.json
+    python src/batch.py --jobs jobs.json
+
+A jobs file is a JSON list. Each entry is either the path of an existing project's
+config.json, or an object describing a project to create or update:
+    {"project_name": "shot-030", "bg_vid": "...", "alpha_vid": "...",
+     "alpha_white_vid": "...", "stitch": false}
+"alpha_white_vid" is only needed if frame_extraction.alpha_white.source is "video".
+"stitch" (default true) controls whether the blend and stitch stages run; leave it
+off until the inpainted keyframe layers are in place.
+
+Jobs run concurrently, up to --max-jobs at a time. Each stage also takes a slot from
+one of two limits: CPU-heavy stages (analysis, upscaling, compositing, validation,
+interpolation, streaming stitch) share --cpu-stages slots and disk/ffmpeg-bound
+stages (keyframe extraction, inpainting, stitching from disk) share --io-stages
+slots, so a box stays busy without running every heavy stage at once. When every
+frame is extracted and the frame dump is out of date, the extraction runs inside
+the analysis, which decodes the frames anyway, and holds its CPU slot. CPU-heavy
+stages start process pools of their own (analysis_workers, upscaling.workers,
+compositing.workers, ...), capped so that the --cpu-stages stages running at once
+share the CPUs, so the CPU limit is usually small.
+
+Each job's status and per-stage timings are written to its project's Log. A
+project's config.json may be edited while its job waits; it is reloaded before each
+stage.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config_utils.config import Config
+from log_utils.log import Log
+from project_manager.project import Project
+from project_manager.stage_manifest import StageManifest
+from main import (
+    create_new_proj,
+    ensure_frame_dump,
+    run_blend,
+    run_extract_and_analyze,
+    run_inpaint,
+    run_interpolate,
+    run_stitch,
+    run_store_keyframes,
+    run_upscale,
+    run_validate,
+    streams_output,
+    synchronous_shell_command,
+)
+
+
+class StageLimits:
+    """Semaphores bounding how many CPU-heavy and I/O-bound stages run at once.
+
+    Attributes:
+        cpu_workers (int): Processes a CPU-heavy stage may start, the CPUs shared
+            between the CPU-heavy stages that may run at once.
+    """
+
+    def __init__(self, cpu_stages, io_stages):
+        self.semaphores = {
+            "cpu": threading.Semaphore(cpu_stages),
+            "io": threading.Semaphore(io_stages),
+        }
+        self.cpu_workers = max(1, (os.cpu_count() or 1) // cpu_stages)
+
+    def run(self, kind, log, name, stage, *args):
+        """Run a stage once a slot of the given kind is free, logging its timing.
+        The project's config is reloaded first if it was edited in the meantime."""
+        with self.semaphores[kind]:
+            if log.config.reload_if_changed():
+                log.write("Batch: config changed on disk, reloaded")
+            log.write(f"Batch: {name} started")
+            start = time.perf_counter()
+            result = stage(*args)
+            elapsed = time.perf_counter() - start
+        log.write(f"Batch: {name} finished in {elapsed:.1f} s")
+        return result, elapsed
+
+
+def project_config_path(job, root):
+    """Return the config path of a job, creating the project if it does not exist."""
+    if isinstance(job, str):
+        return job
+    config = json.load(open(f"{root}/config/config.json"))
+    projects_folder = config["projects_folder"].replace("$root$", root)
+    project_folder = f"{projects_folder}/{job['project_name']}"
+    if not os.path.exists(project_folder):
+        create_new_proj(
+            projects_folder,
+            job["project_name"],
+            config,
+            (job["bg_vid"], job["alpha_vid"], job.get("alpha_white_vid")),
+        )
+    return f"{project_folder}/config.json"
+
+
+def run_job(job, root, limits):
+    """Run every stage of one job. Return (project config path, status, timings)."""
+    try:
+        config_path = project_config_path(job, root)
+        proj_config = Config(config_path)
+        proj_log = Log(proj_config)
+    except Exception as error:
+        # Without a project there is no Log to write to
+        print(f"Batch: could not set up job {job!r}: {error!r}", file=sys.stderr)
+        return str(job), "failed", {}
+    stitch = job.get("stitch", True) if isinstance(job, dict) else True
+    timings = {}
+    proj_log.write(f"Batch: job started for {config_path}")
+    try:
+        project = Project(proj_config, proj_log, synchronous_shell_command)
+        manifest = StageManifest(proj_config)
+        # Extracting every frame is fused into the analysis, which decodes them
+        # anyway, so it takes the analysis's CPU slot
+        frames, timings["analyze"] = limits.run(
+            "cpu",
+            proj_log,
+            "analyze",
+            run_extract_and_analyze,
+            project,
+            manifest,
+            limits.cpu_workers,
+        )
+        if proj_config.get("upscaling")["original"]["enabled"]:
+            _, timings["extract"] = limits.run(
+                "io", proj_log, "extract", ensure_frame_dump, project, manifest
+            )
+            _, timings["upscale_original"] = limits.run(
+                "cpu",
+                proj_log,
+                "upscale_original",
+                run_upscale,
+                project,
+                manifest,
+                "original",
+                limits.cpu_workers,
+            )
+        _, timings["store_keyframes"] = limits.run(
+            "io",
+            proj_log,
+            "store_keyframes",
+            run_store_keyframes,
+            project,
+            manifest,
+            frames.get_keyframe_original_indices(),
+        )
+        # Waiting on the SD server takes an I/O slot
+        _, timings["inpaint"] = limits.run(
+            "io",
+            proj_log,
+            "inpaint",
+            run_inpaint,
+            project,
+            manifest,
+            frames.get_keyframe_original_indices(),
+        )
+        if stitch:
+            # Blend and stitch need the frame dump. Extracting it here takes an I/O
+            # slot, rather than holding their CPU slot
+            _, elapsed = limits.run(
+                "io", proj_log, "extract", ensure_frame_dump, project, manifest
+            )
+            timings["extract"] = timings.get("extract", 0) + elapsed
+            streaming = streams_output(project)
+            if not streaming:
+                _, timings["blend"] = limits.run(
+                    "cpu",
+                    proj_log,
+                    "blend",
+                    run_blend,
+                    project,
+                    manifest,
+                    frames,
+                    limits.cpu_workers,
+                )
+                _, timings["validate"] = limits.run(
+                    "cpu",
+                    proj_log,
+                    "validate",
+                    run_validate,
+                    project,
+                    manifest,
+                    frames,
+                    limits.cpu_workers,
+                )
+                _, timings["upscale_output_composite"] = limits.run(
+                    "cpu",
+                    proj_log,
+                    "upscale_output_composite",
+                    run_upscale,
+                    project,
+                    manifest,
+                    "output_composite",
+                    limits.cpu_workers,
+                )
+                _, timings["interpolate"] = limits.run(
+                    "cpu",
+                    proj_log,
+                    "interpolate",
+                    run_interpolate,
+                    project,
+                    manifest,
+                    frames,
+                    limits.cpu_workers,
+                )
+            # Streaming stitch composites as it encodes
+            _, timings["stitch"] = limits.run(
+                "cpu" if streaming else "io",
+                proj_log,
+                "stitch",
+                run_stitch,
+                project,
+                manifest,
+                frames,
+                streaming,
+                limits.cpu_workers,
+            )
+    except Exception as error:
+        proj_log.error(f"Batch: job failed: {error!r}")
+        proj_log.profiler.summary()
+        return config_path, "failed", timings
+    proj_log.profiler.summary()
+    proj_log.write(["Batch: job complete, stage timings (s):", timings])
+    return config_path, "complete", timings
+
+
+def load_jobs(arguments):
+    jobs = list(arguments.configs)
+    if arguments.jobs:
+        with open(arguments.jobs) as jobs_file:
+            jobs.extend(json.load(jobs_file))
+    return jobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("configs", nargs="*", help="project config.json paths")
+    parser.add_argument("--jobs", help="JSON file listing jobs")
+    parser.add_argument("--max-jobs", type=int, default=4)
+    parser.add_argument("--cpu-stages", type=int, default=1)
+    parser.add_argument("--io-stages", type=int, default=2)
+    arguments = parser.parse_args(argv)
+
+    jobs = load_jobs(arguments)
+    if not jobs:
+        parser.error("no jobs given")
+    root = os.getcwd()  # Therefore, launcher must be run from the root directory
+    limits = StageLimits(arguments.cpu_stages, arguments.io_stages)
+    with ThreadPoolExecutor(max_workers=arguments.max_jobs) as pool:
+        results = list(pool.map(lambda job: run_job(job, root, limits), jobs))
+
+    failed = 0
+    for config_path, status, timings in results:
+        total = sum(timings.values())
+        print(f"{status:>8}  {total:8.1f} s  {config_path}")
+        failed += status != "complete"
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
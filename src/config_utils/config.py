@@ -1,10 +1,64 @@
+import copy
 import json
+import os
+import stat
+import tempfile
+from contextlib import contextmanager
+from config_utils.parameters import AnalysisParameters, BlendingParameters
+
+# Defaults for every option; project configs are copies of it made when the project
+# was created, and may predate options added since
+DEFAULT_CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "config", "config.json"
+)
+
+
+def merge_defaults(defaults, config):
+    """Return config with the keys it lacks filled in from defaults, recursively
+    for nested sections. Values in config, including lists, win."""
+    merged = copy.deepcopy(defaults)
+    for key, value in config.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_defaults(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def with_defaults(config_dict, defaults_path=DEFAULT_CONFIG_PATH):
+    """Return a project config merged on top of the defaults, with the project's
+    paths filled into the default folders it lacked."""
+    if not os.path.exists(defaults_path):
+        return config_dict
+    with open(defaults_path) as defaults_file:
+        defaults = json.load(defaults_file)
+    merged = merge_defaults(defaults, config_dict)
+    if "project_name" in config_dict and "projects_folder" in config_dict:
+        project_root = f"{config_dict['projects_folder']}/{config_dict['project_name']}"
+        for key, value in merged["directories"].items():
+            merged["directories"][key] = value.replace("$project_root$", project_root)
+    return merged
+
+
+def keep_alpha_white_video(config_dict, merged):
+    """Projects created before alpha-white frames could be derived from the alpha
+    video have an alpha-white video, which they keep using. Set the merged config's
+    alpha-white source accordingly if the project's file has no alpha_white
+    options."""
+    if "alpha_white" not in config_dict.get("frame_extraction", {}) and (
+        config_dict.get("alpha_white_vid")
+    ):
+        merged["frame_extraction"]["alpha_white"]["source"] = "video"
+    return merged
 
 
 class Config:
     def __init__(self, config_file_path):
         """Initialize the config object."""
         self.config_file_path = config_file_path
+        self.transaction_depth = 0
+        self.unsaved_changes = False
+        self.snapshots = {}
         self.config = self.load_config()
 
     def get(self, key):
@@ -14,15 +68,83 @@ class Config:
     def set(self, key, value):
         """Set the value of the key."""
         self.config[key] = value
-        self.save_config()
+        self.snapshots = {}
+        if self.transaction_depth:
+            self.unsaved_changes = True
+        else:
+            self.save_config()
+
+    @contextmanager
+    def transaction(self):
+        """Save the changes made inside the with block once, when it ends. If the
+        block raises, the changes are discarded. Transactions may be nested; the
+        outermost one saves."""
+        if not self.transaction_depth:
+            saved = copy.deepcopy(self.config)
+        self.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.transaction_depth -= 1
+            if not self.transaction_depth:
+                self.config = saved
+                self.snapshots = {}
+                self.unsaved_changes = False
+            raise
+        self.transaction_depth -= 1
+        if not self.transaction_depth and self.unsaved_changes:
+            self.save_config()
 
     def load_config(self):
         """Load the config file and return the config object."""
         with open(self.config_file_path) as config_file:
+            self.mtime_ns = os.fstat(config_file.fileno()).st_mtime_ns
             config_dict = json.load(config_file)
-        return dict(config_dict)
+        return keep_alpha_white_video(config_dict, with_defaults(dict(config_dict)))
+
+    def reload_if_changed(self):
+        """Reload the config file if it changed on disk since it was loaded or
+        saved. Return whether it was reloaded."""
+        if self.transaction_depth:
+            return False
+        if os.stat(self.config_file_path).st_mtime_ns == self.mtime_ns:
+            return False
+        self.config = self.load_config()
+        self.snapshots = {}
+        return True
 
     def save_config(self):
         """Save the config file."""
-        with open(self.config_file_path, "w") as config_file:
-            json.dump(self.config, config_file, indent=4)
+        folder = os.path.dirname(os.path.abspath(self.config_file_path))
+        # Written next to the file and moved over it, so a reader never sees a
+        # partly written config
+        config_file = tempfile.NamedTemporaryFile(
+            "w", dir=folder, suffix=".tmp", delete=False
+        )
+        try:
+            with config_file:
+                json.dump(self.config, config_file, indent=4)
+            if os.path.exists(self.config_file_path):
+                os.chmod(
+                    config_file.name,
+                    stat.S_IMODE(os.stat(self.config_file_path).st_mode),
+                )
+            os.replace(config_file.name, self.config_file_path)
+        except BaseException:
+            os.unlink(config_file.name)
+            raise
+        self.mtime_ns = os.stat(self.config_file_path).st_mtime_ns
+        self.unsaved_changes = False
+
+    def snapshot(self, parameters_class):
+        if parameters_class not in self.snapshots:
+            self.snapshots[parameters_class] = parameters_class.from_config(self)
+        return self.snapshots[parameters_class]
+
+    def analysis_parameters(self):
+        """Return the keyframe_determination options as an AnalysisParameters."""
+        return self.snapshot(AnalysisParameters)
+
+    def blending_parameters(self):
+        """Return the compositing and stitching options as a BlendingParameters."""
+        return self.snapshot(BlendingParameters)
@@ -0,0 +1,64 @@
+from typing import NamedTuple, Optional
+
+
+class AnalysisParameters(NamedTuple):
+    """Read-only snapshot of the keyframe_determination section, for code that reads
+    the same options many times, e.g., per frame."""
+
+    max_keyframe_group_size: int
+    motion_weight: float
+    color_weight: float
+    motion_threshold: float
+    color_threshold: float
+    streaming: bool
+    feature_thumbnail_width: Optional[int]
+    feature_plane_width: Optional[int]
+    analysis_workers: int
+    analysis_chunk_size: int
+    analysis_cache: bool
+    mask_roi: bool
+    mask_roi_padding: int
+    working_width: Optional[int]
+    proxy_width: Optional[int]
+    proxy_refine_margin: float
+    proxy_report: bool
+
+    @classmethod
+    def from_config(cls, config):
+        section = config.get("keyframe_determination")
+        return cls(**{field: section[field] for field in cls._fields})
+
+
+class BlendingParameters(NamedTuple):
+    """Read-only snapshot of the compositing and stitching options."""
+
+    workers: Optional[int]
+    writer_threads: int
+    streaming: bool
+    write_frames: bool
+    stream_chunk_size: int
+    crf: int
+    upscaled: bool
+    temporal_blending: bool
+    blend_weighting: str
+    blend_mode: str
+    blend_opacity: float
+
+    @classmethod
+    def from_config(cls, config):
+        compositing = config.get("compositing")
+        stitching = config.get("stitching")
+        frame_blending = config.get("frame_blending")
+        return cls(
+            compositing["workers"],
+            compositing["writer_threads"],
+            stitching["streaming"],
+            stitching["write_frames"],
+            stitching["stream_chunk_size"],
+            stitching["crf"],
+            config.get("upscaling")["original"]["enabled"],
+            frame_blending["enabled"],
+            frame_blending["weighting"],
+            frame_blending["tblend"]["blend"],
+            frame_blending["tblend"]["opacity"],
+        )
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import numpy as np
+from frame_analysis.frame_features import FeatureCache, FeatureOptions
+
+
+# Bump when the stored arrays or the way they are computed change, so caches written
+# by older versions are recomputed instead of misread.
+ANALYSIS_CACHE_VERSION = 2
+
+
+class AnalysisCache:
+    """
+    On-disk cache of the first analysis pass of a project's alpha video.
+
+    Stores the unweighted motion and color differences, fps, histograms, thumbnails,
+    regions of interest and grayscale planes of every scored frame. Weights and
+    thresholds are applied after loading, so changing them does not invalidate the
+    cache and keyframes can be re-selected without decoding the video.
+
+    The cache is a pair of files in the project folder: analysis-cache.npz with the
+    scores and features, and analysis-cache.planes with the raw grayscale planes,
+    read back through a memory map. The npz holds a key made from the video's path,
+    size and modification time and the parameters the features depend on; a cache
+    whose key does not match is ignored and overwritten on the next save.
+
+    Attributes:
+        config (dict): The project's config dictionary.
+        analysis_parameters (AnalysisParameters): The analysis options, by default
+            the config's.
+        path (str): Path of the npz file. The planes file sits next to it.
+    """
+
+    def __init__(self, config, analysis_parameters=None):
+        self.config = config
+        self.analysis_parameters = (
+            analysis_parameters
+            if analysis_parameters is not None
+            else config.analysis_parameters()
+        )
+        self.path = (
+            self.config.get("projects_folder")
+            + "/"
+            + self.config.get("project_name")
+            + "/analysis-cache.npz"
+        )
+        self.planes_path = self.path[: -len(".npz")] + ".planes"
+        self._key = None
+
+    def parameters(self):
+        """The analysis parameters the cached features depend on."""
+        parameters = FeatureOptions.from_parameters(self.analysis_parameters).as_dict()
+        parameters["proxy_width"] = self.analysis_parameters.proxy_width
+        parameters["feature_plane_width"] = self.analysis_parameters.feature_plane_width
+        parameters["version"] = ANALYSIS_CACHE_VERSION
+        return parameters
+
+    def key(self):
+        """Hash of the alpha video's path, size and modification time and the
+        analysis parameters. Hashing the video's contents would read the whole
+        video on every run, which is what the cache saves."""
+        if self._key is None:
+            video_path = os.path.abspath(self.config.get("alpha_vid"))
+            stat = os.stat(video_path)
+            video = {
+                "path": video_path,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+            digest = hashlib.sha256()
+            digest.update(json.dumps(video, sort_keys=True).encode())
+            digest.update(json.dumps(self.parameters(), sort_keys=True).encode())
+            self._key = digest.hexdigest()
+        return self._key
+
+    def load(self):
+        """
+        Return the cached analysis as a dict, or None if there is no cache for the
+        current video and parameters.
+
+        The dict holds "fps", the unweighted "motion_diffs" and "color_diffs" as
+        arrays, and "feature_cache", a FeatureCache over the stored features.
+        """
+        if not (os.path.exists(self.path) and os.path.exists(self.planes_path)):
+            return None
+        with np.load(self.path) as cached:
+            if str(cached["key"]) != self.key():
+                return None
+            frame_count = len(cached["motion_diffs"])
+            thumbnails = (
+                list(cached["thumbnails"])
+                if cached["has_thumbnails"]
+                else [None] * frame_count
+            )
+            plane_shape = tuple(int(x) for x in cached["plane_shape"])
+            if os.path.getsize(self.planes_path) != frame_count * int(
+                np.prod(plane_shape)
+            ):
+                return None
+            return {
+                "fps": float(cached["fps"]),
+                "motion_diffs": cached["motion_diffs"],
+                "color_diffs": cached["color_diffs"],
+                "feature_cache": FeatureCache.load(
+                    self.planes_path,
+                    plane_shape,
+                    cached["histograms"],
+                    thumbnails,
+                    [
+                        None if roi[0] < 0 else tuple(map(int, roi))
+                        for roi in cached["rois"]
+                    ],
+                    tuple(int(x) for x in cached["full_plane_shape"]),
+                ),
+            }
+
+    def save(self, fps, motion_diffs, color_diffs, feature_cache):
+        """Store the unweighted differences and features of an analysis pass."""
+        # Drop the npz first so an interrupted save never leaves a valid key next to
+        # a partially written planes file.
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        feature_cache.save_planes(self.planes_path)
+        has_thumbnails = bool(feature_cache.thumbnails) and all(
+            thumbnail is not None for thumbnail in feature_cache.thumbnails
+        )
+        np.savez(
+            self.path,
+            key=np.array(self.key()),
+            fps=np.array(fps, dtype=np.float64),
+            motion_diffs=np.asarray(motion_diffs, dtype=np.float64),
+            color_diffs=np.asarray(color_diffs, dtype=np.float64),
+            histograms=np.stack(feature_cache.histograms),
+            has_thumbnails=np.array(has_thumbnails),
+            thumbnails=(
+                np.stack(feature_cache.thumbnails)
+                if has_thumbnails
+                else np.zeros((0,), dtype=np.uint8)
+            ),
+            plane_shape=np.array(feature_cache.plane_shape, dtype=np.int64),
+            full_plane_shape=np.array(feature_cache.full_plane_shape, dtype=np.int64),
+            # -1 for frames without a region of interest
+            rois=np.array(
+                [(-1,) * 4 if roi is None else roi for roi in feature_cache.rois],
+                dtype=np.int64,
+            ).reshape(-1, 4),
+        )
@@ -0,0 +1,378 @@
+import math
+import os
+import shutil
+import tempfile
+import cv2
+import numpy as np
+
+
+# Pixels of the alpha video whose channels are all at or below this level are treated
+# as outside the mask. Keeps compression noise in the black background from growing
+# the mask's bounding box.
+MASK_BLACK_LEVEL = 16
+
+
+class FeatureOptions:
+    """
+    How frames are reduced to features. Every frame of an analysis must use the same
+    options so their features can be compared.
+
+    Attributes:
+        thumbnail_width (int): Width of the optional thumbnail, or None for no thumbnail.
+        mask_roi (bool): Whether only the bounding box of the mask is converted and
+            histogrammed. The rest of the grayscale plane is left black.
+        roi_padding (int): Pixels added on each side of the mask's bounding box.
+        working_width (int): Width frames are downscaled to before scoring, or None to
+            score at full resolution.
+    """
+
+    def __init__(
+        self, thumbnail_width=None, mask_roi=False, roi_padding=0, working_width=None
+    ):
+        self.thumbnail_width = thumbnail_width
+        self.mask_roi = mask_roi
+        self.roi_padding = roi_padding
+        self.working_width = working_width
+
+    @classmethod
+    def from_config(cls, config):
+        """Read the options from the keyframe_determination section of a config."""
+        return cls.from_parameters(config.analysis_parameters())
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        """Read the options from an AnalysisParameters."""
+        return cls(
+            parameters.feature_thumbnail_width,
+            parameters.mask_roi,
+            parameters.mask_roi_padding,
+            parameters.working_width,
+        )
+
+    def as_dict(self):
+        return {
+            "feature_thumbnail_width": self.thumbnail_width,
+            "mask_roi": self.mask_roi,
+            "mask_roi_padding": self.roi_padding,
+            "working_width": self.working_width,
+        }
+
+
+def mask_bounding_box(frame, padding=0):
+    """
+    Return the bounding box (x0, y0, x1, y1) of the pixels of a BGR frame that are
+    brighter than MASK_BLACK_LEVEL in any channel, grown by padding and clipped to the
+    frame. The box is empty (x1 == x0) if the whole frame is black.
+    """
+    height, width, channels = frame.shape
+    # Thresholding the interleaved channels as one wide plane finds pixels that are
+    # bright in any channel in a single pass, without splitting the frame.
+    _, mask = cv2.threshold(
+        frame.reshape(height, width * channels), MASK_BLACK_LEVEL, 255, cv2.THRESH_BINARY
+    )
+    x, y, box_width, box_height = cv2.boundingRect(mask)
+    if box_width == 0 or box_height == 0:
+        return 0, 0, 0, 0
+    return (
+        max(0, x // channels - padding),
+        max(0, y - padding),
+        min(width, -(-(x + box_width) // channels) + padding),
+        min(height, y + box_height + padding),
+    )
+
+
+class FrameFeatures:
+    """
+    The reduced representation of a frame that keyframe scoring works on.
+
+    Attributes:
+        gray (ndarray): The grayscale plane of the frame.
+        histogram (ndarray): The 256-bin histogram of the grayscale plane.
+        thumbnail (ndarray): Optional downscaled copy of the grayscale plane.
+        roi (tuple): The region (x0, y0, x1, y1) of the plane outside of which every
+            pixel is black, or None if it is the whole plane.
+    """
+
+    def __init__(self, gray, histogram, thumbnail=None, roi=None):
+        self.gray = gray
+        self.histogram = histogram
+        self.thumbnail = thumbnail
+        self.roi = roi
+
+    @classmethod
+    def from_frame(cls, frame, options=None):
+        """
+        Compute the features of a BGR frame.
+
+        With options.working_width set, the grayscale plane is downscaled to that width.
+        With options.mask_roi set, only the bounding box of the mask is converted,
+        scaled and histogrammed; the rest of the plane is black.
+        """
+        if options is None:
+            options = FeatureOptions()
+        height, width = frame.shape[:2]
+        scale = 1.0
+        if options.working_width and options.working_width < width:
+            scale = options.working_width / width
+        plane_height = max(1, round(height * scale))
+        plane_width = max(1, round(width * scale))
+
+        if not options.mask_roi:
+            roi = None
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if scale != 1.0:
+                gray = cv2.resize(
+                    gray, (plane_width, plane_height), interpolation=cv2.INTER_AREA
+                )
+            histogram = cv2.calcHist([gray], [0], None, [256], [0, 256])
+        else:
+            x0, y0, x1, y1 = mask_bounding_box(frame, options.roi_padding)
+            roi = (
+                int(x0 * scale),
+                int(y0 * scale),
+                min(plane_width, math.ceil(x1 * scale)),
+                min(plane_height, math.ceil(y1 * scale)),
+            )
+            gray = np.zeros((plane_height, plane_width), dtype=np.uint8)
+            if roi[2] > roi[0] and roi[3] > roi[1]:
+                crop = cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+                if scale != 1.0:
+                    crop = cv2.resize(
+                        crop,
+                        (roi[2] - roi[0], roi[3] - roi[1]),
+                        interpolation=cv2.INTER_AREA,
+                    )
+                gray[roi[1] : roi[3], roi[0] : roi[2]] = crop
+                histogram = cv2.calcHist([crop], [0], None, [256], [0, 256])
+            else:
+                histogram = np.zeros((256, 1), dtype=np.float32)
+
+        thumbnail = None
+        if options.thumbnail_width:
+            thumbnail_height = max(
+                1, round(plane_height * options.thumbnail_width / plane_width)
+            )
+            thumbnail = cv2.resize(
+                gray,
+                (options.thumbnail_width, thumbnail_height),
+                interpolation=cv2.INTER_AREA,
+            )
+        return cls(gray, histogram, thumbnail, roi)
+
+    def reduced(self, plane_width):
+        """Return these features with the grayscale plane (and region of interest)
+        downscaled to plane_width, or the features themselves if the plane is not
+        wider. Histograms and thumbnails are kept."""
+        height, width = self.gray.shape
+        if not plane_width or plane_width >= width:
+            return self
+        scale = plane_width / width
+        plane_height = max(1, round(height * scale))
+        gray = cv2.resize(
+            self.gray, (plane_width, plane_height), interpolation=cv2.INTER_AREA
+        )
+        roi = self.roi
+        if roi is not None:
+            roi = (
+                int(roi[0] * scale),
+                int(roi[1] * scale),
+                min(plane_width, math.ceil(roi[2] * scale)),
+                min(plane_height, math.ceil(roi[3] * scale)),
+            )
+        return FrameFeatures(gray, self.histogram, self.thumbnail, roi)
+
+    def motion_difference(self, other):
+        """Sum of absolute differences between the grayscale planes. If both frames
+        have a region of interest, only the union of the two regions is compared,
+        since the planes are black everywhere else."""
+        if self.roi is None or other.roi is None:
+            return cv2.norm(self.gray, other.gray, cv2.NORM_L1)
+        x0, y0 = min(self.roi[0], other.roi[0]), min(self.roi[1], other.roi[1])
+        x1, y1 = max(self.roi[2], other.roi[2]), max(self.roi[3], other.roi[3])
+        if x1 <= x0 or y1 <= y0:
+            return 0.0
+        return cv2.norm(
+            self.gray[y0:y1, x0:x1], other.gray[y0:y1, x0:x1], cv2.NORM_L1
+        )
+
+    def color_difference(self, other):
+        """Chi-squared distance between the grayscale histograms."""
+        return cv2.compareHist(self.histogram, other.histogram, cv2.HISTCMP_CHISQR)
+
+
+class FeatureCache:
+    """
+    Holds the features of every analyzed frame so each frame is converted and
+    histogrammed exactly once.
+
+    If a directory is given, grayscale planes are appended to a temporary file in that
+    directory and read back through a memory map, so the cache does not grow resident
+    memory with the length of the clip. Otherwise they are kept in memory. Histograms
+    (1 KB per frame) and thumbnails are always kept in memory.
+
+    With plane_width set, planes wider than that are stored downscaled to it (see
+    FrameFeatures.reduced), so they take a fraction of the space of full resolution
+    planes. Motion differences between stored planes are then only estimates:
+    calibrate_motion scales them to the full resolution differences of the analysis
+    pass, and selection rescores frames near the threshold at full resolution.
+
+    Analysis worker processes can fill a file backed cache directly: they write planes
+    to plane_path() with write_plane() and the parent then appends the remaining
+    features in order with append(features, written_plane_shape=...).
+    """
+
+    def __init__(self, directory=None, options=None, plane_width=None):
+        self.directory = directory
+        self.options = options if options is not None else FeatureOptions()
+        self.plane_width = plane_width
+        self.histograms = []
+        self.thumbnails = []
+        self.rois = []
+        self.planes = []
+        self.plane_shape = None
+        self.full_plane_shape = None
+        self.motion_scale = 1.0
+        self.plane_file = None
+        self.plane_map = None
+        if directory is not None:
+            self.plane_file = tempfile.NamedTemporaryFile(
+                dir=directory, prefix=".features-"
+            )
+
+    def __len__(self):
+        return len(self.histograms)
+
+    def plane_path(self):
+        """Return the path of the plane file, or None if planes are kept in memory."""
+        return None if self.plane_file is None else self.plane_file.name
+
+    @staticmethod
+    def write_plane(plane_file, index, gray):
+        """Write a grayscale plane at its slot in an open plane file."""
+        data = np.ascontiguousarray(gray)
+        os.pwrite(plane_file.fileno(), data.tobytes(), index * data.nbytes)
+
+    def add(self, frame):
+        """Compute and store the features of a BGR frame. Return the features."""
+        return self.append(FrameFeatures.from_frame(frame, self.options))
+
+    def append(self, features, written_plane_shape=None, full_plane_shape=None):
+        """Store already computed features as the next frame. Return the features.
+
+        If the frame's plane was already written to the plane file with write_plane,
+        pass its shape as written_plane_shape; features.gray may then be None. If the
+        plane (and roi) of features were already reduced, pass the shape of the full
+        plane as full_plane_shape.
+        """
+        self.full_plane_shape = full_plane_shape or (
+            written_plane_shape or features.gray.shape
+        )
+        if written_plane_shape is not None:
+            self.plane_shape = written_plane_shape
+            stored = features
+        else:
+            stored = features.reduced(self.plane_width)
+            self.plane_shape = stored.gray.shape
+            if self.plane_file is None:
+                self.planes.append(stored.gray)
+            else:
+                self.write_plane(self.plane_file, len(self), stored.gray)
+        self.plane_map = None
+        self.rois.append(stored.roi)
+        self.histograms.append(features.histogram)
+        self.thumbnails.append(features.thumbnail)
+        return features
+
+    def is_reduced(self):
+        """Whether the stored planes are smaller than the analyzed ones."""
+        return self.plane_shape != self.full_plane_shape
+
+    def calibrate_motion(self, raw_motion_diffs, block_size=256):
+        """
+        Set motion_scale, the factor that brings motion differences between stored
+        planes to full resolution, from the unweighted full resolution differences
+        of consecutive frames (raw_motion_diffs[i] is between frame i and i - 1).
+
+        Downscaling averages texture away, so the factor is measured as the ratio
+        of the summed full resolution to the summed stored differences rather than
+        taken from the area ratio.
+        """
+        self.motion_scale = 1.0
+        if not self.is_reduced() or len(self) < 2:
+            return
+        stored_total = 0.0
+        for start in range(1, len(self), block_size):
+            stop = min(start + block_size, len(self))
+            current = self.grays(start, stop).astype(np.int16)
+            previous = self.grays(start - 1, stop - 1).astype(np.int16)
+            stored_total += float(np.abs(current - previous).sum(dtype=np.int64))
+        full_total = float(np.sum(raw_motion_diffs[1:]))
+        if stored_total > 0 and full_total > 0:
+            self.motion_scale = full_total / stored_total
+
+    def save_planes(self, path):
+        """Write the cached grayscale planes, in order, to a raw file at path."""
+        if os.path.exists(path):
+            os.remove(path)
+        if self.plane_file is None:
+            with open(path, "wb") as plane_file:
+                for gray in self.planes:
+                    plane_file.write(np.ascontiguousarray(gray).tobytes())
+            return
+        try:
+            os.link(self.plane_file.name, path)
+        except OSError:
+            shutil.copyfile(self.plane_file.name, path)
+
+    @classmethod
+    def load(
+        cls, path, plane_shape, histograms, thumbnails, rois=None, full_plane_shape=None
+    ):
+        """Open a cache whose planes were written to path by save_planes. The planes
+        are read back through a memory map and the file is left in place on close."""
+        cache = cls()
+        cache.plane_file = open(path, "rb")
+        cache.plane_shape = plane_shape
+        cache.full_plane_shape = full_plane_shape or plane_shape
+        cache.histograms = list(histograms)
+        cache.thumbnails = list(thumbnails)
+        cache.rois = list(rois) if rois is not None else [None] * len(cache)
+        return cache
+
+    def mapped_planes(self):
+        """Return the memory map over the plane file, mapping it if needed."""
+        if self.plane_map is None:
+            self.plane_map = np.memmap(
+                self.plane_file,
+                dtype=np.uint8,
+                mode="r",
+                shape=(len(self),) + self.plane_shape,
+            )
+        return self.plane_map
+
+    def gray(self, index):
+        if self.plane_file is None:
+            return self.planes[index]
+        return self.mapped_planes()[index]
+
+    def grays(self, start, stop):
+        """Return the grayscale planes of frames start..stop-1 as one array."""
+        if self.plane_file is None:
+            return np.stack(self.planes[start:stop])
+        return self.mapped_planes()[start:stop]
+
+    def __getitem__(self, index):
+        return FrameFeatures(
+            self.gray(index),
+            self.histograms[index],
+            self.thumbnails[index],
+            self.rois[index],
+        )
+
+    def close(self):
+        """Release the cached planes."""
+        self.planes = []
+        self.plane_map = None
+        if self.plane_file is not None:
+            self.plane_file.close()
+            self.plane_file = None
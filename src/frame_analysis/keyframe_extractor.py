@@ -1,58 +1,118 @@
 import cv2
+import numpy as np
+from functools import partial
 from pprint import pformat
+from frame_analysis.lazy_frame import LazyFrame
+from frame_analysis.frame_features import FrameFeatures, FeatureCache, FeatureOptions
+from frame_analysis.analysis_cache import AnalysisCache
+from frame_analysis.keyframe_selection import select_keyframes
+from frame_analysis.proxy_analysis import (
+    FullResolutionScorer,
+    ProxyRefiner,
+    compare_selections,
+    read_proxy_frames,
+    resize_to_proxies,
+)
+from frame_analysis.parallel_analysis import (
+    FIRST_SCORED_POSITION,
+    frame_ranges,
+    score_frame_range,
+    video_keyframes,
+)
+from project_manager.process_pool import pool_size, process_pool
 
 
 class KeyFrames:
     """
-    This class is responsible for analyzing the frames of the alpha video and determining which frames are keyframes.
-    It also stores the keyframes and their children in a list of dictionaries.
-
-    Keyframes are determined by comparing the color and motion differences between frames.
-    The color difference is calculated by comparing the histograms of the grayscale versions of the frames.
-    The motion difference is calculated by comparing the grayscale versions of the frames.
-
-    The average color and motion differences are calculated and used, along with the user's weights, to determine the thresholds for determining keyframes.
-
-    The thresholds are calculated by subtracting the minimum difference from the average difference and multiplying by the threshold weight. The combined threshold is the sum of the motion and color thresholds.
-
-    Once the thresholds are calculated, the frames are analyzed again to determine keyframes.
-
-    The first frame is set as a keyframe. Then, the color and motion differences between each frame and the previous KEYFRAME are calculated for each frame.
-    If the combined difference is greater than the combined threshold, the frame is set as a keyframe.
-    Otherwise, the frame is set as a child of the previous keyframe.
-
-    Weights and thresholds are set in the config.json file.
+    This class is responsible for analyzing the frames of the alpha video and
+    determining which frames are keyframes. It also stores the keyframes and their
+    children, as NumPy arrays and, on demand, as a list of dictionaries.
+
+    Keyframes are determined by comparing the color and motion differences between
+    frames. The color difference is calculated by comparing the histograms of the
+    grayscale versions of the frames. The motion difference is calculated by
+    comparing the grayscale versions of the frames.
+
+    The thresholds are calculated by subtracting the minimum difference from the
+    average difference and multiplying by the user's threshold weight. The combined
+    threshold is the sum of the motion and color thresholds.
+
+    The first frame is set as a keyframe. Then, each frame is compared with the
+    previous KEYFRAME, using the features cached by the first pass (see
+    FeatureCache and select_keyframes). If the combined difference is greater than
+    the combined threshold, the frame is set as a keyframe. Otherwise, the frame is
+    set as a child of the previous keyframe.
+
+    Weights, thresholds and the analysis options (streaming, mask_roi,
+    working_width, feature_plane_width, analysis_cache, analysis_workers,
+    proxy_width) are set in the keyframe_determination section of config.json.
+    At most max_workers processes score the frames in parallel.
 
     Attributes:
         config (dict): The project's config dictionary.
         log (Log): The project's log object.
-        frames (list): A list of frame objects.
-        keyframes (list): A list of pointers to frame objects in self.frames.
-        all_color_diffs (list): A list of all color differences between frames.
-        all_motion_diffs (list): A list of all motion differences between frames.
+        alpha_frames (iterable): Optional decoded frames of the alpha video, e.g.,
+            from a FrameExtractor, read instead of decoding the alpha video.
+        parameters (AnalysisParameters): The analysis options, by default the
+            config's keyframe_determination.
+        frames (list): A list of frame objects, or None until get_frame_objects is
+            called.
+        keyframes (list): A list of pointers to frame objects in self.frames, or
+            None until built.
+        all_color_diffs (ndarray): The weighted color differences between
+            consecutive frames.
+        all_motion_diffs (ndarray): The weighted motion differences between
+            consecutive frames.
+        raw_color_diffs (ndarray): The color differences before weighting.
+        raw_motion_diffs (ndarray): The motion differences before weighting.
+        keyframe_indices (ndarray): The indices of the keyframes in the frame arrays.
+        keyframe_color_diffs (ndarray): The weighted color difference between each
+            frame and its keyframe.
+        keyframe_motion_diffs (ndarray): The weighted motion difference between each
+            frame and its keyframe.
         min_color_diff (float): The minimum color difference between frames.
         max_color_diff (float): The maximum color difference between frames.
         average_color_diff (float): The average color difference between frames.
         min_motion_diff (float): The minimum motion difference between frames.
         max_motion_diff (float): The maximum motion difference between frames.
         average_motion_diff (float): The average motion difference between frames.
-        calculated_motion_threshold (float): The calculated motion threshold for determining keyframes.
-        calculated_color_threshold (float): The calculated color threshold for determining keyframes.
-        combined_threshold (float): The combined threshold for determining keyframes.
+        calculated_motion_threshold (float): The calculated motion threshold.
+        calculated_color_threshold (float): The calculated color threshold.
+        combined_threshold (float): The combined threshold for determining
+            keyframes.
     """
 
-    def __init__(self, config, log):
+    def __init__(
+        self, config, log, alpha_frames=None, parameters=None, max_workers=None
+    ):
         self.config = config
+        self.max_workers = max_workers
+        # Bound once, read throughout the analysis
+        self.parameters = (
+            parameters if parameters is not None else config.analysis_parameters()
+        )
         self.log = log
-        self.frames = []
-        self.keyframes = []
-        self.all_color_diffs = []
-        self.all_motion_diffs = []
-
-        self.analyze_frames()
-        self.set_difference_measures()
-        self.set_difference_thresholds()
-        self.set_keyframes()
+        self.alpha_frames = alpha_frames
+        self.frames = None
+        self.keyframes = None
+        self.raw_color_diffs = []
+        self.raw_motion_diffs = []
+        self.decoded_frames = []
+        self.feature_cache = None
+
+        try:
+            if not self.load_analysis():
+                self.feature_cache = self.create_feature_cache()
+                self.analyze_frames()
+                self.save_analysis()
+            self.set_scores()
+            self.feature_cache.calibrate_motion(self.raw_motion_diffs)
+            self.set_difference_measures()
+            self.set_difference_thresholds()
+            self.set_keyframes()
+        finally:
+            if self.feature_cache is not None:
+                self.feature_cache.close()
 
         self.log.write(
             [
@@ -61,62 +121,78 @@ class KeyFrames:
                 "frame count:",
                 self.get_frame_count(),
                 "difference properties:",
-                pformat(self.get_difference_properties()),
+                lambda: pformat(self.get_difference_properties()),
                 "keyframe details:",
-                pformat(self.get_keyframe_details()),
+                lambda: pformat(self.get_keyframe_details()),
                 "\nkeyframe original indices:",
-                self.get_keyframe_original_indices(),
+                self.get_keyframe_original_indices,
                 "\n\nkeyframe visualization:",
-                self.get_keyframe_vizualization(),
+                self.get_keyframe_vizualization,
+            ]
+        )
+        # Probably not necessary to print these objects. Only formatted (and only
+        # built) at log_level debug
+        self.log.debug(
+            [
+                "\nframe objects:",
+                lambda: pformat(self.get_frame_objects()),
+                "keyframe objects:",
+                lambda: pformat(self.get_keyframe_objects()),
             ]
         )
-        # Probably not necessary to print these objects
-        if self.config.get("verbose"):
-            self.log.write(
-                [
-                    "\nframe objects:",
-                    pformat(self.get_frame_objects()),
-                    "keyframe objects:",
-                    pformat(self.get_keyframe_objects()),
-                ]
-            )
 
     def get_fps(self):
         return self.fps
 
     def get_frame_count(self):
-        return len(self.frames)
+        return len(self.all_motion_diffs)
 
     def get_frame_objects(self):
+        if self.frames is None:
+            self.build_frame_objects()
         return self.frames
 
     def get_keyframe_objects(self):
+        if self.keyframes is None:
+            self.build_frame_objects()
         return self.keyframes
 
     def get_keyframe_original_indices(self):
-        return [frame["frame_index_original"] for frame in self.keyframes]
+        return self.original_indices(self.keyframe_indices).tolist()
+
+    def original_indices(self, indices):
+        """Convert indices into the frame arrays to original frame indices. The first
+        frame of the video is only read as the previous frame of the second, so
+        original indices are one ahead of array indices."""
+        return indices + 1
+
+    def get_group_boundaries(self):
+        """Return the start (the keyframe) and end (exclusive) array index of each
+        keyframe group."""
+        ends = np.append(self.keyframe_indices[1:], self.get_frame_count())
+        return self.keyframe_indices, ends
 
     def get_keyframe_details(self):
+        starts, ends = self.get_group_boundaries()
+        # Group sizes include the keyframe itself
+        group_sizes = ends - starts
         return {
-            "number of keyframes": len(self.keyframes),
-            "ratio of keyframes to frames": len(self.keyframes) / len(self.frames),
-            "average keyframe group size": len(self.frames) / len(self.keyframes),
-            # + 1 to account for the keyframe itself
-            "largest keyframe group": max(
-                [len(x["keyframe_children_indices"]) for x in self.keyframes]
-            )
-            + 1,
-            "smallest keyframe group": min(
-                [len(x["keyframe_children_indices"]) for x in self.keyframes]
-            )
-            + 1,
+            "number of keyframes": len(self.keyframe_indices),
+            "ratio of keyframes to frames": len(self.keyframe_indices)
+            / self.get_frame_count(),
+            "average keyframe group size": self.get_frame_count()
+            / len(self.keyframe_indices),
+            "largest keyframe group": int(group_sizes.max()),
+            "smallest keyframe group": int(group_sizes.min()),
         }
 
     def get_keyframe_vizualization(self, line_width=39):
+        is_keyframe = np.zeros(self.get_frame_count(), dtype=bool)
+        is_keyframe[self.keyframe_indices] = True
         characters = []
         cur_width = 0
-        for frame in self.frames:
-            if frame["keyframe"]:
+        for keyframe in is_keyframe:
+            if keyframe:
                 characters.append("_X_")
             else:
                 characters.append("___")
@@ -140,135 +216,418 @@ class KeyFrames:
             "combined_threshold": self.combined_threshold,
         }
 
-    def set_difference_measures(self):
-        self.min_color_diff = min(self.all_color_diffs)
-        self.max_color_diff = max(self.all_color_diffs)
-        self.average_color_diff = sum(self.all_color_diffs) / len(self.all_color_diffs)
-        self.min_motion_diff = min(self.all_motion_diffs)
-        self.max_motion_diff = max(self.all_motion_diffs)
-        self.average_motion_diff = sum(self.all_motion_diffs) / len(
-            self.all_motion_diffs
+    def set_scores(self):
+        """Convert the differences of the analysis pass to arrays and weight them."""
+        self.raw_motion_diffs = np.asarray(self.raw_motion_diffs, dtype=np.float64)
+        self.raw_color_diffs = np.asarray(self.raw_color_diffs, dtype=np.float64)
+        self.all_motion_diffs = (
+            self.raw_motion_diffs
+            * self.parameters.motion_weight
+        )
+        self.all_color_diffs = (
+            self.raw_color_diffs
+            * self.parameters.color_weight
         )
 
+    def set_difference_measures(self):
+        self.min_color_diff = float(self.all_color_diffs.min())
+        self.max_color_diff = float(self.all_color_diffs.max())
+        self.average_color_diff = float(self.all_color_diffs.mean())
+        self.min_motion_diff = float(self.all_motion_diffs.min())
+        self.max_motion_diff = float(self.all_motion_diffs.max())
+        self.average_motion_diff = float(self.all_motion_diffs.mean())
+
     def set_difference_thresholds(self):
         # Placeholder algorithm (needs improving):
         # (average diff) -  (minimum diff) * (1 - threshold)
         self.calculated_motion_threshold = (
             self.average_motion_diff - self.min_motion_diff
-        ) * (1 - self.config.get("keyframe_determination")["motion_threshold"])
+        ) * (1 - self.parameters.motion_threshold)
         self.calculated_color_threshold = (
             self.average_color_diff - self.min_color_diff
-        ) * (1 - self.config.get("keyframe_determination")["color_threshold"])
+        ) * (1 - self.parameters.color_threshold)
         self.combined_threshold = (
             self.calculated_motion_threshold + self.calculated_color_threshold
         )
 
     def calculate_color_difference(self, frame1, frame2):
-        hist1 = cv2.calcHist(
-            [cv2.cvtColor(frame1, cv2.COLOR_BGR2GRAY)], [0], None, [256], [0, 256]
-        )
-        hist2 = cv2.calcHist(
-            [cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY)], [0], None, [256], [0, 256]
+        return FrameFeatures.from_frame(frame1).color_difference(
+            FrameFeatures.from_frame(frame2)
         )
-        color_diff = cv2.compareHist(hist1, hist2, cv2.HISTCMP_CHISQR)
-        return color_diff
 
-    def analyze_frames(self):
-        video_capture = cv2.VideoCapture(self.config.get("alpha_vid"))
-        frame_count = 0
-        ret, prev_frame = video_capture.read()
+    def is_streaming(self):
+        """Whether decoded frames are dropped after scoring instead of being kept in
+        the frame objects. In streaming mode each frame object holds a LazyFrame
+        handle that re-reads the frame from the alpha video when needed."""
+        return self.parameters.streaming
+
+    def create_feature_cache(self):
+        """In streaming mode the cached grayscale planes are spilled to a temporary
+        file in the project folder instead of being held in memory. Either way they
+        are stored at most feature_plane_width wide."""
+        directory = None
+        if self.is_streaming():
+            directory = (
+                self.config.get("projects_folder")
+                + "/"
+                + self.config.get("project_name")
+            )
+        return FeatureCache(
+            directory,
+            FeatureOptions.from_parameters(self.parameters),
+            self.parameters.feature_plane_width,
+        )
 
-        self.fps = video_capture.get(cv2.CAP_PROP_FPS)
+    def is_caching(self):
+        """Whether the first analysis pass is stored in and loaded from an
+        AnalysisCache. Only streaming mode is cached, because frame objects hold the
+        decoded frames otherwise."""
+        return (
+            self.is_streaming()
+            and self.parameters.analysis_cache
+        )
 
-        while True:
-            ret, frame = video_capture.read()
+    def load_analysis(self):
+        """Rebuild the frame objects and feature cache from the analysis cache.
+        Return False if caching is off or there is no cache for this video."""
+        if not self.is_caching():
+            return False
+        self.analysis_cache = AnalysisCache(self.config, self.parameters)
+        cached = self.analysis_cache.load()
+        if cached is None:
+            self.log.write("No analysis cache for this video, analyzing frames")
+            return False
+        self.fps = cached["fps"]
+        self.feature_cache = cached["feature_cache"]
+        self.raw_motion_diffs = cached["motion_diffs"]
+        self.raw_color_diffs = cached["color_diffs"]
+        self.log.write("Loaded frame analysis from the analysis cache")
+        return True
+
+    def save_analysis(self):
+        if self.is_caching():
+            self.analysis_cache.save(
+                self.fps,
+                self.raw_motion_diffs,
+                self.raw_color_diffs,
+                self.feature_cache,
+            )
 
-            if not ret:
-                break
+    def add_scored_frame(self, motion_diff, color_diff, frame=None):
+        """Record the next scored frame of the alpha video, given its unweighted
+        differences to the frame before it."""
+        self.raw_motion_diffs.append(motion_diff)
+        self.raw_color_diffs.append(color_diff)
+        if not self.is_streaming():
+            self.decoded_frames.append(frame)
 
-            cur_frame = {"frame_index_original": frame_count, "cv2_frame_object": frame}
-            frame_count += 1
-            if frame_count > 1:
-                gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                gray_prev_frame = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
-                motion_diff = cv2.absdiff(gray_frame, gray_prev_frame).sum()
-                motion_diff = (
-                    motion_diff
-                    * self.config.get("keyframe_determination")["motion_weight"]
-                )
-                self.all_motion_diffs.append(motion_diff)
-                cur_frame["motion_diff"] = motion_diff
+    def is_proxy(self):
+        """Whether the first pass scores downscaled proxies of the frames."""
+        return self.is_streaming() and bool(self.parameters.proxy_width)
 
-                color_diff = self.calculate_color_difference(frame, prev_frame)
-                color_diff = (
-                    color_diff
-                    * self.config.get("keyframe_determination")["color_weight"]
+    def analyze_frames(self):
+        if self.parameters.analysis_workers > 1 and not self.is_proxy():
+            if self.analyze_frames_parallel():
+                return
+            self.log.warning(
+                "Analysis chunks of the alpha video did not line up, analyzing "
+                "frames sequentially"
+            )
+            self.feature_cache.close()
+            self.feature_cache = self.create_feature_cache()
+            self.raw_motion_diffs = []
+            self.raw_color_diffs = []
+            self.decoded_frames = []
+        self.analyze_frames_sequentially()
+
+    def read_alpha_frames(self):
+        """Yield the decoded frames of the alpha video, from alpha_frames if given,
+        or their proxies in proxy mode."""
+        video_capture = cv2.VideoCapture(self.config.get("alpha_vid"))
+        self.fps = video_capture.get(cv2.CAP_PROP_FPS)
+        if self.alpha_frames is not None:
+            video_capture.release()
+            if self.is_proxy():
+                yield from resize_to_proxies(
+                    self.alpha_frames, self.parameters.proxy_width
                 )
-                self.all_color_diffs.append(color_diff)
-                cur_frame["color_diff"] = color_diff
-
-                cur_frame["combined_score"] = motion_diff + color_diff
-                self.frames.append(cur_frame)
-
-            prev_frame = frame
+            else:
+                yield from self.alpha_frames
+            return
+        if self.is_proxy():
+            video_capture.release()
+            yield from read_proxy_frames(
+                self.config.get("alpha_vid"), self.parameters.proxy_width
+            )
+            return
+        try:
+            while True:
+                ret, frame = video_capture.read()
+                if not ret:
+                    break
+                yield frame
+        finally:
+            video_capture.release()
+
+    def analyze_frames_sequentially(self):
+        # Per-frame timings of the hot loop, see Profiler.section
+        decode = self.log.profiler.section("decode")
+        extract_features = self.log.profiler.section("features")
+        difference = self.log.profiler.section("difference")
+        alpha_frames = self.read_alpha_frames()
+        position = 0
+        prev_frame = next(alpha_frames)
+        prev_features = FrameFeatures.from_frame(prev_frame, self.feature_cache.options)
 
+        while True:
+            with decode:
+                frame = next(alpha_frames, None)
+            if frame is None:
+                break
+            position += 1
+            with extract_features:
+                if position >= FIRST_SCORED_POSITION:
+                    # Features are computed once here and reused by set_keyframes
+                    features = self.feature_cache.add(frame)
+                else:
+                    features = FrameFeatures.from_frame(
+                        frame, self.feature_cache.options
+                    )
+            if position >= FIRST_SCORED_POSITION:
+                with difference:
+                    motion_diff = features.motion_difference(prev_features)
+                    color_diff = features.color_difference(prev_features)
+                self.add_scored_frame(motion_diff, color_diff, frame)
+
+            prev_features = features
+
+    def analyze_frames_parallel(self):
+        """Decode and score the alpha video in chunks across a process pool.
+
+        Each worker seeks to its own frame range (overlapping the previous range by
+        one frame) and the results are merged in order, so the frame objects and
+        differences are identical to analyze_frames_sequentially. Return False if a
+        range did not start on the frame the previous one ended on, which leaves the
+        analysis partly filled.
+        """
+        video_path = self.config.get("alpha_vid")
+        workers = pool_size(self.parameters.analysis_workers, self.max_workers)
+        chunk_size = self.parameters.analysis_chunk_size
+        video_capture = cv2.VideoCapture(video_path)
+        self.fps = video_capture.get(cv2.CAP_PROP_FPS)
         video_capture.release()
-        cv2.destroyAllWindows()
+        keyframes, frame_count = video_keyframes(video_path)
+
+        ranges = frame_ranges(frame_count, chunk_size)
+        with process_pool(workers) as pool:
+            results = pool.map(
+                partial(
+                    score_frame_range,
+                    video_path,
+                    plane_path=self.feature_cache.plane_path(),
+                    options=self.feature_cache.options,
+                    keep_frames=not self.is_streaming(),
+                    plane_width=self.feature_cache.plane_width,
+                    keyframes=keyframes,
+                ),
+                [start for start, _ in ranges],
+                [end for _, end in ranges],
+            )
+            position = FIRST_SCORED_POSITION
+            last_digest = None
+            for result in results:
+                if not result["motion_diffs"]:
+                    continue
+                if result["start"] != position:
+                    raise IOError(
+                        f"Analysis chunk starting at frame {result['start']} of "
+                        f"{video_path} does not follow frame {position - 1}"
+                    )
+                if last_digest is not None and result["first_digest"] != last_digest:
+                    pool.shutdown(cancel_futures=True)
+                    return False
+                last_digest = result["last_digest"]
+                for i in range(len(result["motion_diffs"])):
+                    self.feature_cache.append(
+                        FrameFeatures(
+                            result["planes"][i] if result["planes"] else None,
+                            result["histograms"][i],
+                            result["thumbnails"][i],
+                            result["rois"][i],
+                        ),
+                        written_plane_shape=(
+                            None if result["planes"] else result["plane_shape"]
+                        ),
+                        full_plane_shape=result["full_plane_shape"],
+                    )
+                    self.add_scored_frame(
+                        result["motion_diffs"][i],
+                        result["color_diffs"][i],
+                        result["frames"][i] if result["frames"] else None,
+                    )
+                    position += 1
+        return True
 
     def set_keyframes(self):
-        # Set first frame as keyframe
-        first_frame = self.frames[0]
-        first_frame.update(
-            {
-                "keyframe": True,
-                "keyframe_children_indices": [],
-                "keyframe_index": 0,
-            }
-        )
-        self.keyframes.append(first_frame)
-
-        for frame in self.frames[1:]:
-            prev_keyframe = self.keyframes[-1]
-            current_group_size = len(prev_keyframe["keyframe_children_indices"])
-
-            gray_frame = cv2.cvtColor(frame["cv2_frame_object"], cv2.COLOR_BGR2GRAY)
-            gray_prev_keyframe = cv2.cvtColor(
-                prev_keyframe["cv2_frame_object"], cv2.COLOR_BGR2GRAY
+        if self.is_proxy():
+            self.set_refined_keyframes()
+            return
+        if not self.feature_cache.is_reduced():
+            (
+                self.keyframe_indices,
+                self.keyframe_motion_diffs,
+                self.keyframe_color_diffs,
+            ) = select_keyframes(
+                self.feature_cache,
+                self.parameters.motion_weight,
+                self.parameters.color_weight,
+                self.combined_threshold,
+                self.parameters.max_keyframe_group_size,
             )
-            motion_diff = cv2.absdiff(gray_frame, gray_prev_keyframe).sum()
-            motion_diff = (
-                motion_diff * self.config.get("keyframe_determination")["motion_weight"]
+            return
+        # The stored planes are downscaled, so frames whose estimated difference is
+        # near the threshold are rescored on the analyzed planes, re-read from the
+        # video, which need no calibration
+        scorer = FullResolutionScorer(
+            self.config.get("alpha_vid"),
+            FeatureOptions.from_parameters(
+                self.parameters._replace(feature_thumbnail_width=None)
+            ),
+        )
+        refiner = ProxyRefiner(
+            scorer, self.parameters.motion_weight, self.parameters.color_weight
+        )
+        try:
+            (
+                self.keyframe_indices,
+                self.keyframe_motion_diffs,
+                self.keyframe_color_diffs,
+            ) = select_keyframes(
+                self.feature_cache,
+                self.parameters.motion_weight,
+                self.parameters.color_weight,
+                self.combined_threshold,
+                self.parameters.max_keyframe_group_size,
+                refine=refiner,
+                refine_margin=self.parameters.proxy_refine_margin,
             )
-            frame["keyframe_motion_diff"] = motion_diff
+        finally:
+            scorer.close()
+        self.log.write(
+            f"Feature planes stored at {self.feature_cache.plane_shape}, "
+            f"{len(refiner.refined)} of {self.get_frame_count()} frames rescored at "
+            "full resolution"
+        )
 
-            color_diff = self.calculate_color_difference(
-                frame["cv2_frame_object"], prev_keyframe["cv2_frame_object"]
+    def set_refined_keyframes(self):
+        """Select keyframes on the proxy features, rescoring the uncertain frames at
+        full resolution, and log how the refined selection compares with the
+        proxy-only one (and with a full resolution analysis, if proxy_report is
+        enabled)."""
+        proxy_indices = select_keyframes(
+            self.feature_cache,
+            self.parameters.motion_weight,
+            self.parameters.color_weight,
+            self.combined_threshold,
+            self.parameters.max_keyframe_group_size,
+        )[0]
+        # working_width would downscale the frames again
+        full_resolution_options = FeatureOptions.from_parameters(
+            self.parameters._replace(feature_thumbnail_width=None, working_width=None)
+        )
+        scorer = FullResolutionScorer(
+            self.config.get("alpha_vid"), full_resolution_options
+        )
+        refiner = ProxyRefiner(
+            scorer, self.parameters.motion_weight, self.parameters.color_weight
+        )
+        try:
+            refiner.calibrate(
+                self.raw_motion_diffs,
+                self.raw_color_diffs,
+                self.calculated_motion_threshold,
+                self.calculated_color_threshold,
             )
-            color_diff = (
-                color_diff * self.config.get("keyframe_determination")["color_weight"]
+            (
+                self.keyframe_indices,
+                self.keyframe_motion_diffs,
+                self.keyframe_color_diffs,
+            ) = select_keyframes(
+                self.feature_cache,
+                self.parameters.motion_weight,
+                self.parameters.color_weight,
+                self.combined_threshold,
+                self.parameters.max_keyframe_group_size,
+                refine=refiner,
+                refine_margin=self.parameters.proxy_refine_margin,
             )
-            frame["keyframe_color_diff"] = color_diff
-
-            frame["keyframe_combined_score"] = motion_diff + color_diff
-
-            if (
-                frame["keyframe_combined_score"] > self.combined_threshold
-                or current_group_size
-                > self.config.get("keyframe_determination")["max_keyframe_group_size"]
-            ):
-                frame["keyframe"] = True
-                frame["keyframe_children_indices"] = []
-                frame["keyframe_index"] = len(self.keyframes)
-                self.keyframes.append(frame)
-            else:
-                frame["keyframe"] = False
-                try:
-                    self.keyframes[-1]["keyframe_children_indices"].append(
-                        frame["frame_index_original"]
-                    )
-                except IndexError:
-                    print(
-                        "Frame "
-                        + str(frame["frame_index_original"])
-                        + " cannot be assigned a parent keyframe because there are no keyframes yet (i.e., this frame occurs before the first keyframe)."
+        finally:
+            scorer.close()
+
+        report = [
+            "Proxy analysis:",
+            f"proxy planes {self.feature_cache.plane_shape}, "
+            f"{len(refiner.refined)} of {self.get_frame_count()} frames rescored at "
+            "full resolution",
+            "full resolution calibration:",
+            pformat(refiner.calibration),
+            "refined selection compared with the selection on proxies alone:",
+            pformat(compare_selections(self.keyframe_indices, proxy_indices)),
+        ]
+        if self.parameters.proxy_report:
+            reference = KeyFrames(
+                self.config,
+                self.log,
+                parameters=self.parameters._replace(
+                    proxy_width=None, analysis_cache=False
+                ),
+            )
+            report += [
+                "refined selection compared with a full resolution analysis:",
+                pformat(
+                    compare_selections(
+                        reference.keyframe_indices, self.keyframe_indices
                     )
+                ),
+                "selection on proxies alone compared with a full resolution analysis:",
+                pformat(compare_selections(reference.keyframe_indices, proxy_indices)),
+            ]
+        self.log.write(report)
+
+    def build_frame_objects(self):
+        """Build the frame and keyframe dictionaries from the score arrays."""
+        video_path = self.config.get("alpha_vid")
+        self.frames = []
+        self.keyframes = []
+        starts, ends = self.get_group_boundaries()
+        for keyframe_index, (start, end) in enumerate(zip(starts, ends)):
+            for index in range(start, end):
+                cur_frame = {
+                    "frame_index_original": int(self.original_indices(index)),
+                    "frame_reader": LazyFrame(
+                        video_path, index + FIRST_SCORED_POSITION
+                    ),
+                }
+                if not self.is_streaming():
+                    cur_frame["cv2_frame_object"] = self.decoded_frames[index]
+                cur_frame["motion_diff"] = float(self.all_motion_diffs[index])
+                cur_frame["color_diff"] = float(self.all_color_diffs[index])
+                cur_frame["combined_score"] = (
+                    cur_frame["motion_diff"] + cur_frame["color_diff"]
+                )
+                if index > 0:
+                    motion_diff = float(self.keyframe_motion_diffs[index])
+                    color_diff = float(self.keyframe_color_diffs[index])
+                    cur_frame["keyframe_motion_diff"] = motion_diff
+                    cur_frame["keyframe_color_diff"] = color_diff
+                    cur_frame["keyframe_combined_score"] = motion_diff + color_diff
+                if index == start:
+                    cur_frame["keyframe"] = True
+                    cur_frame["keyframe_children_indices"] = self.original_indices(
+                        np.arange(start + 1, end)
+                    ).tolist()
+                    cur_frame["keyframe_index"] = keyframe_index
+                    self.keyframes.append(cur_frame)
+                else:
+                    cur_frame["keyframe"] = False
+                self.frames.append(cur_frame)
@@ -0,0 +1,133 @@
+import numpy as np
+
+
+# Number of frames compared against the current keyframe at once. Bounds the size of
+# the temporary arrays while keeping the comparisons vectorized.
+SELECTION_BLOCK_SIZE = 16
+
+
+def motion_differences(grays, keyframe_gray):
+    """Sum of absolute differences between each plane in grays and keyframe_gray.
+    Same values as FrameFeatures.motion_difference."""
+    difference = np.abs(grays.astype(np.int16) - keyframe_gray.astype(np.int16))
+    return difference.reshape(len(grays), -1).sum(axis=1, dtype=np.int64)
+
+
+def color_differences(histograms, keyframe_histogram):
+    """Chi-squared distance between each row of histograms and keyframe_histogram.
+    Same formula as FrameFeatures.color_difference (cv2.HISTCMP_CHISQR), which
+    divides by the bins of the first histogram and skips its empty bins."""
+    histograms = histograms.astype(np.float64)
+    difference = histograms - keyframe_histogram.astype(np.float64)
+    nonempty = np.abs(histograms) > np.finfo(np.float64).eps
+    terms = np.divide(
+        difference * difference,
+        histograms,
+        out=np.zeros_like(histograms),
+        where=nonempty,
+    )
+    return terms.sum(axis=1)
+
+
+def select_keyframes(
+    feature_cache,
+    motion_weight,
+    color_weight,
+    combined_threshold,
+    max_group_size,
+    block_size=SELECTION_BLOCK_SIZE,
+    refine=None,
+    refine_margin=0.0,
+):
+    """
+    Choose keyframes from the features of a FeatureCache.
+
+    The first frame is a keyframe. Each later frame is compared against the current
+    keyframe and becomes the next keyframe if its weighted combined difference is
+    greater than combined_threshold, or if the current group already has more than
+    max_group_size children.
+
+    Frames following a keyframe are compared in blocks of block_size, so each block
+    is a few array operations instead of a Python loop over frames, and the search
+    stops at the first block that contains the next keyframe.
+
+    Motion differences between the cached planes are scaled by the cache's
+    motion_scale, which is 1 unless the planes were stored downscaled.
+
+    If refine is given, frames whose combined difference is within refine_margin
+    (a fraction of combined_threshold) of the threshold are rescored with
+    refine(keyframe, indices), which returns their weighted motion and color
+    differences, before the decision is made. See ProxyRefiner.
+
+    Returns three arrays: the indices of the keyframes, and the weighted motion and
+    color differences between every frame and its keyframe (NaN for the first frame,
+    which has no keyframe before it).
+    """
+    frame_count = len(feature_cache)
+    histograms = np.stack(feature_cache.histograms).reshape(frame_count, -1)
+    keyframe_motion_diffs = np.full(frame_count, np.nan)
+    keyframe_color_diffs = np.full(frame_count, np.nan)
+    keyframe_indices = [0]
+    plane_motion_weight = motion_weight * feature_cache.motion_scale
+
+    keyframe = 0
+    # A frame this far after its keyframe is always a keyframe: the group has
+    # max_group_size + 1 children by then.
+    forced_distance = max_group_size + 2
+    while keyframe + 1 < frame_count:
+        keyframe_gray = np.array(feature_cache.gray(keyframe))
+        keyframe_histogram = histograms[keyframe]
+        next_keyframe = None
+        start = keyframe + 1
+        stop = min(keyframe + forced_distance, frame_count)
+        while start < stop and next_keyframe is None:
+            end = min(start + block_size, stop)
+            motion = plane_motion_weight * motion_differences(
+                feature_cache.grays(start, end), keyframe_gray
+            )
+            color = color_weight * color_differences(
+                histograms[start:end], keyframe_histogram
+            )
+            if refine is not None:
+                # Only uncertain frames before the first clear keyframe matter
+                combined = motion + color
+                band = refine_margin * abs(combined_threshold)
+                clear = np.flatnonzero(combined > combined_threshold + band)
+                limit = clear[0] if clear.size else len(combined)
+                uncertain = np.flatnonzero(
+                    np.abs(combined[:limit] - combined_threshold) <= band
+                )
+                if uncertain.size:
+                    motion[uncertain], color[uncertain] = refine(
+                        keyframe, start + uncertain
+                    )
+            keyframe_motion_diffs[start:end] = motion
+            keyframe_color_diffs[start:end] = color
+            exceeding = np.flatnonzero(motion + color > combined_threshold)
+            if exceeding.size:
+                next_keyframe = start + int(exceeding[0])
+            start = end
+        if next_keyframe is None:
+            if stop == frame_count:
+                break
+            # The forced keyframe is still compared against the current keyframe so
+            # its keyframe differences are recorded like every other frame's.
+            next_keyframe = stop
+            keyframe_motion_diffs[stop] = plane_motion_weight * motion_differences(
+                feature_cache.grays(stop, stop + 1), keyframe_gray
+            )[0]
+            keyframe_color_diffs[stop] = color_weight * color_differences(
+                histograms[stop : stop + 1], keyframe_histogram
+            )[0]
+        # Differences computed past the next keyframe in its block were measured
+        # against the wrong keyframe and are recomputed from the new one.
+        keyframe_motion_diffs[next_keyframe + 1 : start] = np.nan
+        keyframe_color_diffs[next_keyframe + 1 : start] = np.nan
+        keyframe_indices.append(next_keyframe)
+        keyframe = next_keyframe
+
+    return (
+        np.array(keyframe_indices, dtype=np.int64),
+        keyframe_motion_diffs,
+        keyframe_color_diffs,
+    )
@@ -0,0 +1,34 @@
+import cv2
+
+
+class LazyFrame:
+    """
+    Handle to a single frame of a video file on disk.
+
+    The pixel buffer is not held in memory. It is decoded from the video each time
+    read() is called, so frame objects can reference any frame of a long clip without
+    keeping the decoded frames around.
+
+    Attributes:
+        video_path (str): Path to the video the frame belongs to.
+        position (int): Zero-based position of the frame in the decoded video stream.
+    """
+
+    def __init__(self, video_path, position):
+        self.video_path = video_path
+        self.position = position
+
+    def read(self):
+        """Decode the frame from disk and return it as a BGR array."""
+        video_capture = cv2.VideoCapture(self.video_path)
+        video_capture.set(cv2.CAP_PROP_POS_FRAMES, self.position)
+        ret, frame = video_capture.read()
+        video_capture.release()
+        if not ret:
+            raise IOError(
+                f"Could not read frame {self.position} from {self.video_path}"
+            )
+        return frame
+
+    def __repr__(self):
+        return f"LazyFrame({self.video_path!r}, {self.position})"
@@ -0,0 +1,160 @@
+import bisect
+import hashlib
+import cv2
+from frame_analysis.frame_features import FrameFeatures, FeatureCache
+
+
+# The first scored frame is at position 2 of the alpha video. Position 0 is only read
+# as the previous frame of position 1, and position 1 is only read as the previous
+# frame of position 2 (see KeyFrames.analyze_frames).
+FIRST_SCORED_POSITION = 2
+
+
+def video_keyframes(video_path):
+    """
+    Return the positions of the keyframes of a video and its frame count, read from
+    the demuxed packets without decoding them.
+
+    If the backend cannot return raw packets, the first frame is the only known
+    keyframe and the count is the container's estimate.
+    """
+    video_capture = cv2.VideoCapture(video_path)
+    try:
+        if not video_capture.set(cv2.CAP_PROP_FORMAT, -1):
+            return [0], int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        keyframes = []
+        frame_count = 0
+        while video_capture.grab():
+            if video_capture.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+                keyframes.append(frame_count)
+            frame_count += 1
+    finally:
+        video_capture.release()
+    if not keyframes or keyframes[0] != 0:
+        keyframes.insert(0, 0)
+    return keyframes, frame_count
+
+
+def seek(video_capture, position, keyframes):
+    """Move a capture to position: seek to the last keyframe at or before it, where
+    decoding starts exactly, and grab() the frames in between. Seeking to other
+    frames is not frame accurate on long-GOP video. Return False if the video ends
+    first."""
+    keyframe = keyframes[bisect.bisect_right(keyframes, position) - 1]
+    if keyframe > 0 or video_capture.get(cv2.CAP_PROP_POS_FRAMES) > 0:
+        video_capture.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+    for _ in range(position - keyframe):
+        if not video_capture.grab():
+            return False
+    return True
+
+
+def frame_digest(frame):
+    """Return a short digest of a decoded frame's pixels."""
+    return hashlib.blake2b(frame.tobytes(), digest_size=16).hexdigest()
+
+
+def frame_ranges(frame_count, chunk_size):
+    """
+    Split the scored positions of a video into (start, end) ranges of chunk_size
+    frames.
+
+    The ranges are contiguous and never overlap, so no frame is scored twice. The
+    last range is open ended (end is None) and reads until the decoder runs out of
+    frames, so a frame_count below the real count does not drop frames. Ranges
+    starting past the real end are empty.
+    """
+    starts = list(range(FIRST_SCORED_POSITION, max(frame_count, 3), chunk_size))
+    ends = starts[1:] + [None]
+    return list(zip(starts, ends))
+
+
+def score_frame_range(
+    video_path,
+    start,
+    end,
+    plane_path=None,
+    options=None,
+    keep_frames=False,
+    plane_width=None,
+    keyframes=(0,),
+):
+    """
+    Decode the frames at positions start..end-1 of the video and score each against
+    the frame before it. Runs in an analysis worker process.
+
+    The decoder is moved to start - 1 with seek, given the video's keyframes, so
+    consecutive ranges overlap by one frame and the differences at range boundaries
+    match a single sequential pass. The digests of the overlapping first frame and
+    of the last frame are returned, so the caller can check that each range starts
+    on the frame the previous one ended on.
+
+    If plane_path is given, grayscale planes are written straight into that feature
+    cache file at their final slot. Otherwise they are returned with the results.
+    Either way they are first reduced to plane_width (see FeatureCache).
+
+    Returns a dict with the unweighted motion and color differences, the histograms,
+    thumbnails, regions of interest and (optionally) planes and decoded frames of the
+    range, in order, the shapes of the stored and of the full grayscale planes, and
+    the digests of the frames at start - 1 ("first_digest") and at the end of the
+    range ("last_digest").
+    """
+    cv2.setNumThreads(1)
+    result = {
+        "start": start,
+        "plane_shape": None,
+        "full_plane_shape": None,
+        "motion_diffs": [],
+        "color_diffs": [],
+        "histograms": [],
+        "thumbnails": [],
+        "rois": [],
+        "planes": [],
+        "frames": [],
+        "first_digest": None,
+        "last_digest": None,
+    }
+    video_capture = cv2.VideoCapture(video_path)
+    ret = seek(video_capture, start - 1, keyframes)
+    if ret:
+        ret, prev_frame = video_capture.read()
+    if not ret:
+        video_capture.release()
+        return result
+    result["first_digest"] = frame_digest(prev_frame)
+    prev_features = FrameFeatures.from_frame(prev_frame, options)
+    plane_file = open(plane_path, "r+b") if plane_path else None
+
+    try:
+        position = start
+        while end is None or position < end:
+            ret, frame = video_capture.read()
+            if not ret:
+                break
+            features = FrameFeatures.from_frame(frame, options)
+            stored = features.reduced(plane_width)
+            result["plane_shape"] = stored.gray.shape
+            result["full_plane_shape"] = features.gray.shape
+            result["motion_diffs"].append(features.motion_difference(prev_features))
+            result["color_diffs"].append(features.color_difference(prev_features))
+            result["histograms"].append(features.histogram)
+            result["thumbnails"].append(features.thumbnail)
+            result["rois"].append(stored.roi)
+            if plane_file is None:
+                result["planes"].append(stored.gray)
+            else:
+                FeatureCache.write_plane(
+                    plane_file, position - FIRST_SCORED_POSITION, stored.gray
+                )
+            if keep_frames:
+                result["frames"].append(frame)
+            prev_features = features
+            prev_frame = frame
+            position += 1
+        result["last_digest"] = frame_digest(prev_frame)
+    finally:
+        video_capture.release()
+        if plane_file is not None:
+            plane_file.close()
+
+    return result
@@ -0,0 +1,293 @@
+import shutil
+import subprocess
+import cv2
+import numpy as np
+from frame_analysis.frame_features import FrameFeatures
+from frame_analysis.parallel_analysis import (
+    FIRST_SCORED_POSITION,
+    seek,
+    video_keyframes,
+)
+
+# Pairs of consecutive frames scored at full resolution to calibrate the proxy
+# differences, spread evenly over the clip
+CALIBRATION_PAIRS = 32
+CALIBRATION_MINIMUM_PAIRS = 4
+
+
+def proxy_size(width, height, proxy_width):
+    """Return the (width, height) of the proxy of a width x height frame, or the
+    frame's own size if it is not wider than proxy_width. Heights are kept even, as
+    ffmpeg's scaler requires for most pixel formats."""
+    if width <= proxy_width:
+        return width, height
+    proxy_height = max(2, round(height * proxy_width / width / 2) * 2)
+    return proxy_width, proxy_height
+
+
+def resize_to_proxies(frames, proxy_width):
+    """Yield downscaled copies of already decoded BGR frames."""
+    for frame in frames:
+        size = proxy_size(frame.shape[1], frame.shape[0], proxy_width)
+        if size == (frame.shape[1], frame.shape[0]):
+            yield frame
+        else:
+            yield cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def read_proxy_frames(video_path, proxy_width):
+    """
+    Yield every frame of a video downscaled to proxy_width, as BGR arrays.
+
+    If ffmpeg is installed, it decodes and scales the video (on several threads,
+    with its area scaler) and pipes the small frames as raw video, so full
+    resolution frames are never converted or copied into Python. Otherwise frames
+    are decoded with OpenCV and resized with INTER_AREA.
+    """
+    video_capture = cv2.VideoCapture(video_path)
+    width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if shutil.which("ffmpeg") is None:
+        try:
+            while True:
+                ret, frame = video_capture.read()
+                if not ret:
+                    return
+                yield from resize_to_proxies([frame], proxy_width)
+        finally:
+            video_capture.release()
+    video_capture.release()
+
+    proxy_width, proxy_height = proxy_size(width, height, proxy_width)
+    command = [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-i",
+        video_path,
+        # Raw video output has no timestamps, so ffmpeg passes every decoded frame
+        # through, as OpenCV reads them
+        "-vf",
+        f"scale={proxy_width}:{proxy_height}:flags=area",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "bgr24",
+        "-",
+    ]
+    frame_size = proxy_width * proxy_height * 3
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            yield np.frombuffer(data, dtype=np.uint8).reshape(
+                proxy_height, proxy_width, 3
+            )
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+class FullResolutionScorer:
+    """
+    Scores selected frames of the alpha video at full resolution, for refining a
+    keyframe selection made on proxies.
+
+    Frames are addressed by their index in the analysis arrays. They are decoded in
+    increasing order where possible (skipping short gaps with grab() and long ones by
+    seeking to the last keyframe before the frame, see seek). Only the features of the current
+    keyframe are kept, since it is compared against many frames; full resolution
+    planes are large.
+
+    Attributes:
+        video_path (str): Path of the alpha video.
+        options (FeatureOptions): Feature options of the full resolution analysis.
+        plane_area (int): Area of the full resolution grayscale planes, once a frame
+            was scored.
+    """
+
+    SEEK_DISTANCE = 120
+
+    def __init__(self, video_path, options):
+        self.video_path = video_path
+        self.options = options
+        self.plane_area = None
+        self.keyframe = None
+        self.keyframe_features = None
+        self.keyframes = None
+        self.video_capture = cv2.VideoCapture(video_path)
+        self.position = 0
+
+    def frame_features(self, index):
+        target = index + FIRST_SCORED_POSITION
+        if target < self.position or target - self.position > self.SEEK_DISTANCE:
+            if self.keyframes is None:
+                self.keyframes = video_keyframes(self.video_path)[0]
+            if not seek(self.video_capture, target, self.keyframes):
+                raise IOError(f"Could not seek to frame {target} of {self.video_path}")
+            self.position = target
+        while self.position < target and self.video_capture.grab():
+            self.position += 1
+        ret, frame = self.video_capture.read()
+        if not ret:
+            raise IOError(f"Could not read frame {target} from {self.video_path}")
+        self.position += 1
+        features = FrameFeatures.from_frame(frame, self.options)
+        self.plane_area = features.gray.shape[0] * features.gray.shape[1]
+        return features
+
+    def differences(self, keyframe, indices):
+        """Return the unweighted motion and color differences between each frame in
+        indices (increasing, after keyframe) and the keyframe, at full resolution."""
+        if self.keyframe != keyframe:
+            self.keyframe_features = self.frame_features(keyframe)
+            self.keyframe = keyframe
+        motion = np.empty(len(indices))
+        color = np.empty(len(indices))
+        for i, index in enumerate(indices):
+            features = self.frame_features(int(index))
+            motion[i] = features.motion_difference(self.keyframe_features)
+            color[i] = features.color_difference(self.keyframe_features)
+        return motion, color
+
+    def close(self):
+        self.video_capture.release()
+        self.keyframe_features = None
+
+
+def calibration_ratio(proxy_diffs, sample, full_sample, full_minimum):
+    """Return the ratio of the full resolution to the proxy range (mean minus
+    minimum) of one channel's differences, given the proxy differences, the
+    indices of the sample, its full resolution differences and the lowest
+    rescored one."""
+    proxy_range = float(np.mean(proxy_diffs[sample]) - np.min(proxy_diffs))
+    full_range = float(np.mean(full_sample) - full_minimum)
+    if proxy_range > 0 and full_range > 0:
+        return full_range / proxy_range
+    return 1.0
+
+
+class ProxyRefiner:
+    """
+    Refine callback for select_keyframes: rescores frames at full resolution and
+    returns their weighted differences in proxy scale.
+
+    Both differences are sums over pixels (the motion difference directly, the
+    chi-squared color distance through the histogram counts), so they grow with the
+    plane, but not in proportion to its area: downscaling averages fine texture
+    away, so textured frames differ less on proxies than the area ratio predicts,
+    and the color distance barely depends on the area. The threshold is a multiple
+    of the mean minus the minimum difference of consecutive frames, so calibrate
+    rescores CALIBRATION_PAIRS pairs of them, spread evenly over the clip, and the
+    CALIBRATION_MINIMUM_PAIRS pairs with the lowest proxy differences, and measures
+    the ratio of that range at full resolution to the proxy one, for motion and
+    color separately. Scaling each channel's proxy threshold by its ratio gives
+    the threshold a full resolution analysis would compute.
+    Rescored differences are multiplied by the proxy threshold over the full
+    resolution one, so comparing them with the proxy threshold makes the decision
+    a full resolution analysis would make.
+
+    Attributes:
+        scorer (FullResolutionScorer): Scores the frames at full resolution.
+        refined (set): Indices of every frame rescored.
+        calibration (dict): The measured ratios and both thresholds, once
+            calibrated.
+    """
+
+    def __init__(self, scorer, motion_weight, color_weight):
+        self.scorer = scorer
+        self.motion_weight = motion_weight
+        self.color_weight = color_weight
+        self.scale = 1.0
+        self.refined = set()
+        self.calibration = None
+
+    def calibrate(
+        self, raw_motion_diffs, raw_color_diffs, motion_threshold, color_threshold
+    ):
+        """Rescore pairs of consecutive frames, given the proxy differences of every
+        frame to the one before it and the proxy's motion and color thresholds,
+        and set the scale of rescored differences."""
+        count = len(raw_motion_diffs)
+        sample = np.unique(
+            np.linspace(0, count - 1, min(count, CALIBRATION_PAIRS)).round()
+        ).astype(int)
+        # The lowest differences too, as the threshold depends on the minimum
+        lowest = [
+            np.argsort(diffs, kind="stable")[:CALIBRATION_MINIMUM_PAIRS]
+            for diffs in (raw_motion_diffs, raw_color_diffs)
+        ]
+        indices = np.unique(np.concatenate([sample, *lowest]))
+        full_motion = np.empty(count)
+        full_color = np.empty(count)
+        for index in indices:
+            # Analysis index -1 is the frame before the first scored one
+            motion, color = self.scorer.differences(int(index) - 1, [int(index)])
+            full_motion[index] = motion[0]
+            full_color[index] = color[0]
+        motion_ratio = calibration_ratio(
+            raw_motion_diffs, sample, full_motion[sample], full_motion[indices].min()
+        )
+        color_ratio = calibration_ratio(
+            raw_color_diffs, sample, full_color[sample], full_color[indices].min()
+        )
+        proxy_threshold = motion_threshold + color_threshold
+        full_threshold = motion_ratio * motion_threshold + color_ratio * color_threshold
+        if proxy_threshold and full_threshold:
+            self.scale = full_threshold / proxy_threshold
+        self.calibration = {
+            "pairs": len(indices),
+            "motion ratio": motion_ratio,
+            "color ratio": color_ratio,
+            "proxy threshold": proxy_threshold,
+            "full resolution threshold": full_threshold,
+        }
+
+    def __call__(self, keyframe, indices):
+        motion, color = self.scorer.differences(keyframe, indices)
+        self.refined.update(int(index) for index in indices)
+        return (
+            self.motion_weight * motion / self.scale,
+            self.color_weight * color / self.scale,
+        )
+
+
+def compare_selections(reference, other, tolerance=2):
+    """
+    Compare two keyframe selections (arrays of frame indices).
+
+    A keyframe of other matches if reference has a keyframe at most tolerance frames
+    away. Returns the keyframe counts, the fraction of each selection matched by the
+    other, the indices only in each and the mean distance of matched keyframes.
+    """
+    reference = np.asarray(reference)
+    other = np.asarray(other)
+
+    def nearest_distances(keyframes, candidates):
+        if not len(candidates):
+            return np.full(len(keyframes), np.inf)
+        positions = np.searchsorted(candidates, keyframes)
+        before = candidates[np.maximum(positions - 1, 0)]
+        after = candidates[np.minimum(positions, len(candidates) - 1)]
+        return np.minimum(np.abs(keyframes - before), np.abs(keyframes - after))
+
+    other_distances = nearest_distances(other, reference)
+    reference_distances = nearest_distances(reference, other)
+    matched = other_distances <= tolerance
+    return {
+        "reference keyframes": len(reference),
+        "keyframes": len(other),
+        "matched within tolerance": float(matched.mean()) if len(other) else 1.0,
+        "reference keyframes found": float((reference_distances <= tolerance).mean())
+        if len(reference)
+        else 1.0,
+        "tolerance (frames)": tolerance,
+        "mean distance of matches": float(other_distances[matched].mean())
+        if matched.any()
+        else None,
+        "only in reference": reference[reference_distances > tolerance].tolist(),
+        "only in this selection": other[~matched].tolist(),
+    }
@@ -0,0 +1,470 @@
+import bisect
+import json
+import os
+from concurrent.futures import as_completed
+from typing import NamedTuple, Optional
+import cv2
+import numpy as np
+from project_manager.frame_extractor import (
+    frame_extension,
+    link_or_copy,
+    read_frame,
+    write_frame,
+)
+from project_manager.frame_store import (
+    FrameStore,
+    is_store_frame_path,
+    store_frame_path,
+    store_path,
+)
+from project_manager.process_pool import pool_size, process_pool
+
+# Dense optical flow methods of OpenCV. "auto" picks DIS, the faster of the two.
+FLOW_MODELS = ("farneback", "dis")
+
+# Frame positions closer than this to a frame number are that frame
+POSITION_TOLERANCE = 1e-6
+
+
+def model_name(model):
+    if model == "auto":
+        return "dis"
+    if model not in FLOW_MODELS:
+        raise ValueError(
+            f"Unknown frame interpolation model {model!r}, expected one of "
+            f"{('auto',) + FLOW_MODELS}"
+        )
+    return model
+
+
+def interpolation_pairs(numbers, ratio):
+    """
+    Return the frames of a sequence of frame numbers, which may have gaps, resampled
+    to ratio times as many frames per second.
+
+    Output frame k (1-based) lies at position numbers[0] + (k - 1) / ratio of the
+    input. The outputs are grouped by the pair of existing frames they lie
+    between: [(previous number, next number, [(output number, t), ...]), ...], t
+    being the position between the two, from 0 (the previous frame itself) to 1.
+    The last frame's pair has no next number.
+    """
+    first, last = numbers[0], numbers[-1]
+    count = int((last - first) * ratio + POSITION_TOLERANCE) + 1
+    pairs = []
+    for output_number in range(1, count + 1):
+        position = first + (output_number - 1) / ratio
+        i = bisect.bisect_right(numbers, position + POSITION_TOLERANCE) - 1
+        previous = numbers[i]
+        following = numbers[i + 1] if i + 1 < len(numbers) else None
+        if position - previous < POSITION_TOLERANCE:
+            t = 0.0
+        else:
+            t = (position - previous) / (following - previous)
+        if pairs and pairs[-1][0] == previous:
+            pairs[-1][2].append((output_number, t))
+        else:
+            pairs.append((previous, following, [(output_number, t)]))
+    return pairs
+
+
+def flow_size(width, height, flow_width):
+    """Return the (width, height) flow is computed at."""
+    if not flow_width or flow_width >= width:
+        return width, height
+    return flow_width, max(1, round(height * flow_width / width))
+
+
+def flow_plane(frame, size):
+    """Return the downscaled grayscale plane of a BGR (or BGRA) frame that flow is
+    computed on."""
+    frame = np.ascontiguousarray(frame[:, :, :3])
+    if size != (frame.shape[1], frame.shape[0]):
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def compute_flow(first, second, model):
+    """Return the dense flow from grayscale plane first to second, (height, width,
+    2) float32 pixel offsets."""
+    if model == "dis":
+        dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
+        return dis.calc(first, second, None)
+    return cv2.calcOpticalFlowFarneback(first, second, None, 0.5, 4, 21, 3, 7, 1.5, 0)
+
+
+def intermediate_flows(forward, backward, t):
+    """Return the flows from the frame at t back to the previous and on to the next
+    frame, approximated from the forward and backward flows between the two, as in
+    Super SloMo (Jiang et al., 2018)."""
+    to_previous = -t * (1 - t) * forward + t * t * backward
+    to_next = (1 - t) * (1 - t) * forward - t * (1 - t) * backward
+    return to_previous, to_next
+
+
+def upsample_flow(flow, width, height):
+    """Resize a flow field to (width, height), scaling its offsets with it."""
+    if flow.shape[:2] == (height, width):
+        return flow
+    upsampled = cv2.resize(flow, (width, height), interpolation=cv2.INTER_LINEAR)
+    upsampled[:, :, 0] *= width / flow.shape[1]
+    upsampled[:, :, 1] *= height / flow.shape[0]
+    return upsampled
+
+
+def pixel_grid(width, height):
+    """Return the (x, y) coordinates of every pixel, as a cv2.remap map."""
+    x, y = np.meshgrid(
+        np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32)
+    )
+    return np.dstack((x, y))
+
+
+def warp(frame, flow, grid):
+    """Sample frame at each pixel's position plus its flow."""
+    return cv2.remap(
+        frame, grid + flow, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE
+    )
+
+
+def interpolate_frame(previous, following, forward, backward, t, grid):
+    """Return the frame at t between two full-resolution frames, given the forward
+    and backward flows between them at flow resolution."""
+    height, width = previous.shape[:2]
+    to_previous, to_next = intermediate_flows(forward, backward, t)
+    return cv2.addWeighted(
+        warp(previous, upsample_flow(to_previous, width, height), grid),
+        1 - t,
+        warp(following, upsample_flow(to_next, width, height), grid),
+        t,
+        0,
+    )
+
+
+class FlowCache:
+    """
+    Forward and backward flow fields of frame pairs, one npz file per pair in a
+    folder. A pair's flows are stored with a key (the flow options and both frames'
+    frame index entries) and reused while the key matches. Flows are stored as
+    float16, at flow resolution.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, pair):
+        return f"{self.folder}/{pair[0]}-{pair[1]}.npz"
+
+    def load(self, pair, key):
+        """Return the (forward, backward) flows of a pair, or None if they are not
+        cached under key."""
+        path = self.path(pair)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as cached:
+                if str(cached["key"]) != key:
+                    return None
+                return (
+                    cached["forward"].astype(np.float32),
+                    cached["backward"].astype(np.float32),
+                )
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, pair, key, forward, backward):
+        path = self.path(pair)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as cache_file:
+            np.savez(
+                cache_file,
+                key=np.array(key),
+                forward=forward.astype(np.float16),
+                backward=backward.astype(np.float16),
+            )
+        os.replace(temporary_path, path)
+
+    def prune(self, pairs):
+        """Delete the cached flows of pairs not in pairs."""
+        if not os.path.isdir(self.folder):
+            return
+        keep = {os.path.basename(self.path(pair)) for pair in pairs}
+        for name in os.listdir(self.folder):
+            if name not in keep:
+                os.remove(f"{self.folder}/{name}")
+
+
+class InterpolationOptions(NamedTuple):
+    """What an interpolation worker needs besides its frames."""
+
+    model: str
+    flow_width: Optional[int]
+    frame_format: str
+    cache_folder: Optional[str]
+
+
+def decoded_frame(decoded, path):
+    """Return the frame at path from decoded, decoding it first if needed."""
+    if path not in decoded:
+        decoded[path] = np.asarray(read_frame(path))
+    return decoded[path]
+
+
+def copy_frame(source, target, decoded, frame_format):
+    """Hardlink source to target if both are files of the same format, or write its
+    frame to target otherwise."""
+    if (
+        not is_store_frame_path(source)
+        and not is_store_frame_path(target)
+        and os.path.splitext(source)[1] == os.path.splitext(target)[1]
+    ):
+        link_or_copy(source, target)
+    else:
+        write_frame(target, decoded_frame(decoded, source), frame_format)
+
+
+def pair_flows(previous, following, numbers, key, options, cache):
+    """Return the forward and backward flows between two frames, from the cache if
+    they are in it."""
+    flows = cache.load(numbers, key) if cache is not None else None
+    if flows is not None:
+        return flows
+    size = flow_size(previous.shape[1], previous.shape[0], options.flow_width)
+    previous_plane = flow_plane(previous, size)
+    next_plane = flow_plane(following, size)
+    flows = (
+        compute_flow(previous_plane, next_plane, options.model),
+        compute_flow(next_plane, previous_plane, options.model),
+    )
+    if cache is not None:
+        cache.save(numbers, key, *flows)
+    return flows
+
+
+def interpolate_chunk(pairs, options):
+    """
+    Write the output frames of consecutive pairs in the worker process. pairs are
+    (previous path, next path, pair numbers, cache key, [(output path, t), ...]).
+    Return the number of frames written.
+
+    Frames are decoded as they are needed and only the current pair is held, so the
+    next frame of one pair is reused as the previous frame of the next. Flows are
+    only computed for pairs with outputs between their frames.
+    """
+    cv2.setNumThreads(1)
+    cache = FlowCache(options.cache_folder) if options.cache_folder else None
+    decoded = {}
+    grid = None
+    written = 0
+    for previous_path, next_path, numbers, key, outputs in pairs:
+        decoded = {
+            path: decoded[path]
+            for path in (previous_path, next_path)
+            if path in decoded
+        }
+        flows = None
+        for output_path, t in outputs:
+            if not t:
+                copy_frame(previous_path, output_path, decoded, options.frame_format)
+                written += 1
+                continue
+            previous = decoded_frame(decoded, previous_path)
+            following = decoded_frame(decoded, next_path)
+            if flows is None:
+                flows = pair_flows(previous, following, numbers, key, options, cache)
+            height, width = previous.shape[:2]
+            if grid is None or grid.shape[:2] != (height, width):
+                grid = pixel_grid(width, height)
+            write_frame(
+                output_path,
+                interpolate_frame(previous, following, *flows, t, grid),
+                options.frame_format,
+            )
+            written += 1
+    return written
+
+
+class FrameInterpolator:
+    """
+    Interpolates the composites into the frames_composite_interpolated folder, with
+    the options of upscaling.video.frame_interpolation: it fills the gaps left by
+    keyframe groups deleted by validation and, with fps_increase, raises the frame
+    rate, so the stitch plays fps + fps_increase frames per second over the same
+    duration. Output frames are numbered without gaps, and frames that fall on a
+    composite are hardlinks to it (or copies).
+
+    An in-between frame is made from the dense optical flow between the composites
+    around it (model: "farneback" or "dis", OpenCV's CPU methods). Flow is computed
+    forwards and backwards on grayscale planes downscaled to flow_width, then, for
+    each output, the flows from its position to both composites are approximated
+    from them, upsampled, and both composites are warped to the output's position
+    at full resolution with cv2.remap and blended by their distance to it.
+
+    Pairs of composites are spread across a process pool of workers (one per CPU if
+    null, and no more than max_workers, e.g., the CPUs a batch gives each stage),
+    in chunks of about chunk_size output frames that are never split inside a
+    pair, so the in-between frames of a gap, or of consecutive composites, are
+    made by one worker that decodes each composite once (see interpolate_chunk).
+    With flow_cache, each pair's flows are kept in flow-cache/ in the project
+    folder and reused while both composites are unchanged, e.g., when only
+    fps_increase changes or other groups are recomposited.
+
+    Frames before the first composite and after the last one cannot be
+    interpolated, so a deleted first or last group shortens the output.
+    """
+
+    def __init__(self, config, log, frame_index, max_workers=None):
+        self.config = config
+        self.log = log
+        self.frame_index = frame_index
+        self.max_workers = max_workers
+
+    def options(self):
+        return self.config.get("upscaling")["video"]["frame_interpolation"]
+
+    def input_folder(self):
+        scale = (
+            "upscaled"
+            if self.config.get("upscaling")["output_composite"]["enabled"]
+            else "raw"
+        )
+        return self.config.get("directories")[f"frames_composite_all_{scale}"]
+
+    def output_folder(self):
+        return self.config.get("directories")["frames_composite_interpolated"]
+
+    def cache_folder(self):
+        return (
+            self.config.get("projects_folder")
+            + "/"
+            + self.config.get("project_name")
+            + "/flow-cache"
+        )
+
+    def input_fingerprint(self):
+        """Return a hash of the composites' frame index entries, which changes when
+        any composite is written or deleted."""
+        return self.frame_index.fingerprint(self.input_folder())
+
+    def clear_output(self):
+        """Delete the frames of an earlier run, whose numbering may differ."""
+        folder = self.output_folder()
+        for path in self.frame_index.frame_paths(folder):
+            if not is_store_frame_path(path) and os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(store_path(folder)):
+            os.remove(store_path(folder))
+        self.frame_index.reset(folder)
+
+    def pair_tasks(self, pairs):
+        """Return the worker tasks (see interpolate_chunk) of interpolation_pairs."""
+        options = self.options()
+        model = model_name(options["model"])
+        input_folder = self.input_folder()
+        output_folder = self.output_folder()
+        entries = self.frame_index.frames(input_folder)
+        use_store = self.config.get("frame_extraction")["format"] == "store"
+        tasks = []
+        for previous, following, outputs in pairs:
+            key = json.dumps(
+                [
+                    model,
+                    options["flow_width"],
+                    entries[str(previous)],
+                    entries[str(following)] if following is not None else None,
+                ]
+            )
+            output_paths = [
+                (
+                    store_frame_path(output_folder, number)
+                    if use_store
+                    else f"{output_folder}/{number}{frame_extension(self.config)}",
+                    t,
+                )
+                for number, t in outputs
+            ]
+            tasks.append(
+                (
+                    self.frame_index.frame_path(input_folder, previous),
+                    None
+                    if following is None
+                    else self.frame_index.frame_path(input_folder, following),
+                    (previous, following),
+                    key,
+                    output_paths,
+                )
+            )
+        return tasks
+
+    def interpolate(self, fps):
+        """Interpolate the composites, played at fps, to fps + fps_increase. Return
+        the number of frames written."""
+        options = self.options()
+        input_folder = self.input_folder()
+        numbers = self.frame_index.numbers(input_folder)
+        if not numbers:
+            self.log.warning(f"Frame interpolation: no frames in {input_folder}")
+            return 0
+        ratio = (fps + options["fps_increase"]) / fps
+        pairs = interpolation_pairs(numbers, ratio)
+        gaps = sum(
+            1
+            for previous, following, _ in pairs
+            if following is not None and following > previous + 1
+        )
+        tasks = self.pair_tasks(pairs)
+
+        self.clear_output()
+        os.makedirs(self.output_folder(), exist_ok=True)
+        output_count = pairs[-1][2][-1][0]
+        frame_format = self.config.get("frame_extraction")["format"]
+        if frame_format == "store":
+            first = read_frame(tasks[0][0])
+            FrameStore.create(
+                store_path(self.output_folder()), first.shape, output_count
+            ).close()
+        cache_folder = None
+        if options["flow_cache"]:
+            cache_folder = self.cache_folder()
+            os.makedirs(cache_folder, exist_ok=True)
+            FlowCache(cache_folder).prune(
+                [task[2] for task in tasks if task[2][1] is not None]
+            )
+        self.log.write(
+            f"Frame interpolation: {len(numbers)} composites with {gaps} gaps to "
+            f"{output_count} frames ({fps} to {fps + options['fps_increase']} fps)"
+        )
+        worker_options = InterpolationOptions(
+            model_name(options["model"]),
+            options["flow_width"],
+            frame_format,
+            cache_folder,
+        )
+        try:
+            return self.run(tasks, worker_options)
+        finally:
+            self.frame_index.save()
+
+    def run(self, tasks, worker_options):
+        chunk_size = self.options()["chunk_size"]
+        chunks = [[]]
+        outputs = 0
+        for task in tasks:
+            if outputs >= chunk_size:
+                chunks.append([])
+                outputs = 0
+            chunks[-1].append(task)
+            outputs += len(task[4])
+
+        workers = pool_size(self.options()["workers"], self.max_workers)
+        written = 0
+        with process_pool(workers) as pool:
+            futures = {
+                pool.submit(interpolate_chunk, chunk, worker_options): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                written += future.result()
+                for task in futures[future]:
+                    for output_path, _ in task[4]:
+                        self.frame_index.record(output_path)
+        return written
@@ -0,0 +1,197 @@
+import json
+import os
+import cv2
+import numpy as np
+from frame_analysis.frame_features import FeatureOptions, FrameFeatures
+from image_compositing.image_layer_blender import Blender
+from project_manager.frame_extractor import read_frame
+from project_manager.frame_store import is_store_frame_path
+from project_manager.process_pool import pool_size, process_pool
+
+
+def nan_statistic(function, values):
+    """Apply function to the values that are not NaN, or return 0.0 if none are."""
+    values = values[~np.isnan(values)]
+    return float(function(values)) if values.size else 0.0
+
+
+def score_composites(frame_paths, previous_path, options):
+    """
+    Decode a keyframe group's composites in order and return the unweighted motion
+    and color differences of each against the composite before it. Runs in a
+    validation worker process. The first composite is compared with previous_path,
+    the last composite of the group before, or gets NaN if there is none.
+    """
+    cv2.setNumThreads(1)
+    motion = np.full(len(frame_paths), np.nan)
+    color = np.full(len(frame_paths), np.nan)
+    previous = None
+    if previous_path is not None:
+        previous = FrameFeatures.from_frame(
+            read_frame(previous_path)[:, :, :3], options
+        )
+    for i, path in enumerate(frame_paths):
+        features = FrameFeatures.from_frame(read_frame(path)[:, :, :3], options)
+        if previous is not None:
+            motion[i] = features.motion_difference(previous)
+            color[i] = features.color_difference(previous)
+        previous = features
+    return motion, color
+
+
+class CompositeValidator:
+    """
+    Checks the composites against the original clip, group by group, to find the
+    keyframe groups whose alpha layer does not follow the subject (a bad diffusion
+    result or an oversized group).
+
+    The composites in frames_composite_all_raw are scored like the alpha video:
+    the weighted motion plus color difference of each composite to the one before
+    it. The original differences are the ones already held by the KeyFrames (loaded
+    from the analysis cache when unchanged), so the alpha video is not analyzed
+    again. Each series is divided by its mean, since the composites include the
+    background and may differ in resolution, and a frame's deviation is the
+    absolute difference of the two normalized series.
+
+    Groups are decoded and scored in parallel on validation.workers processes (one
+    per CPU if null, and no more than max_workers), each reading its composites
+    once, in order. A group's deviation is the mean deviation of its frames, the
+    first of which is compared with the last composite of the group before, so pops
+    at group boundaries count. Groups are ranked by deviation and those above
+    validation.flag_threshold are flagged. The report is written to
+    validation-report.json in the project folder. With validation.delete_flagged,
+    the composites of flagged groups are deleted (and forgotten by the frame index),
+    so the stitch skips them, as dropped frames look better than a jarring change of
+    the subject; the next blend recomposites them, e.g., once their alpha layers are
+    redone.
+    """
+
+    def __init__(self, config, log, frames, frame_index, max_workers=None):
+        self.config = config
+        self.log = log
+        self.frames = frames
+        self.frame_index = frame_index
+        self.max_workers = max_workers
+
+    def report_path(self):
+        return (
+            self.config.get("projects_folder")
+            + "/"
+            + self.config.get("project_name")
+            + "/validation-report.json"
+        )
+
+    def group_tasks(self):
+        """Return (keyframe, composite paths, original array indices) for each
+        keyframe group, in order."""
+        blender = Blender(
+            self.config,
+            self.frames.get_frame_objects(),
+            self.frames.get_keyframe_objects(),
+            self.frame_index,
+        )
+        tasks = []
+        for keyframe, (_, frame_paths, _) in zip(
+            self.frames.get_keyframe_objects(), blender.group_tasks()
+        ):
+            original_indices = sorted(
+                keyframe["keyframe_children_indices"]
+                + [keyframe["frame_index_original"]]
+            )
+            tasks.append(
+                (
+                    keyframe,
+                    [output_path for _, output_path in frame_paths],
+                    # Original indices are one ahead of the analysis arrays
+                    np.asarray(original_indices) - 1,
+                )
+            )
+        return tasks
+
+    def original_scores(self, indices):
+        frames = self.frames
+        return frames.all_motion_diffs[indices] + frames.all_color_diffs[indices]
+
+    def validate(self):
+        """Score the composites, write the report and return it."""
+        section = self.config.get("validation")
+        parameters = self.config.analysis_parameters()
+        # Composites are full frames, so the mask's region of interest does not
+        # apply; the working width keeps the scoring cost down
+        options = FeatureOptions(working_width=parameters.working_width)
+        tasks = self.group_tasks()
+
+        results = []
+        workers = pool_size(section["workers"], self.max_workers)
+        with process_pool(workers) as pool:
+            previous_paths = [None] + [paths[-1] for _, paths, _ in tasks[:-1]]
+            futures = [
+                pool.submit(score_composites, paths, previous_path, options)
+                for (_, paths, _), previous_path in zip(tasks, previous_paths)
+            ]
+            for future in futures:
+                motion, color = future.result()
+                results.append(
+                    parameters.motion_weight * motion + parameters.color_weight * color
+                )
+
+        composite = np.concatenate(results)
+        original = self.original_scores(np.concatenate([task[2] for task in tasks]))
+        deviations = np.abs(
+            composite / np.nanmean(composite) - original / np.nanmean(original)
+        )
+
+        groups = []
+        start = 0
+        for (keyframe, paths, _), scores in zip(tasks, results):
+            group_deviations = deviations[start : start + len(scores)]
+            start += len(scores)
+            groups.append(
+                {
+                    "keyframe_index": keyframe["keyframe_index"],
+                    "frame_index_original": keyframe["frame_index_original"],
+                    "frames": len(paths),
+                    "deviation": nan_statistic(np.mean, group_deviations),
+                    "max_deviation": nan_statistic(np.max, group_deviations),
+                    "boundary_deviation": None
+                    if np.isnan(group_deviations[0])
+                    else float(group_deviations[0]),
+                    "composites": paths,
+                }
+            )
+        groups.sort(key=lambda group: group["deviation"], reverse=True)
+        flagged = [
+            group for group in groups if group["deviation"] > section["flag_threshold"]
+        ]
+        report = {
+            "flag_threshold": section["flag_threshold"],
+            "flagged": [group["keyframe_index"] for group in flagged],
+            "deleted": bool(section["delete_flagged"]),
+            "groups": groups,
+        }
+        with open(self.report_path(), "w") as report_file:
+            json.dump(report, report_file, indent=4)
+
+        self.log.write(
+            [
+                f"Validation: {len(flagged)} of {len(groups)} keyframe groups flagged, "
+                f"report in {self.report_path()}",
+                "most deviating groups (keyframe index, deviation):",
+                [
+                    (group["keyframe_index"], round(group["deviation"], 3))
+                    for group in groups[:10]
+                ],
+            ]
+        )
+        if section["delete_flagged"]:
+            self.delete_composites(flagged)
+        return report
+
+    def delete_composites(self, groups):
+        """Delete the composites of groups and drop them from the frame index."""
+        for group in groups:
+            for path in group["composites"]:
+                if not is_store_frame_path(path) and os.path.exists(path):
+                    os.remove(path)
+                self.frame_index.discard(path)
+        self.frame_index.save()
@@ -1,47 +1,414 @@
-from PIL import Image
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import cv2
+import numpy as np
+from project_manager.frame_extractor import read_frame, write_frame
+from project_manager.frame_index import FrameIndex, path_frame_number
+from project_manager.frame_store import FrameStore, store_frame_path, store_path
+from project_manager.process_pool import pool_size, process_pool
+
+
+# Modes of frame_blending.tblend.blend: "over" cross-fades two alpha layers and
+# composites the result over the background
+BLEND_MODES = ("over",)
+
+
+def load_alpha_layer(path):
+    """Read a keyframe's output alpha layer as a BGR image and an alpha plane. Layers
+    without an alpha channel are treated as fully opaque."""
+    layer = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if layer is None:
+        raise IOError(f"Could not read alpha layer {path}")
+    if layer.ndim == 2:
+        layer = cv2.cvtColor(layer, cv2.COLOR_GRAY2BGR)
+    if layer.shape[2] == 4:
+        return layer[:, :, :3], layer[:, :, 3]
+    return layer, np.full(layer.shape[:2], 255, dtype=np.uint8)
+
+
+@lru_cache(maxsize=4)
+def cached_alpha_layer(path, mtime_ns):
+    """load_alpha_layer, cached per process. mtime_ns is part of the cache key so a
+    layer that was rewritten is read again."""
+    return load_alpha_layer(path)
+
+
+def alpha_over(foreground, alpha, background):
+    """
+    Composite a BGR foreground with an 8-bit alpha plane over an opaque BGR
+    background of the same size, in 16-bit fixed point:
+    (foreground * alpha + background * (255 - alpha) + 127) / 255, rounded.
+    """
+    alpha = alpha[:, :, np.newaxis].astype(np.uint16)
+    blended = foreground.astype(np.uint16) * alpha
+    blended += background.astype(np.uint16) * (255 - alpha)
+    blended += 127
+    # Exact division by 255 for values below 65535: (x + (x >> 8) + 1) >> 8
+    return ((blended + (blended >> 8) + 1) >> 8).astype(np.uint8)
+
+
+def fit_background(background, size):
+    """Scale a background frame to size (width, height) if it differs."""
+    if (background.shape[1], background.shape[0]) == size:
+        return background
+    interpolation = (
+        cv2.INTER_AREA if background.shape[1] > size[0] else cv2.INTER_LANCZOS4
+    )
+    return cv2.resize(background, size, interpolation=interpolation)
+
+
+def premultiplied_layer(foreground, alpha):
+    """Return a layer's premultiplied color (foreground * alpha) and its alpha
+    plane, both as uint16, for cross_fade_over."""
+    alpha = alpha.astype(np.uint16)
+    return foreground * alpha[:, :, np.newaxis], alpha
+
+
+def premultiplied_over(color, alpha, background):
+    """alpha_over for a layer in premultiplied form, with the same rounding."""
+    blended = background.astype(np.uint16) * (255 - alpha)[:, :, np.newaxis]
+    blended += color
+    blended += 127
+    return ((blended + (blended >> 8) + 1) >> 8).astype(np.uint8)
+
+
+def cross_fade_over(first, second, weight, background):
+    """
+    Composite the cross-fade of two premultiplied layers (see premultiplied_layer)
+    over an opaque BGR background: (1 - weight) * first + weight * second, then
+    over the background. weight is quantized to 1/256 steps and the arithmetic is
+    32-bit fixed point, rounded like alpha_over.
+
+    Cross-fading premultiplied layers is the same as cross-fading the two layers'
+    composites, so pixels covered by only one of them fade in or out rather than
+    popping.
+    """
+    step = round(weight * 256)
+    if step == 0:
+        return premultiplied_over(*first, background)
+    if step == 256:
+        return premultiplied_over(*second, background)
+    (first_color, first_alpha), (second_color, second_alpha) = first, second
+    coverage = first_alpha.astype(np.uint32) * (256 - step)
+    coverage += second_alpha * np.uint32(step)
+    blended = first_color.astype(np.uint32) * (256 - step)
+    blended += second_color * np.uint32(step)
+    blended += background.astype(np.uint32) * (65280 - coverage)[:, :, np.newaxis]
+    blended += 32640
+    return (blended // 65280).astype(np.uint8)
+
+
+def read_background(background_path, size):
+    """Read a background frame as opaque BGR of size (width, height)."""
+    background = read_frame(background_path)
+    if background.ndim == 3 and background.shape[2] == 4:
+        background = background[:, :, :3]
+    return fit_background(background, size)
+
+
+def composite_frame(foreground, alpha, background_path):
+    """Composite a foreground and alpha plane over the background frame at a path."""
+    size = (foreground.shape[1], foreground.shape[0])
+    return alpha_over(foreground, alpha, read_background(background_path, size))
+
+
+def group_compositor(alpha_path, fade=None, cached=False):
+    """
+    Return a function compositing the i-th frame of a keyframe group over the
+    background at a path: composite(i, background_path).
+
+    Without a fade the keyframe's alpha layer is pasted over every frame. With a
+    fade, (next alpha path, weights), frame i cross-fades from the keyframe's layer
+    to the next keyframe's by weights[i]; the two layers are held in premultiplied
+    form and nothing else of the group is kept. If cached is set, layers are read
+    through the per-process cache (see composite_frames).
+    """
+    read_layer = (
+        (lambda path: cached_alpha_layer(path, os.stat(path).st_mtime_ns))
+        if cached
+        else load_alpha_layer
+    )
+    foreground, alpha = read_layer(alpha_path)
+    size = (foreground.shape[1], foreground.shape[0])
+    if fade is None:
+        return lambda i, background_path: alpha_over(
+            foreground, alpha, read_background(background_path, size)
+        )
+
+    next_alpha_path, weights = fade
+    first = premultiplied_layer(foreground, alpha)
+    next_foreground, next_alpha = read_layer(next_alpha_path)
+    if next_foreground.shape != foreground.shape:
+        next_foreground = cv2.resize(
+            next_foreground, size, interpolation=cv2.INTER_LINEAR
+        )
+        next_alpha = cv2.resize(next_alpha, size, interpolation=cv2.INTER_LINEAR)
+    second = premultiplied_layer(next_foreground, next_alpha)
+    return lambda i, background_path: cross_fade_over(
+        first, second, weights[i], read_background(background_path, size)
+    )
+
+
+def composite_group(alpha_path, frame_paths, writer_threads, fade=None):
+    """
+    Composite one keyframe's alpha layer over every background frame of its group.
+
+    The alpha layer is read once, and with a fade (see group_compositor) so is the
+    next keyframe's. frame_paths is a list of (background path, output path)
+    pairs. PNG encoding runs on a thread pool so it overlaps with compositing the
+    next frame. Returns the number of frames written.
+    """
+    cv2.setNumThreads(1)
+    composite = group_compositor(alpha_path, fade)
+    with ThreadPoolExecutor(max_workers=writer_threads) as writers:
+        writes = []
+        for i, (background_path, output_path) in enumerate(frame_paths):
+            result = composite(i, background_path)
+            writes.append(writers.submit(write_frame, output_path, result))
+        for write in writes:
+            write.result()
+    return len(frame_paths)
+
+
+def composite_frames(alpha_path, frame_paths, write_frames=False, fade=None):
+    """
+    Composite a run of frames of one keyframe group and return them in order.
+    If write_frames is set, each composite is also written to its output path.
+    fade, if given, holds the weights of the frames of the run.
+
+    The alpha layers are cached per worker process, so consecutive runs of the same
+    group that land on one worker read them only once.
+    """
+    cv2.setNumThreads(1)
+    composite = group_compositor(alpha_path, fade, cached=True)
+    results = []
+    for i, (background_path, output_path) in enumerate(frame_paths):
+        result = composite(i, background_path)
+        if write_frames:
+            write_frame(output_path, result)
+        results.append(result)
+    return results
 
 
 class Blender:
-    def __init__(self, config, frames, keyframes):
+    """
+    Composites the output alpha layer of each keyframe over the original background
+    frames of its keyframe group.
+
+    Keyframe groups are spread across a process pool (compositing.workers in the
+    config, or one per CPU if null, and no more than max_workers). If a
+    StageManifest is passed to blend, groups whose fingerprint (see
+    group_fingerprint) is unchanged and whose composites exist are skipped. stream
+    yields every composite in frame order instead, e.g., to pipe them into a
+    VideoEncoder. With frame_blending.enabled, each group cross-fades towards the
+    next keyframe's layer (see fade_weights and cross_fade_over).
+
+    Background frames are looked up, and composites recorded, in the project's
+    FrameIndex (a new one is loaded if none is passed).
+    """
+
+    def __init__(
+        self, config, frames, keyframes, frame_index=None, max_workers=None
+    ):
         self.config = config
         self.frames = frames
         self.keyframes = keyframes
-
-    def blend(self):
-        scale = (
-            "upscaled" if self.config.get("upscaling")["original"]["enabled"] else "raw"
-        )
-        original_frames = os.listdir(
-            self.config.get("directories")[f"frames_original_background_{scale}"]
+        self.frame_index = (
+            frame_index if frame_index is not None else FrameIndex(config)
         )
-        original_frames = sorted(original_frames, key=lambda x: int(x.split(".")[0]))
+        self.max_workers = max_workers
+
+    def alpha_layer_path(self, keyframe):
+        return f"{self.config.get('directories')['keyframes_output_alpha']}/{keyframe['keyframe_index'] + 1}.png"
+
+    def fade_weights(self, target_indices, next_keyframe, scores):
+        """Return the cross-fade weight of each frame of a group (original indices,
+        the keyframe first) towards the next keyframe's layer."""
+        parameters = self.config.blending_parameters()
+        start = target_indices[0]
+        end = next_keyframe["frame_index_original"]
+        positions = (np.asarray(target_indices) - start) / (end - start)
+        weights = positions
+        next_score = next_keyframe.get("keyframe_combined_score", np.nan)
+        if parameters.blend_weighting == "score" and next_score > 0:
+            weights = np.array([scores.get(i, np.nan) for i in target_indices])
+            weights[0] = 0
+            # A forced keyframe (see max_keyframe_group_size) can score lower than
+            # frames of the group before it
+            weights = np.clip(weights / max(next_score, np.nanmax(weights)), 0, 1)
+            # Frames without a score fall back to their position, and the weight
+            # never decreases within a group, so the fade does not flicker
+            weights = np.where(np.isnan(weights), positions, weights)
+            weights = np.maximum.accumulate(weights)
+        return (weights * parameters.blend_opacity).tolist()
+
+    def group_tasks(self):
+        """Return (alpha layer path, [(background path, output path), ...], fade) for
+        each keyframe group. fade is (next alpha layer path, weights) with temporal
+        blending, or None."""
+        scale = "upscaled" if self.config.blending_parameters().upscaled else "raw"
+        background_folder = self.config.get("directories")[
+            f"frames_original_background_{scale}"
+        ]
+        original_frames = self.frame_index.frame_paths(background_folder)
+        composite_folder = self.config.get("directories")["frames_composite_all_raw"]
+        use_store = self.config.get("frame_extraction")["format"] == "store"
+        parameters = self.config.blending_parameters()
+        if parameters.temporal_blending:
+            if parameters.blend_mode not in BLEND_MODES:
+                raise ValueError(
+                    f"Unknown frame_blending.tblend.blend {parameters.blend_mode!r}"
+                )
+            scores = {
+                frame["frame_index_original"]: frame.get(
+                    "keyframe_combined_score", np.nan
+                )
+                for frame in self.frames
+            }
 
-        for keyframe in self.keyframes:
-            alpha_output_path = f"{self.config.get('directories')['keyframes_output_alpha']}/{keyframe['keyframe_index'] + 1}.png"
-            blend_target_indices = keyframe["keyframe_children_indices"]
-            blend_target_indices.append(keyframe["frame_index_original"])
-            blend_target_indices.sort()
+        tasks = []
+        for k, keyframe in enumerate(self.keyframes):
+            alpha_output_path = self.alpha_layer_path(keyframe)
+            blend_target_indices = sorted(
+                keyframe["keyframe_children_indices"]
+                + [keyframe["frame_index_original"]]
+            )
+            frame_paths = []
             for index in blend_target_indices:
-                blend_target_path = (
-                    self.config.get("directories")[
-                        f"frames_original_background_{scale}"
-                    ]
-                    + f"/{original_frames[index]}"
+                number = path_frame_number(original_frames[index])
+                if use_store:
+                    output_path = store_frame_path(composite_folder, number)
+                else:
+                    output_path = f"{composite_folder}/{number}.png"
+                frame_paths.append((original_frames[index], output_path))
+            fade = None
+            if parameters.temporal_blending and k + 1 < len(self.keyframes):
+                next_keyframe = self.keyframes[k + 1]
+                fade = (
+                    self.alpha_layer_path(next_keyframe),
+                    self.fade_weights(blend_target_indices, next_keyframe, scores),
                 )
-                output_path = f"{self.config.get('directories')['frames_composite_all_raw']}/{original_frames[index]}"
+            tasks.append((alpha_output_path, frame_paths, fade))
+        if use_store and tasks:
+            self.prepare_composite_store(composite_folder, tasks)
+        return tasks
 
-                # Load images
-                background = Image.open(blend_target_path)
-                alpha_channel = Image.open(alpha_output_path)
+    def prepare_composite_store(self, composite_folder, tasks):
+        """Create the composite FrameStore, unless one of the right shape and size
+        exists, whose composites are kept."""
+        shape = load_alpha_layer(tasks[0][0])[0].shape
+        count = max(
+            path_frame_number(output_path)
+            for _, frame_paths, _ in tasks
+            for _, output_path in frame_paths
+        )
+        path = store_path(composite_folder)
+        if os.path.exists(path):
+            store = FrameStore.open(path)
+            store.close()
+            if store.shape == shape and store.count == count:
+                return
+        FrameStore.create(path, shape, count).close()
 
-                # Scale background to match alpha channel dimensions
-                background = background.resize(alpha_channel.size, Image.ANTIALIAS)
+    def group_fingerprint(self, manifest, alpha_path, frame_paths, fade):
+        fingerprint = {
+            "alpha": manifest.file_hash(alpha_path),
+            "frames": [os.path.basename(path) for path, _ in frame_paths],
+        }
+        if fade is not None:
+            fingerprint["next alpha"] = manifest.file_hash(fade[0])
+            fingerprint["weights"] = [round(weight, 4) for weight in fade[1]]
+        return fingerprint
 
-                # Composite images using alpha channel
-                result = Image.alpha_composite(
-                    background.convert("RGBA"), alpha_channel
+    def blend(self, manifest=None):
+        """Composite every keyframe group, or with a manifest of the running "blend"
+        stage, only the groups that changed. Return the number of frames written."""
+        workers = pool_size(
+            self.config.blending_parameters().workers, self.max_workers
+        )
+        writer_threads = self.config.blending_parameters().writer_threads
+        tasks = []
+        for alpha_path, frame_paths, fade in self.group_tasks():
+            fingerprint = None
+            if manifest is not None:
+                fingerprint = self.group_fingerprint(
+                    manifest, alpha_path, frame_paths, fade
                 )
+                # Composites deleted by validation are only missing from the
+                # index when the format is "store", whose slots remain
+                if manifest.item_is_current("blend", alpha_path, fingerprint) and all(
+                    self.frame_index.contains(output_path)
+                    for _, output_path in frame_paths
+                ):
+                    continue
+            tasks.append((alpha_path, frame_paths, fade, fingerprint))
+
+        written = 0
+        try:
+            with process_pool(workers) as pool:
+                futures = {
+                    pool.submit(
+                        composite_group, alpha_path, frame_paths, writer_threads, fade
+                    ): (alpha_path, frame_paths, fingerprint)
+                    for alpha_path, frame_paths, fade, fingerprint in tasks
+                }
+                for future in as_completed(futures):
+                    written += future.result()
+                    alpha_path, frame_paths, fingerprint = futures[future]
+                    for _, output_path in frame_paths:
+                        self.frame_index.record(output_path)
+                    if manifest is not None:
+                        manifest.record_item("blend", alpha_path, fingerprint)
+        finally:
+            # Groups finished before a failure are not redone
+            if manifest is not None:
+                manifest.flush()
+            self.frame_index.save()
+        return written
+
+    def stream(self, write_frames=False):
+        """Yield the composited frames, in order, as BGR arrays. If write_frames is
+        set, they are also written to the composite folder."""
+        parameters = self.config.blending_parameters()
+        workers = pool_size(parameters.workers, self.max_workers)
+        chunk_size = parameters.stream_chunk_size
+        # Runs composited ahead of the one being yielded
+        max_pending = 2 * workers
+        pending = deque()
+
+        def finish_run():
+            future, run = pending.popleft()
+            results = future.result()
+            if write_frames:
+                for _, output_path in run:
+                    self.frame_index.record(output_path)
+            return results
 
-                # Save result
-                result.save(output_path)
+        with process_pool(workers) as pool:
+            for alpha_path, frame_paths, fade in self.group_tasks():
+                for start in range(0, len(frame_paths), chunk_size):
+                    run = frame_paths[start : start + chunk_size]
+                    if fade is not None:
+                        run_fade = (fade[0], fade[1][start : start + chunk_size])
+                    else:
+                        run_fade = None
+                    pending.append(
+                        (
+                            pool.submit(
+                                composite_frames,
+                                alpha_path,
+                                run,
+                                write_frames,
+                                run_fade,
+                            ),
+                            run,
+                        )
+                    )
+                    if len(pending) >= max_pending:
+                        yield from finish_run()
+            while pending:
+                yield from finish_run()
+        if write_frames:
+            self.frame_index.save()
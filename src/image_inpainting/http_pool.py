@@ -0,0 +1,141 @@
+import asyncio
+import ssl
+from urllib.parse import urlsplit
+
+
+class HTTPError(Exception):
+    """A response with an error status. retryable is set for statuses worth
+    retrying: 408, 429 and 5xx."""
+
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}: {body[:200]!r}")
+        self.status = status
+        self.body = body
+        self.retryable = status in (408, 429) or status >= 500
+
+
+class ConnectionPool:
+    """
+    A minimal asyncio HTTP/1.1 client keeping up to size keep-alive connections to
+    one server.
+
+    A request takes an idle connection, or opens one, and returns it to the pool
+    once the response was read, unless the server asked to close it. At most size
+    requests are in flight; more wait for a connection. Responses with a
+    Content-Length or chunked body are supported, which covers the JSON APIs the
+    pipeline talks to.
+
+    Attributes:
+        host (str): Server host.
+        port (int): Server port.
+        size (int): Maximum number of connections, and of requests in flight.
+        timeout (float): Seconds allowed for one request and its response.
+        connections_opened (int): Number of connections opened so far.
+    """
+
+    def __init__(self, url, size, timeout):
+        parts = urlsplit(url)
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.base_path = parts.path.rstrip("/")
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+        self.connections_opened = 0
+
+    async def connect(self):
+        self.connections_opened += 1
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def request(self, method, path, body=b"", content_type="application/json"):
+        """Send a request and return the status and body of the response. Raises
+        HTTPError for statuses of 400 and above."""
+        async with self.slots:
+            while True:
+                reused = bool(self.idle)
+                connection = self.idle.pop() if reused else await self.connect()
+                try:
+                    status, data, keep_alive = await asyncio.wait_for(
+                        self.exchange(connection, method, path, body, content_type),
+                        self.timeout,
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError) as error:
+                    self.close(connection)
+                    # The server may close a connection while it is idle. If a
+                    # reused connection fails before any response arrived, the
+                    # request is sent again on another one
+                    if reused and not getattr(error, "partial", b""):
+                        continue
+                    raise
+                except BaseException:
+                    self.close(connection)
+                    raise
+                break
+            if keep_alive:
+                self.idle.append(connection)
+            else:
+                self.close(connection)
+        if status >= 400:
+            raise HTTPError(status, data)
+        return status, data
+
+    async def exchange(self, connection, method, path, body, content_type):
+        reader, writer = connection
+        head = (
+            f"{method} {self.base_path}{path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        version, status = status_line.decode("latin-1").split(" ", 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection") != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size_line = await reader.readline()
+                if not size_line:
+                    raise asyncio.IncompleteReadError(b"".join(chunks), None)
+                size = int(size_line.split(b";")[0], 16)
+                if size == 0:
+                    # Trailers, up to the blank line
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b"".join(chunks)
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return int(status), data, keep_alive
+
+    def close(self, connection):
+        connection[1].close()
+
+    async def close_all(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
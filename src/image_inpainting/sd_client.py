@@ -0,0 +1,231 @@
+import asyncio
+import base64
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from image_inpainting.http_pool import ConnectionPool, HTTPError
+from project_manager.frame_extractor import read_frame
+
+# automatic1111's inpainting endpoint
+IMG2IMG_PATH = "/sdapi/v1/img2img"
+
+
+def encode_image(image):
+    """Return an image as base64 PNG."""
+    ok, data = cv2.imencode(".png", np.asarray(image))
+    if not ok:
+        raise IOError("Could not encode an image for the SD server")
+    return base64.b64encode(data.tobytes()).decode("ascii")
+
+
+def decode_image(data):
+    """Decode a base64 image, as the API returns them, to a BGR array."""
+    if "," in data[:64]:
+        # Data URLs ("data:image/png;base64,...")
+        data = data.split(",", 1)[1]
+    image = cv2.imdecode(
+        np.frombuffer(base64.b64decode(data), dtype=np.uint8), cv2.IMREAD_COLOR
+    )
+    if image is None:
+        raise IOError("Could not decode an image returned by the SD server")
+    return image
+
+
+def alpha_layer(output, mask):
+    """Return the output alpha layer of a keyframe: the SD output as BGRA, with the
+    keyframe's white mask as its alpha channel, so only the inpainted area is
+    composited."""
+    if mask.ndim == 3:
+        mask = cv2.cvtColor(mask[:, :, :3], cv2.COLOR_BGR2GRAY)
+    if mask.shape != output.shape[:2]:
+        mask = cv2.resize(
+            mask, (output.shape[1], output.shape[0]), interpolation=cv2.INTER_LINEAR
+        )
+    return np.dstack((output, mask))
+
+
+class InpaintingClient:
+    """
+    Inpaints the keyframes through an automatic1111-style img2img API, with several
+    requests in flight at once so the SD server never waits for the client.
+
+    Each keyframe's background frame (keyframes_original_background) is sent as the
+    init image and its alpha-white frame (keyframes_original_alpha_white_out) as
+    the mask. The first image returned becomes the keyframe's output alpha layer
+    in keyframes_output_alpha, named like Blender expects ({keyframe index + 1}.png);
+    any further images, if the request asks for several (batch_size and n_iter
+    of stable_diffusion.request, 1 by default), are written next to it as
+    {keyframe index + 1}_{n}.png, to pick from.
+
+    Requests go through one ConnectionPool of stable_diffusion.max_in_flight
+    keep-alive connections. Twice as many worker coroutines take the next keyframe,
+    so one keyframe's request is being prepared while another's is on the server.
+    Encoding the inputs and decoding and writing the results (base64 and PNG) run
+    on a thread pool, off the event loop, so responses keep being read while images
+    are converted. Failed requests (connection errors, timeouts, 408,
+    429 and 5xx) are retried up to stable_diffusion.retries times, waiting
+    retry_backoff * 2^attempt seconds with jitter in between.
+
+    If a StageManifest is passed to inpaint, each keyframe's fingerprint (the hashes
+    of its two input frames) is recorded as it finishes, and keyframes whose
+    fingerprint is unchanged and whose alpha layer exists are skipped. The
+    manifest's "inpaint" stage must be started with the request options, so a
+    changed prompt redoes every keyframe.
+    """
+
+    def __init__(self, config, log, frame_index):
+        self.config = config
+        self.log = log
+        self.frame_index = frame_index
+
+    def request_options(self):
+        """Return the img2img request fields other than the images."""
+        section = self.config.get("stable_diffusion")
+        options = dict(section["request"])
+        model = options.pop("model", None)
+        if model:
+            options["override_settings"] = {"sd_model_checkpoint": model}
+        return options
+
+    def keyframe_jobs(self, keyframe_indices):
+        """Return (keyframe number, background path, mask path, output path) for
+        each keyframe, keyframe_indices being the keyframes' original indices in
+        keyframe order."""
+        directories = self.config.get("directories")
+        jobs = []
+        for number, index in enumerate(keyframe_indices, start=1):
+            background_path = self.frame_index.frame_path(
+                directories["keyframes_original_background"], index
+            )
+            mask_path = self.frame_index.frame_path(
+                directories["keyframes_original_alpha_white_out"], index
+            )
+            if background_path is None or mask_path is None:
+                self.log.warning(f"Inpainting: keyframe {index} is not stored")
+                continue
+            output_path = f"{directories['keyframes_output_alpha']}/{number}.png"
+            jobs.append((number, background_path, mask_path, output_path))
+        return jobs
+
+    def fingerprint(self, manifest, background_path, mask_path):
+        return {
+            "background": manifest.file_hash(background_path),
+            "mask": manifest.file_hash(mask_path),
+        }
+
+    def inpaint(self, keyframe_indices, manifest=None):
+        """Inpaint the keyframes that are not done yet. Return the number
+        inpainted."""
+        jobs = []
+        for job in self.keyframe_jobs(keyframe_indices):
+            fingerprint = None
+            if manifest is not None:
+                fingerprint = self.fingerprint(manifest, job[1], job[2])
+                if manifest.item_is_current(
+                    "inpaint", job[0], fingerprint
+                ) and os.path.exists(job[3]):
+                    continue
+            jobs.append(job + (fingerprint,))
+        self.log.write(f"Inpainting {len(jobs)} keyframes")
+        if not jobs:
+            return 0
+        return asyncio.run(self.run(jobs, manifest))
+
+    async def run(self, jobs, manifest):
+        section = self.config.get("stable_diffusion")
+        pool = ConnectionPool(
+            section["url"], section["max_in_flight"], section["timeout"]
+        )
+        options = self.request_options()
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+        done = []
+
+        async def worker():
+            while not queue.empty():
+                job = queue.get_nowait()
+                await self.inpaint_keyframe(pool, executor, options, job)
+                number, _, _, _, fingerprint = job
+                if manifest is not None:
+                    manifest.record_item("inpaint", number, fingerprint)
+                done.append(number)
+                self.log.write(f"Inpainting: keyframe {number} done")
+
+        workers = min(2 * pool.size, len(jobs))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                await asyncio.gather(*(worker() for _ in range(workers)))
+            finally:
+                await pool.close_all()
+                if manifest is not None:
+                    manifest.flush()
+        self.log.write(
+            f"Inpainting: {len(done)} keyframes over {pool.connections_opened} "
+            "connections"
+        )
+        return len(done)
+
+    async def inpaint_keyframe(self, pool, executor, options, job):
+        _, background_path, mask_path, output_path, _ = job
+        loop = asyncio.get_running_loop()
+
+        def encode_request():
+            background = read_frame(background_path)
+            # SD works in multiples of 8 pixels; the server resizes to this size
+            scale = self.config.get("stable_diffusion")["resize"]
+            body = dict(options)
+            body["width"] = max(8, round(background.shape[1] * scale / 8) * 8)
+            body["height"] = max(8, round(background.shape[0] * scale / 8) * 8)
+            body["init_images"] = [encode_image(background)]
+            body["mask"] = encode_image(read_frame(mask_path))
+            return json.dumps(body).encode("utf-8")
+
+        body = await loop.run_in_executor(executor, encode_request)
+        _, response = await self.post(pool, body)
+        await loop.run_in_executor(
+            executor, self.write_outputs, response, mask_path, output_path
+        )
+
+    async def post(self, pool, body):
+        """POST an img2img request, retrying failures with exponential backoff. A
+        connection that failed, including one the server closed or reset while the
+        response was being read, is closed by the pool and the retry opens or
+        reuses another."""
+        section = self.config.get("stable_diffusion")
+        attempt = 0
+        while True:
+            try:
+                return await pool.request("POST", IMG2IMG_PATH, body)
+            except (
+                HTTPError,
+                ConnectionError,
+                asyncio.IncompleteReadError,
+                asyncio.TimeoutError,
+                OSError,
+            ) as error:
+                retryable = not isinstance(error, HTTPError) or error.retryable
+                if not retryable or attempt >= section["retries"]:
+                    raise
+                delay = section["retry_backoff"] * 2**attempt
+                delay *= random.uniform(0.5, 1.5)
+                self.log.warning(
+                    f"Inpainting: request failed ({error!r}), retrying in {delay:.1f} s"
+                )
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def write_outputs(self, response, mask_path, output_path):
+        """Decode the images of an img2img response and write the alpha layers."""
+        images = json.loads(response)["images"]
+        if not images:
+            raise IOError(f"The SD server returned no images for {output_path}")
+        mask = np.asarray(read_frame(mask_path))
+        stem = output_path[: -len(".png")]
+        for n, data in enumerate(images):
+            path = output_path if n == 0 else f"{stem}_{n}.png"
+            if not cv2.imwrite(path, alpha_layer(decode_image(data), mask)):
+                raise IOError(f"Could not write alpha layer to {path}")
@@ -0,0 +1,427 @@
+import math
+import os
+import sys
+from concurrent.futures import as_completed
+import cv2
+import numpy as np
+from project_manager.frame_extractor import frame_extension, read_frame, write_frame
+from project_manager.frame_index import FrameIndex
+from project_manager.frame_store import FrameStore, store_frame_path, store_path
+from project_manager.process_pool import pool_size, process_pool
+
+# Vendored Real-ESRGAN checkout; its realesrgan package is imported from here if it
+# is not installed
+REAL_ESRGAN_PATH = "lib/Real-ESRGAN"
+
+# Real-ESRGAN models by name: architecture and native scale. "auto" picks the x2
+# model for scales up to 2 and the x4 model otherwise.
+MODELS = {
+    "RealESRGAN_x4plus": ("rrdbnet", 4),
+    "RealESRGAN_x2plus": ("rrdbnet", 2),
+    "realesr-general-x4v3": ("srvgg", 4),
+}
+
+# Upscaled input and output folders of each target in the upscaling config section
+TARGET_FOLDERS = {
+    "original": [
+        ("frames_original_background_raw", "frames_original_background_upscaled")
+    ],
+    "output_composite": [
+        ("frames_composite_all_raw", "frames_composite_all_upscaled")
+    ],
+}
+
+
+def model_name(model, scale):
+    if model != "auto":
+        return model
+    return "RealESRGAN_x2plus" if scale <= 2 else "RealESRGAN_x4plus"
+
+
+def axis_windows(length, tile_size, overlap):
+    """
+    Return (window start, core start, core end) of each tile along an axis.
+
+    The cores cut the axis into tile_size pieces. Each window adds up to overlap
+    pixels of context on both sides of its core, and windows at the edges are
+    shifted inwards rather than cut, so every window has the same length and tiles
+    of equal-sized frames can be stacked into one batch.
+    """
+    window = min(length, tile_size + 2 * overlap)
+    windows = []
+    for core_start in range(0, length, tile_size):
+        core_end = min(core_start + tile_size, length)
+        window_start = min(max(core_start - overlap, 0), length - window)
+        windows.append((window_start, core_start, core_end))
+    return window, windows
+
+
+def tile_windows(height, width, tile_size, overlap):
+    """Return the window (height, width) and the (y windows, x windows) tiles of a
+    frame, see axis_windows."""
+    window_height, rows = axis_windows(height, tile_size, overlap)
+    window_width, columns = axis_windows(width, tile_size, overlap)
+    tiles = [(row, column) for row in rows for column in columns]
+    return (window_height, window_width), tiles
+
+
+def import_architectures():
+    """Return the RRDBNet and SRVGGNetCompact classes of Real-ESRGAN."""
+    if os.path.isdir(REAL_ESRGAN_PATH) and REAL_ESRGAN_PATH not in sys.path:
+        sys.path.append(REAL_ESRGAN_PATH)
+    try:
+        from basicsr.archs.rrdbnet_arch import RRDBNet
+        from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+    except ImportError as error:
+        raise ImportError(
+            "Upscaling needs torch, basicsr and Real-ESRGAN (pip install basicsr, and "
+            f"pip install realesrgan or a checkout in {REAL_ESRGAN_PATH})"
+        ) from error
+    return RRDBNet, SRVGGNetCompact
+
+
+def check_model(name, models_folder):
+    """Raise a clear error if the packages or the weights a model needs are
+    missing, before any worker process tries to load it."""
+    import_architectures()
+    weights = f"{models_folder}/{name}.pth"
+    if not os.path.exists(weights):
+        raise FileNotFoundError(
+            f"Upscaling model {name} not found: download {name}.pth from the "
+            f"Real-ESRGAN releases to {weights} (upscaling.models_folder)"
+        )
+
+
+def load_model(name, models_folder):
+    """Load a Real-ESRGAN model's weights from models_folder/{name}.pth, in
+    evaluation mode on the CPU."""
+    import torch
+
+    RRDBNet, SRVGGNetCompact = import_architectures()
+    architecture, scale = MODELS[name]
+    if architecture == "rrdbnet":
+        model = RRDBNet(
+            num_in_ch=3,
+            num_out_ch=3,
+            num_feat=64,
+            num_block=23,
+            num_grow_ch=32,
+            scale=scale,
+        )
+    else:
+        model = SRVGGNetCompact(
+            num_in_ch=3,
+            num_out_ch=3,
+            num_feat=64,
+            num_conv=32,
+            upscale=scale,
+            act_type="prelu",
+        )
+    weights = torch.load(f"{models_folder}/{name}.pth", map_location="cpu")
+    # Released weights keep the EMA parameters under params_ema
+    for key in ("params_ema", "params"):
+        if key in weights:
+            weights = weights[key]
+            break
+    model.load_state_dict(weights, strict=True)
+    return model.eval()
+
+
+class TileUpscaler:
+    """
+    Upscales frames with a Real-ESRGAN model, tile by tile.
+
+    Frames are cut into overlapping tiles of equal size (see axis_windows), and the
+    tiles of all the frames passed to upscale are run through the model in batches
+    of batch_size, so small frames fill a batch as well as large ones. Each tile
+    contributes only its core, so the overlap hides the seams. The model's output is
+    resized if the requested scale is not the model's own.
+
+    Attributes:
+        model: The Real-ESRGAN model (a torch module).
+        model_scale (int): The model's native scale.
+        scale (float): The requested scale.
+        tile_size (int): Side of a tile's core, in input pixels.
+        overlap (int): Context added around each core, in input pixels.
+        batch_size (int): Tiles per model call.
+    """
+
+    def __init__(self, model, model_scale, scale, tile_size, overlap, batch_size):
+        self.model = model
+        self.model_scale = model_scale
+        self.scale = scale
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+
+    def run_model(self, tiles):
+        """Upscale a (count, height, width, 3) uint8 BGR batch."""
+        import torch
+
+        batch = np.ascontiguousarray(tiles[..., ::-1].transpose(0, 3, 1, 2))
+        with torch.inference_mode():
+            output = self.model(torch.from_numpy(batch).float().div_(255))
+            output = output.clamp_(0, 1).mul_(255).round_().byte().numpy()
+        return output.transpose(0, 2, 3, 1)[..., ::-1]
+
+    def upscale(self, frames):
+        """Return the upscaled copies of a list of BGR (or BGRA) frames."""
+        scale = self.model_scale
+        outputs = []
+        tiles = []
+        for frame in frames:
+            height, width = frame.shape[:2]
+            output = np.empty((height * scale, width * scale, 3), dtype=np.uint8)
+            (window_height, window_width), windows = tile_windows(
+                height, width, self.tile_size, self.overlap
+            )
+            for (y, core_y0, core_y1), (x, core_x0, core_x1) in windows:
+                tiles.append(
+                    (
+                        frame[y : y + window_height, x : x + window_width, :3],
+                        output[
+                            core_y0 * scale : core_y1 * scale,
+                            core_x0 * scale : core_x1 * scale,
+                        ],
+                        (core_y0 - y) * scale,
+                        (core_x0 - x) * scale,
+                    )
+                )
+            outputs.append(output)
+
+        # Tiles of one shape are batched together; frames of one size share a shape
+        tiles.sort(key=lambda tile: tile[0].shape)
+        start = 0
+        while start < len(tiles):
+            shape = tiles[start][0].shape
+            end = start
+            while (
+                end < len(tiles)
+                and end - start < self.batch_size
+                and tiles[end][0].shape == shape
+            ):
+                end += 1
+            results = self.run_model(np.stack([tile[0] for tile in tiles[start:end]]))
+            for (_, core, top, left), result in zip(tiles[start:end], results):
+                core[:] = result[top : top + core.shape[0], left : left + core.shape[1]]
+            start = end
+
+        for i, frame in enumerate(frames):
+            outputs[i] = self.finish(frame, outputs[i])
+        return outputs
+
+    def finish(self, frame, output):
+        """Resize the model's output to the requested scale and upscale the alpha
+        channel, if any, by interpolation."""
+        height, width = frame.shape[:2]
+        size = (round(width * self.scale), round(height * self.scale))
+        if size != (output.shape[1], output.shape[0]):
+            output = cv2.resize(output, size, interpolation=cv2.INTER_LANCZOS4)
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            alpha = cv2.resize(frame[..., 3], size, interpolation=cv2.INTER_LINEAR)
+            output = np.dstack((output, alpha))
+        return output
+
+
+# The TileUpscaler of a worker process, loaded once by init_worker
+worker_upscaler = None
+
+
+def init_worker(name, models_folder, scale, tile_size, overlap, batch_size, threads):
+    """Process pool initializer: limit torch's intra-op threads and load the model
+    once for every chunk the worker upscales."""
+    import torch
+
+    global worker_upscaler
+    torch.set_num_threads(threads)
+    worker_upscaler = TileUpscaler(
+        load_model(name, models_folder),
+        MODELS[name][1],
+        scale,
+        tile_size,
+        overlap,
+        batch_size,
+    )
+
+
+def upscale_chunk(frame_paths, frame_format):
+    """Upscale [(input path, output path), ...] in the worker process. Return the
+    number of frames written."""
+    frames = [read_frame(input_path) for input_path, _ in frame_paths]
+    for (_, output_path), output in zip(frame_paths, worker_upscaler.upscale(frames)):
+        write_frame(output_path, output, frame_format)
+    return len(frame_paths)
+
+
+class Upscaler:
+    """
+    Runs the upscaling targets of the config's upscaling section ("original" for
+    the background frames, "output_composite" for the composites) with Real-ESRGAN,
+    in-process on the CPU.
+
+    Frames are spread across a process pool of upscaling.workers (or one per
+    threads_per_worker CPUs if null), using no more than max_workers CPUs, e.g.,
+    the CPUs a batch gives each stage. Each worker loads the model once and limits
+    torch to threads_per_worker intra-op threads, since several small thread pools
+    keep a CPU busier than one large one on the model's small convolutions. Workers
+    upscale chunks of frames, with the tiles of a chunk batched across its frames
+    (see TileUpscaler).
+
+    If a StageManifest is passed to upscale, each frame's fingerprint (its input's
+    FrameIndex entry, the model, scale and tiling) is recorded as its chunk
+    finishes, and frames whose fingerprint is unchanged and whose output exists
+    are skipped, so an interrupted run resumes where it stopped. With
+    frame_extraction.format "store", upscaled frames go to a FrameStore in the
+    output folder.
+
+    The weights are read from upscaling.models_folder/{model}.pth.
+    """
+
+    def __init__(self, config, log, frame_index=None, max_workers=None):
+        self.config = config
+        self.log = log
+        self.frame_index = (
+            frame_index if frame_index is not None else FrameIndex(config)
+        )
+        self.max_workers = max_workers
+
+    def frame_fingerprint(self, entry, name, scale):
+        """Return the fingerprint of a frame's upscaled output: its input's
+        FrameIndex entry and the options that change the output."""
+        section = self.config.get("upscaling")
+        return {
+            "input": entry,
+            "model": name,
+            "scale": scale,
+            "tile_size": section["tile_size"],
+            "tile_overlap": section["tile_overlap"],
+        }
+
+    def frame_tasks(self, input_folder, output_folder, stage, name, scale, manifest):
+        """Return the (input path, output path, fingerprint) of each frame to
+        upscale."""
+        use_store = self.config.get("frame_extraction")["format"] == "store"
+        inputs = self.frame_index.frames(input_folder)
+        tasks = []
+        for number in self.frame_index.numbers(input_folder):
+            entry = inputs[str(number)]
+            if use_store:
+                output_path = store_frame_path(output_folder, number)
+            else:
+                output_path = f"{output_folder}/{number}{frame_extension(self.config)}"
+            fingerprint = self.frame_fingerprint(entry, name, scale)
+            if (
+                manifest is not None
+                and manifest.item_is_current(stage, output_path, fingerprint)
+                and self.frame_index.contains(output_path)
+            ):
+                continue
+            tasks.append((f"{input_folder}/{entry[0]}", output_path, fingerprint))
+        return tasks
+
+    def prepare_store(self, input_folder, output_folder, scale):
+        """Create the output FrameStore, unless one of the right shape and size
+        exists, whose frames are kept."""
+        numbers = self.frame_index.numbers(input_folder)
+        first = read_frame(self.frame_index.frame_path(input_folder, numbers[0]))
+        shape = (
+            round(first.shape[0] * scale),
+            round(first.shape[1] * scale),
+        ) + first.shape[2:]
+        path = store_path(output_folder)
+        if os.path.exists(path):
+            store = FrameStore.open(path)
+            store.close()
+            if store.shape == shape and store.count == numbers[-1]:
+                return
+        FrameStore.create(path, shape, numbers[-1]).close()
+        self.frame_index.reset(output_folder)
+
+    def upscale(self, target, manifest=None):
+        """Upscale the frames of a target, or with a manifest of the running
+        "upscale_{target}" stage, only the frames that changed. Return the number of
+        frames written."""
+        section = self.config.get("upscaling")
+        options = section[target]
+        name = model_name(options["model"], options["scale"])
+        stage = f"upscale_{target}"
+        threads = section["threads_per_worker"]
+        # Each worker keeps threads CPUs busy
+        workers = pool_size(
+            section["workers"], pool_size(None, self.max_workers) // threads
+        )
+        frame_format = self.config.get("frame_extraction")["format"]
+        written = 0
+        try:
+            for input_folder, output_folder in TARGET_FOLDERS[target]:
+                input_folder = self.config.get("directories")[input_folder]
+                output_folder = self.config.get("directories")[output_folder]
+                if not self.frame_index.count(input_folder):
+                    self.log.warning(f"Upscaling: no frames in {input_folder}")
+                    continue
+                if frame_format == "store":
+                    self.prepare_store(input_folder, output_folder, options["scale"])
+                tasks = self.frame_tasks(
+                    input_folder, output_folder, stage, name, options["scale"], manifest
+                )
+                self.log.write(
+                    f"Upscaling {len(tasks)} frames of {input_folder} with {name}, "
+                    f"x{options['scale']}, on {workers} workers"
+                )
+                written += self.run(
+                    tasks, name, options["scale"], workers, threads, stage, manifest
+                )
+        finally:
+            # Frames finished before a failure are not redone
+            if manifest is not None:
+                manifest.flush()
+            self.frame_index.save()
+        return written
+
+    def run(self, tasks, name, scale, workers, threads, stage, manifest):
+        if not tasks:
+            return 0
+        section = self.config.get("upscaling")
+        check_model(name, section["models_folder"])
+        tile_size = section["tile_size"]
+        overlap = section["tile_overlap"]
+        batch_size = section["batch_size"]
+        # Enough frames per chunk to fill a batch with their tiles
+        first = read_frame(tasks[0][0])
+        _, windows = tile_windows(first.shape[0], first.shape[1], tile_size, overlap)
+        chunk_size = max(1, math.ceil(batch_size / len(windows)))
+        frame_format = self.config.get("frame_extraction")["format"]
+
+        written = 0
+        with process_pool(
+            workers,
+            initializer=init_worker,
+            initargs=(
+                name,
+                section["models_folder"],
+                scale,
+                tile_size,
+                overlap,
+                batch_size,
+                threads,
+            ),
+        ) as pool:
+            chunks = [
+                tasks[start : start + chunk_size]
+                for start in range(0, len(tasks), chunk_size)
+            ]
+            futures = {
+                pool.submit(
+                    upscale_chunk,
+                    [(input_path, output_path) for input_path, output_path, _ in chunk],
+                    frame_format,
+                ): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                written += future.result()
+                for _, output_path, fingerprint in futures[future]:
+                    self.frame_index.record(output_path)
+                    if manifest is not None:
+                        manifest.record_item(stage, output_path, fingerprint)
+        return written
@@ -1,17 +1,45 @@
+import atexit
+import queue
+import threading
 from datetime import datetime
 import os.path
+from log_utils.profiler import Profiler
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name.upper() for name, value in LEVELS.items()}
 
 
 class Log:
+    # Seconds the writer thread waits for new entries before flushing the file
+    FLUSH_INTERVAL = 1.0
+
     def __init__(self, config):
         """Initialize the log object representing the log file for
         the current project on the current day. Each entry in the log
         file is a line of text prepended with time of writing.
         The log file is located at {projects_folder}/{project_name}/log
+        Stage timings and memory use are recorded through self.profiler
+        (see Profiler) next to the log file.
+
+        Entries below the config's log_level are dropped. Entries that pass
+        are formatted by the caller and handed to a background thread that
+        keeps the log file open and writes them in order, so write does not
+        touch the disk. The file is flushed when the writer is idle, on flush
+        and when the interpreter exits.
         """
         self.config = config
         self.verbose = config.get("verbose")
+        self.level = LEVELS[config.get("log_level")]
         self.date_title = datetime.now().strftime("%d.%m.%Y")
+        self.profiler = Profiler(config, self)
+        self.entries = queue.SimpleQueue()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.registered_close = False
         if not os.path.exists(self.path()):
             self.write(
                 [
@@ -23,24 +51,85 @@ class Log:
                 ]
             )
 
-    def minute_time(self):
-        """Return the current time in the format HH:MM am/pm."""
-        return datetime.now().strftime("%I:%M %p")
+    def entry_time(self):
+        """Return the current time in the format HH:MM:SS am/pm."""
+        return datetime.now().strftime("%I:%M:%S %p")
 
     def path(self):
         """Return the correct path to this log file."""
         return f"{self.config.get('projects_folder')}/{self.config.get('project_name')}/log/{self.date_title}.txt"
 
-    def write(self, message):
-        """Write the message to the log file."""
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def write(self, message, level=INFO):
+        """Write the message, a value or a list of lines, to the log file if level
+        is enabled. A value or line may be a function without arguments returning
+        the value, e.g., lambda: pformat(objects); it is only called if level is
+        enabled."""
+        if level < self.level:
+            return
+        lines = message if isinstance(message, list) else [message]
+        lines = [str(line() if callable(line) else line) for line in lines]
+        if self.verbose:
+            for line in lines:
+                print(line)
+        header = self.entry_time()
+        if level != INFO:
+            header += " " + LEVEL_NAMES.get(level, str(level))
+        self.start_writer()
+        self.entries.put("\n\n" + header + "".join("\n" + line for line in lines))
+
+    def debug(self, message):
+        self.write(message, DEBUG)
+
+    def warning(self, message):
+        self.write(message, WARNING)
+
+    def error(self, message):
+        self.write(message, ERROR)
+
+    def start_writer(self):
+        with self.writer_lock:
+            if self.writer is not None:
+                return
+            self.writer = threading.Thread(target=self.run_writer, daemon=True)
+            self.writer.start()
+            if not self.registered_close:
+                atexit.register(self.close)
+                self.registered_close = True
+
+    def run_writer(self):
+        """Write queued entries to the log file until close puts None."""
         with open(self.path(), "a") as log_file:
-            log_file.write("\n\n" + self.minute_time())
-            if isinstance(message, list):
-                for line in message:
-                    log_file.write("\n" + str(line))
-                    if self.verbose:
-                        print(line)
-            else:
-                log_file.write("\n" + str(message))
-                if self.verbose:
-                    print(message)
+            while True:
+                try:
+                    entry = self.entries.get(timeout=self.FLUSH_INTERVAL)
+                except queue.Empty:
+                    log_file.flush()
+                    continue
+                if entry is None:
+                    break
+                if isinstance(entry, threading.Event):
+                    log_file.flush()
+                    entry.set()
+                    continue
+                log_file.write(entry)
+
+    def flush(self):
+        """Block until every entry written so far is in the log file."""
+        if self.writer is None:
+            return
+        flushed = threading.Event()
+        self.entries.put(flushed)
+        flushed.wait()
+
+    def close(self):
+        """Write the remaining entries and stop the writer thread. Later writes
+        start it again."""
+        with self.writer_lock:
+            if self.writer is None:
+                return
+            self.entries.put(None)
+            self.writer.join()
+            self.writer = None
@@ -0,0 +1,326 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def process_cpu_seconds():
+    """CPU time (user and system) of this whole process and its reaped child
+    processes, e.g., the workers of a finished process pool."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def process_tree_rss_mb():
+    """Current resident set size of this process and all its descendants, in MB,
+    read from /proc. Returns None where there is no /proc."""
+    if not os.path.isdir("/proc/self"):
+        return None
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                # The command name may contain spaces; the fields after it do not
+                fields = stat_file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+    pids = [os.getpid()]
+    rss_pages = 0
+    while pids:
+        pid = pids.pop()
+        pids.extend(parents.get(pid, ()))
+        try:
+            with open(f"/proc/{pid}/statm") as statm_file:
+                rss_pages += int(statm_file.read().split()[1])
+        except OSError:
+            continue
+    return rss_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class RSSSampler:
+    """
+    Samples process_tree_rss_mb on a background thread, every interval seconds,
+    while it is running, and keeps the peak. Unlike ru_maxrss, which is a
+    high-water mark over the whole life of the process, this is the peak of one
+    stage, including its worker processes.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_mb = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while True:
+            rss_mb = process_tree_rss_mb()
+            if rss_mb is None:
+                return
+            self.peak_mb = max(rss_mb, self.peak_mb or 0.0)
+            if self.stopped.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        # One last sample, so a stage shorter than the interval is measured too
+        rss_mb = process_tree_rss_mb()
+        if rss_mb is not None:
+            self.peak_mb = max(rss_mb, self.peak_mb or 0.0)
+
+
+class StageRecord:
+    """
+    Measurements of one run of a pipeline stage.
+
+    The code inside the stage may set frames once it knows how many frames it
+    processed; throughput is derived from it.
+
+    thread_cpu_seconds is the CPU time of the thread that ran the stage, which is
+    the stage's own work even while other batch jobs run concurrently, but not that
+    of its worker threads and processes. process_cpu_seconds is process-wide: it
+    includes the workers reaped during the stage, but also every other thread of
+    the process, e.g., the stages of concurrent batch jobs. peak_rss_mb is the
+    sampled peak RSS of the process and its children during the stage (see
+    RSSSampler), which also includes concurrent jobs.
+    """
+
+    def __init__(self, name, frames=None):
+        self.name = name
+        self.frames = frames
+        self.started = datetime.now().isoformat(timespec="milliseconds")
+        self.wall_seconds = None
+        self.thread_cpu_seconds = None
+        self.process_cpu_seconds = None
+        self.peak_rss_mb = None
+        self.traced_peak_mb = None
+
+    def fps(self):
+        if not self.frames or not self.wall_seconds:
+            return None
+        return self.frames / self.wall_seconds
+
+    def as_dict(self):
+        return {
+            "type": "stage",
+            "stage": self.name,
+            "started": self.started,
+            "wall_seconds": self.wall_seconds,
+            "thread_cpu_seconds": self.thread_cpu_seconds,
+            "process_cpu_seconds": self.process_cpu_seconds,
+            "frames": self.frames,
+            "fps": self.fps(),
+            "peak_rss_mb": self.peak_rss_mb,
+            "traced_peak_mb": self.traced_peak_mb,
+        }
+
+
+class Section:
+    """
+    Accumulated wall and CPU time of a hot loop body, e.g., decoding one frame.
+    Entering and leaving it only reads two clocks, so it can wrap per-frame work.
+    CPU time is that of the calling thread. Not reentrant.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+
+    def __enter__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall_seconds += time.perf_counter() - self.start_wall
+        self.cpu_seconds += time.thread_time() - self.start_cpu
+        self.calls += 1
+
+    def as_dict(self):
+        return {
+            "type": "section",
+            "section": self.name,
+            "calls": self.calls,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "ms_per_call": 1000 * self.wall_seconds / self.calls if self.calls else None,
+        }
+
+
+class NullSection:
+    """Stand-in for Section when profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+NULL_SECTION = NullSection()
+
+
+class Profiler:
+    """
+    Timing and memory instrumentation for the pipeline, written next to the
+    project's log.
+
+    stage is a context manager around a pipeline stage. It records wall time, CPU
+    time of the stage's thread and of the whole process (see StageRecord), frames
+    processed, throughput and the stage's peak RSS, writes them as one JSON line to
+    the profile file ({log folder}/{date}.jsonl) and a human-readable line to the
+    Log.
+
+    section returns a cheap accumulating timer for hot loop bodies (decoding,
+    feature extraction, differencing, compositing, encoding). Sections only see
+    work done in this process, not inside process pool workers.
+
+    summary writes the accumulated sections to the profile file and a table of
+    every stage and section of the run to the Log.
+
+    Config (profiling):
+        enabled: Record stages and sections at all.
+        cprofile_stage: Name of a stage to run under cProfile. The stats are dumped
+            to {log folder}/{stage}-{time}.prof and the top functions are logged.
+        tracemalloc_stage: Name of a stage to run under tracemalloc. The traced
+            peak is added to the stage record and the top allocation sites are
+            logged.
+    """
+
+    TOP_ENTRIES = 20
+
+    def __init__(self, config, log):
+        self.config = config
+        self.log = log
+        self.options = config.get("profiling")
+        self.enabled = self.options["enabled"]
+        self.stages = []
+        self.sections = {}
+
+    def path(self):
+        return os.path.splitext(self.log.path())[0] + ".jsonl"
+
+    def write_record(self, record):
+        with open(self.path(), "a") as profile_file:
+            profile_file.write(json.dumps(record) + "\n")
+
+    def section(self, name):
+        if not self.enabled:
+            return NULL_SECTION
+        if name not in self.sections:
+            self.sections[name] = Section(name)
+        return self.sections[name]
+
+    @contextmanager
+    def stage(self, name, frames=None):
+        """Measure the stage run inside the with block. Yields a StageRecord."""
+        record = StageRecord(name, frames)
+        if not self.enabled:
+            yield record
+            return
+        profile = None
+        if self.options["cprofile_stage"] == name:
+            profile = cProfile.Profile()
+        tracing = self.options["tracemalloc_stage"] == name
+        if tracing:
+            tracemalloc.start()
+        sampler = RSSSampler()
+        start_wall = time.perf_counter()
+        start_thread_cpu = time.thread_time()
+        start_process_cpu = process_cpu_seconds()
+        if profile is not None:
+            profile.enable()
+        try:
+            with sampler:
+                yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+            record.wall_seconds = time.perf_counter() - start_wall
+            record.thread_cpu_seconds = time.thread_time() - start_thread_cpu
+            record.process_cpu_seconds = process_cpu_seconds() - start_process_cpu
+            record.peak_rss_mb = sampler.peak_mb
+            if tracing:
+                snapshot = tracemalloc.take_snapshot()
+                record.traced_peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+                tracemalloc.stop()
+                self.log_allocations(name, snapshot)
+            if profile is not None:
+                self.dump_profile(name, profile)
+            self.stages.append(record)
+            self.write_record(record.as_dict())
+            self.log.write(f"Profile: {self.format_stage(record)}")
+
+    def dump_profile(self, name, profile):
+        log_folder = os.path.dirname(self.log.path())
+        path = f"{log_folder}/{name}-{datetime.now().strftime('%H%M%S')}.prof"
+        profile.dump_stats(path)
+        stats = pstats.Stats(profile).sort_stats("cumulative")
+        rows = []
+        for function, (_, calls, own, cumulative, _) in stats.stats.items():
+            rows.append((cumulative, own, calls, pstats.func_std_string(function)))
+        rows.sort(reverse=True)
+        self.log.write(
+            [f"Profile: cProfile of {name} saved to {path}, top functions:"]
+            + [
+                f"{cumulative:9.3f} s cumulative {own:9.3f} s own {calls:9d} calls  {function}"
+                for cumulative, own, calls, function in rows[: self.TOP_ENTRIES]
+            ]
+        )
+
+    def log_allocations(self, name, snapshot):
+        statistics = snapshot.statistics("lineno")[: self.TOP_ENTRIES]
+        self.log.write(
+            [f"Profile: largest allocations still held at the end of {name}:"]
+            + [str(statistic) for statistic in statistics]
+        )
+
+    def format_stage(self, record):
+        fps = record.fps()
+        peak = record.peak_rss_mb
+        return (
+            f"{record.name:<18}{record.wall_seconds:10.2f}"
+            f"{record.thread_cpu_seconds:10.2f}{record.process_cpu_seconds:10.2f}"
+            f"{record.frames if record.frames is not None else '':>9}"
+            f"{f'{fps:.1f}' if fps is not None else '':>10}"
+            f"{f'{peak:.1f}' if peak is not None else '':>12}"
+        )
+
+    def summary(self):
+        """Write the sections to the profile file and a table of the run to the
+        Log."""
+        if not self.enabled or not (self.stages or self.sections):
+            return
+        for section in self.sections.values():
+            self.write_record(section.as_dict())
+        lines = [
+            "Profile summary:",
+            f"{'stage':<18}{'wall s':>10}{'thread s':>10}{'process s':>10}"
+            f"{'frames':>9}{'fps':>10}{'peak MB':>12}",
+        ]
+        lines += [self.format_stage(record) for record in self.stages]
+        if self.sections:
+            lines.append(
+                f"\n{'section':<18}{'wall s':>10}{'cpu s':>10}{'calls':>9}{'ms/call':>10}"
+            )
+            for section in self.sections.values():
+                lines.append(
+                    f"{section.name:<18}{section.wall_seconds:10.2f}"
+                    f"{section.cpu_seconds:10.2f}{section.calls:9d}"
+                    f"{1000 * section.wall_seconds / max(1, section.calls):10.3f}"
+                )
+        self.log.write(lines)
@@ -8,20 +8,20 @@ import json
 from frame_analysis.keyframe_extractor import KeyFrames
 from project_manager.project import Project
 from config_utils.config import Config
+from image_compositing.composite_validation import CompositeValidator
+from frame_interpolation.frame_interpolator import FrameInterpolator
 from image_compositing.image_layer_blender import Blender
+from image_inpainting.sd_client import InpaintingClient
+from image_upscaling.upscaler import Upscaler
 from log_utils.log import Log
+from project_manager.frame_extractor import derives_alpha_white
+from project_manager.stage_manifest import StageManifest
 
 
 def synchronous_shell_command(command):
-    """Execute a shell command synchronously."""
-    completed_process = None
-    try:
-        completed_process = subprocess.run(
-            command, shell=True, check=True, stdout=subprocess.PIPE
-        )
-    except subprocess.CalledProcessError as error:
-        print(error)
-    return completed_process
+    """Execute a command, given as an argument list, synchronously, without a shell.
+    Return the CompletedProcess; raise CalledProcessError if the command failed."""
+    return subprocess.run(command, check=True, stdout=subprocess.PIPE)
 
 
 def create_proj_folders(path_dict, proj_root):
@@ -39,7 +39,12 @@ def verify_path(prompt):
     return path
 
 
-def create_new_proj(projects_folder, project_name, config):
+def create_new_proj(projects_folder, project_name, config, videos=None):
+    """Create a project folder and config. videos is an optional (background, alpha,
+    alpha white) tuple of video paths; the user is prompted for them if not given.
+    If alpha-white frames are derived from the alpha video (the default), no
+    alpha-white video is needed and one given is ignored."""
+    derive = config["frame_extraction"]["alpha_white"]["source"] == "derived"
     print("Creating new project at: " + f"{projects_folder}/{project_name}")
     create_proj_folders(config["directories"], f"{projects_folder}/{project_name}")
     config["project_name"] = project_name
@@ -49,47 +54,352 @@ def create_new_proj(projects_folder, project_name, config):
             "$project_root$", f"{projects_folder}/{project_name}"
         )
 
-    bg_vid, alpha_vid, alpha_white_vid = (
-        verify_path("Enter the path to the background video: "),
-        verify_path("Enter the path to the alpha video: "),
-        verify_path("Enter the path to the alpha white video: "),
-    )
+    if videos is None:
+        videos = (
+            verify_path("Enter the path to the background video: "),
+            verify_path("Enter the path to the alpha video: "),
+        )
+        if not derive:
+            videos += (verify_path("Enter the path to the alpha white video: "),)
+    bg_vid, alpha_vid = videos[:2]
     shutil.copy(bg_vid, config["directories"]["input_videos"] + "/background.mp4")
     shutil.copy(alpha_vid, config["directories"]["input_videos"] + "/alpha.mp4")
-    shutil.copy(
-        alpha_white_vid, config["directories"]["input_videos"] + "/alpha_white.mp4"
-    )
     config["bg_vid"] = config["directories"]["input_videos"] + "/background.mp4"
     config["alpha_vid"] = config["directories"]["input_videos"] + "/alpha.mp4"
-    config["alpha_white_vid"] = (
-        config["directories"]["input_videos"] + "/alpha_white.mp4"
-    )
+    config["alpha_white_vid"] = None
+    if not derive:
+        shutil.copy(
+            videos[2], config["directories"]["input_videos"] + "/alpha_white.mp4"
+        )
+        config["alpha_white_vid"] = (
+            config["directories"]["input_videos"] + "/alpha_white.mp4"
+        )
     json.dump(
         config, open(f"{projects_folder}/{project_name}/config.json", "w"), indent=4
     )
 
 
+def input_videos(config):
+    videos = [config.get("bg_vid"), config.get("alpha_vid")]
+    if not derives_alpha_white(config):
+        videos.append(config.get("alpha_white_vid"))
+    return videos
+
+
+def extract_parameters(config):
+    return {
+        "format": config.get("frame_extraction")["format"],
+        "alpha_white": config.get("frame_extraction")["alpha_white"]["source"],
+    }
+
+
+def run_extract(project, manifest, alpha_consumer=None):
+    """Run the extract stage, passing the decoded alpha frames to alpha_consumer."""
+    config = project.config
+    manifest.start("extract", input_videos(config), extract_parameters(config))
+    with project.log.profiler.stage("extract"):
+        result = project.extract_input_frames(alpha_consumer)
+    manifest.finish("extract")
+    return result
+
+
+def run_extract_and_analyze(project, manifest, max_workers=None):
+    """Run the analyze stage, and the extract stage with it if every frame is to be
+    extracted and the frame dump is missing or out of date. Return the KeyFrames.
+    max_workers caps the analysis processes."""
+    config, log = project.config, project.log
+    manifest.start(
+        "analyze", [config.get("alpha_vid")], config.get("keyframe_determination")
+    )
+    with log.profiler.stage("analyze") as record:
+        if config.get("frame_extraction")["mode"] == "all" and not manifest.is_current(
+            "extract", input_videos(config), extract_parameters(config)
+        ):
+            # Keyframe analysis runs on the alpha frames decoded by the extraction
+            frames = run_extract(
+                project,
+                manifest,
+                lambda alpha_frames: KeyFrames(
+                    config, log, alpha_frames, max_workers=max_workers
+                ),
+            )
+        else:
+            # Unchanged analyses are loaded from the analysis cache
+            frames = KeyFrames(config, log, max_workers=max_workers)
+        record.frames = frames.get_frame_count()
+    manifest.finish(
+        "analyze", {"keyframe_indices": frames.get_keyframe_original_indices()}
+    )
+    return frames
+
+
+def run_store_keyframes(project, manifest, keyframe_indices):
+    """Run the store_keyframes stage if the keyframes or their videos changed."""
+    config = project.config
+    if derives_alpha_white(config):
+        inputs = [config.get("bg_vid"), config.get("alpha_vid")]
+    else:
+        inputs = [config.get("bg_vid"), config.get("alpha_white_vid")]
+    parameters = {
+        "keyframe_indices": keyframe_indices,
+        "format": config.get("frame_extraction")["format"],
+        "alpha_white": config.get("frame_extraction")["alpha_white"],
+        "upscaled": config.get("upscaling")["original"]["enabled"],
+    }
+    if manifest.is_current("store_keyframes", inputs, parameters):
+        project.log.write("Keyframes are up to date")
+        return
+    manifest.start("store_keyframes", inputs, parameters)
+    # Without a full frame dump only the keyframes are decoded
+    with project.log.profiler.stage("store_keyframes", len(keyframe_indices)):
+        project.store_keyframes(keyframe_indices)
+    manifest.finish("store_keyframes")
+
+
+def run_inpaint(project, manifest, keyframe_indices):
+    """Run the inpaint stage if it is enabled: send the stored keyframes to the SD
+    server and write their output alpha layers. Keyframes already inpainted from
+    the same frames with the same request options are skipped."""
+    config = project.config
+    section = config.get("stable_diffusion")
+    if not section["enabled"]:
+        return
+    manifest.start(
+        "inpaint", (), {"request": section["request"], "resize": section["resize"]}
+    )
+    with project.log.profiler.stage("inpaint", len(keyframe_indices)) as record:
+        record.frames = InpaintingClient(
+            config, project.log, project.frame_index
+        ).inpaint(keyframe_indices, manifest)
+    manifest.finish("inpaint")
+
+
+def ensure_frame_dump(project, manifest):
+    """Run the extract stage if the frame dump is missing or out of date."""
+    config = project.config
+    if not manifest.is_current(
+        "extract", input_videos(config), extract_parameters(config)
+    ):
+        run_extract(project, manifest)
+
+
+def output_fps(config, frames):
+    if config.get("outputFPS") == "auto":
+        return frames.get_fps()
+    return config.get("outputFPS")
+
+
+def run_upscale(project, manifest, target, max_workers=None):
+    """Run the upscale stage of an upscaling target ("original" or
+    "output_composite") if it is enabled. Frames already upscaled from the same
+    input with the same options are skipped. max_workers caps the CPUs the
+    upscaling uses."""
+    config = project.config
+    options = config.get("upscaling")[target]
+    if not options["enabled"]:
+        return
+    name = f"upscale_{target}"
+    parameters = {
+        "scale": options["scale"],
+        "model": options["model"],
+        "tile_size": config.get("upscaling")["tile_size"],
+        "tile_overlap": config.get("upscaling")["tile_overlap"],
+        "format": config.get("frame_extraction")["format"],
+    }
+    manifest.start(name, (), parameters)
+    with project.log.profiler.stage(name) as record:
+        written = record.frames = Upscaler(
+            config, project.log, project.frame_index, max_workers
+        ).upscale(target, manifest)
+    project.log.write(f"Upscaled {written} frames")
+    manifest.finish(name, {"frames_written": written})
+
+
+def run_blend(project, manifest, frames, max_workers=None):
+    """Run the blend stage, recompositing only the keyframe groups that changed.
+    max_workers caps the compositing processes."""
+    config = project.config
+    ensure_frame_dump(project, manifest)
+    manifest.start(
+        "blend",
+        [config.get("bg_vid")],
+        {
+            "format": config.get("frame_extraction")["format"],
+            "upscaled": config.get("upscaling")["original"]["enabled"],
+        },
+    )
+    with project.log.profiler.stage("blend") as record:
+        blender = Blender(
+            config,
+            frames.get_frame_objects(),
+            frames.get_keyframe_objects(),
+            project.frame_index,
+            max_workers,
+        )
+        written = record.frames = blender.blend(manifest)
+    project.log.write(f"Composited {written} frames")
+    manifest.finish("blend", {"frames_written": written})
+
+
+def run_validate(project, manifest, frames, max_workers=None):
+    """Run the validate stage if it is enabled: score the composites on disk against
+    the original clip and flag the keyframe groups that deviate from it. max_workers
+    caps the scoring processes."""
+    config = project.config
+    if not config.get("validation")["enabled"]:
+        return
+    manifest.start("validate", [config.get("alpha_vid")], config.get("validation"))
+    with project.log.profiler.stage("validate", frames.get_frame_count()):
+        report = CompositeValidator(
+            config, project.log, frames, project.frame_index, max_workers
+        ).validate()
+    manifest.finish("validate", {"flagged": report["flagged"]})
+
+
+def run_interpolate(project, manifest, frames, max_workers=None):
+    """Run the interpolate stage if frame interpolation is enabled: fill the gaps
+    left in the composites on disk by deleted keyframe groups and raise the frame
+    rate by fps_increase. Skipped if the composites and options are unchanged.
+    max_workers caps the interpolation processes."""
+    config = project.config
+    options = config.get("upscaling")["video"]["frame_interpolation"]
+    if not options["enabled"]:
+        return
+    interpolator = FrameInterpolator(
+        config, project.log, project.frame_index, max_workers
+    )
+    fps = output_fps(config, frames)
+    parameters = {
+        "fps": fps,
+        "frame_interpolation": options,
+        "format": config.get("frame_extraction")["format"],
+        "upscaled_composite": config.get("upscaling")["output_composite"]["enabled"],
+        "composites": interpolator.input_fingerprint(),
+    }
+    if manifest.is_current("interpolate", (), parameters):
+        project.log.write("Interpolated frames are up to date")
+        return
+    manifest.start("interpolate", (), parameters)
+    with project.log.profiler.stage("interpolate") as record:
+        written = record.frames = interpolator.interpolate(fps)
+    project.log.write(f"Wrote {written} interpolated sequence frames")
+    manifest.finish("interpolate", {"frames_written": written})
+
+
+def streams_output(project):
+    """Whether the output is composited straight into the encoder
+    (stitching.streaming). Validation, output_composite upscaling and frame
+    interpolation work on the composites on disk, so if any of them is enabled,
+    streaming is ignored with a warning and the frames are composited to disk."""
+    config = project.config
+    if not config.get("stitching")["streaming"]:
+        return False
+    upscaling = config.get("upscaling")
+    disk_stages = [
+        name
+        for name, enabled in (
+            ("validation", config.get("validation")["enabled"]),
+            ("upscaling.output_composite", upscaling["output_composite"]["enabled"]),
+            (
+                "upscaling.video.frame_interpolation",
+                upscaling["video"]["frame_interpolation"]["enabled"],
+            ),
+        )
+        if enabled
+    ]
+    if disk_stages:
+        project.log.warning(
+            "stitching.streaming is ignored: "
+            + ", ".join(disk_stages)
+            + " need the composites on disk"
+        )
+        return False
+    return True
+
+
+def run_stitch(project, manifest, frames, streaming=False, max_workers=None):
+    """Run the stitch stage: encode the output video if it is missing or any alpha
+    layer or stitching option changed. With streaming (see streams_output), frames
+    are composited and piped straight into the encoder; otherwise the frames
+    composited to disk by the blend stage are stitched, so run_blend must run
+    first, and run_interpolate too if frame interpolation is enabled. max_workers
+    caps the compositing processes of a streaming stitch."""
+    config = project.config
+    ensure_frame_dump(project, manifest)
+    fps = output_fps(config, frames)
+    interpolation = config.get("upscaling")["video"]["frame_interpolation"]
+    interpolated = interpolation["enabled"] and not streaming
+    if interpolated:
+        fps += interpolation["fps_increase"]
+    raw = not config.get("upscaling")["output_composite"]["enabled"]
+    frames_folder = None
+    if not streaming:
+        frames_folder = project.output_frames_folder(raw, interpolated)
+    alpha_layers = [
+        f"{config.get('directories')['keyframes_output_alpha']}/{keyframe['keyframe_index'] + 1}.png"
+        for keyframe in frames.get_keyframe_objects()
+    ]
+    inputs = [config.get("bg_vid")] + alpha_layers
+    parameters = {
+        "fps": fps,
+        "stitching": dict(config.get("stitching"), streaming=streaming),
+        "format": config.get("frame_extraction")["format"],
+        "upscaled": config.get("upscaling")["original"]["enabled"],
+        "upscaled_composite": config.get("upscaling")["output_composite"]["enabled"],
+        "frame_blending": config.get("frame_blending"),
+        "frame_interpolation": interpolation if interpolated else None,
+        # Changes when frames are written or deleted, e.g., by validation
+        "frames": (
+            project.frame_index.fingerprint(frames_folder)
+            if frames_folder is not None
+            else None
+        ),
+    }
+    if manifest.is_current("stitch", inputs, parameters) and os.path.exists(
+        project.output_video_path()
+    ):
+        project.log.write("Output video is up to date")
+        return
+    manifest.start("stitch", inputs, parameters)
+    with project.log.profiler.stage("stitch") as record:
+        if streaming:
+            blender = Blender(
+                config,
+                frames.get_frame_objects(),
+                frames.get_keyframe_objects(),
+                project.frame_index,
+                max_workers,
+            )
+            record.frames = project.stitch_frames(
+                blender.stream(config.get("stitching")["write_frames"]), fps
+            )
+        else:
+            project.stitch_output_frames(fps, raw=raw, interpolated=interpolated)
+            record.frames = project.frame_index.count(frames_folder)
+    manifest.finish("stitch", {"video": project.output_video_path()})
+
+
 if __name__ == "__main__":
     DEV = True
-    new_project = False
     root = os.getcwd()  # Therefore, launcher must be run from the root directory
     project_name = input("Enter the project name: ")
     config = json.load(open(f"{root}/config/config.json"))
     projects_folder = config["projects_folder"].replace("$root$", root)
     if not os.path.exists(f"{projects_folder}/{project_name}"):
         create_new_proj(projects_folder, project_name, config)
-        new_project = True
 
     proj_config = Config(f"{projects_folder}/{project_name}/config.json")
     proj_log = Log(proj_config)
     project = Project(proj_config, proj_log, synchronous_shell_command)
-    frames = KeyFrames(proj_config, proj_log)
-    keyframe_indices = frames.get_keyframe_original_indices()
-    if new_project:
-        project.extract_input_frames(frames.get_fps())
-        project.store_keyframes(keyframe_indices)
-
-    # !! DO SD here
+    # Stages whose inputs and parameters are unchanged since their last complete
+    # run are skipped, and interrupted stages are rerun.
+    manifest = StageManifest(proj_config)
+    frames = run_extract_and_analyze(project, manifest)
+    if proj_config.get("upscaling")["original"]["enabled"]:
+        ensure_frame_dump(project, manifest)
+        run_upscale(project, manifest, "original")
+    run_store_keyframes(project, manifest, frames.get_keyframe_original_indices())
+    run_inpaint(project, manifest, frames.get_keyframe_original_indices())
 
     if DEV:
         print("cv2 frame analysis:")
@@ -99,16 +409,18 @@ if __name__ == "__main__":
         print(
             "total frames"
             + str(
-                len(
-                    os.listdir(
-                        proj_config.get("directories")["frames_original_background_raw"]
-                    )
+                project.frame_index.count(
+                    proj_config.get("directories")["frames_original_background_raw"]
                 )
             )
         )
 
     if input("Do you want to blend the frames? (y/n): ") == "y":
-        blender = Blender(
-            proj_config, frames.get_frame_objects(), frames.get_keyframe_objects()
-        )
-        blender.blend()
+        streaming = streams_output(project)
+        if not streaming:
+            run_blend(project, manifest, frames)
+            run_validate(project, manifest, frames)
+            run_upscale(project, manifest, "output_composite")
+            run_interpolate(project, manifest, frames)
+        run_stitch(project, manifest, frames, streaming)
+    proj_log.profiler.summary()
@@ -0,0 +1,331 @@
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from project_manager.frame_store import (
+    FrameStore,
+    is_store_frame_path,
+    read_store_frame,
+    store_frame_path,
+    store_path,
+    write_store_frame,
+)
+
+
+# On-disk formats for extracted frames: file extension and cv2.imwrite parameters.
+# "npy" frames are raw BGR arrays written with np.save. "store" extracts whole
+# videos into a FrameStore; frames that must be files (keyframes) are PNG.
+FRAME_FORMATS = {
+    "png": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 3]),
+    "png_fast": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    "npy": (".npy", None),
+    "store": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 3]),
+}
+
+# Decoded alpha frames buffered between the extraction thread and keyframe analysis.
+ALPHA_QUEUE_SIZE = 32
+
+# When extracting selected frames, gaps longer than this many frames are skipped by
+# seeking instead of grabbing (decoding without converting) every frame in between.
+# Seeking restarts decoding at the previous key frame of the stream, so it only pays
+# off for gaps longer than a typical group of pictures.
+SEEK_DISTANCE = 120
+
+
+def alpha_white_lut(threshold, gamma=None):
+    """
+    Return the 256-entry lookup table that turns alpha frame levels into alpha-white
+    mask levels: levels at or below threshold (compression noise in the black
+    background) become 0, and the rest 255, or with gamma set, the level raised to
+    the power 1 / gamma. A very high gamma, as the README suggests, pushes every
+    level of the subject close to white while keeping soft edges.
+    """
+    levels = np.arange(256) / 255
+    if gamma:
+        table = np.round(255 * levels ** (1 / gamma))
+    else:
+        table = np.full(256, 255.0)
+    table[: threshold + 1] = 0
+    return table.astype(np.uint8)
+
+
+def derive_alpha_white(frame, lut):
+    """Return the alpha-white mask of a BGR alpha frame as a grayscale plane: the
+    brightest channel of each pixel mapped through lut. The table is monotonic, so
+    looking up the maximum equals the maximum of the looked up channels."""
+    if frame.ndim == 3:
+        frame = cv2.max(cv2.max(frame[:, :, 0], frame[:, :, 1]), frame[:, :, 2])
+    return cv2.LUT(frame, lut)
+
+
+def derives_alpha_white(config):
+    """Whether alpha-white frames are derived from the alpha video instead of read
+    from an alpha-white video."""
+    return config.get("frame_extraction")["alpha_white"]["source"] == "derived"
+
+
+def config_alpha_white_lut(config):
+    options = config.get("frame_extraction")["alpha_white"]
+    return alpha_white_lut(options["threshold"], options["gamma"])
+
+
+def frame_extension(config):
+    """Return the file extension of the frames extracted for a project."""
+    return FRAME_FORMATS[config.get("frame_extraction")["format"]][0]
+
+
+def write_frame(path, frame, frame_format="png"):
+    """Write a BGR frame to path, which must end in the format's extension, or to a
+    preallocated FrameStore if path is a store frame path."""
+    if is_store_frame_path(path):
+        write_store_frame(path, frame)
+        return
+    parameters = FRAME_FORMATS[frame_format][1]
+    if parameters is None:
+        np.save(path, frame)
+    elif not cv2.imwrite(path, frame, parameters):
+        raise IOError(f"Could not write frame to {path}")
+
+
+def read_frame(path):
+    """Read a frame written by write_frame (or any image cv2 can read) as BGR.
+    Frames in a FrameStore are returned as read-only views."""
+    if is_store_frame_path(path):
+        return read_store_frame(path)
+    if path.endswith(".npy"):
+        return np.load(path)
+    frame = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if frame is None:
+        raise IOError(f"Could not read frame from {path}")
+    return frame
+
+
+def link_or_copy(source, target):
+    """Hardlink source to target, or copy it if they are on different filesystems."""
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class FrameExtractor:
+    """
+    Decodes the project's input videos into frame folders in-process, each video
+    once, on its own thread. Frames are named 1, 2, 3, ... like ffmpeg's %d pattern
+    and written in the format set by frame_extraction.format ("png", "png_fast",
+    "npy" or "store", a single FrameStore file per folder).
+
+    The decoded alpha frames can be handed to a consumer, such as KeyFrames, so the
+    analysis reuses the decode. extract_keyframes decodes only the background and
+    alpha-white keyframes. Derived alpha-white frames (frame_extraction.alpha_white
+    "derived") are made from the alpha frames. Frames written are recorded in the
+    FrameIndex, if given; the caller saves it.
+    """
+
+    def __init__(self, config, log, frame_index=None):
+        self.config = config
+        self.log = log
+        self.frame_index = frame_index
+        self.frame_format = self.config.get("frame_extraction")["format"]
+
+    def record(self, path):
+        if self.frame_index is not None:
+            self.frame_index.record(path)
+
+    def extract_video(self, video_path, output_folder, on_frame=None):
+        """Decode every frame of a video into output_folder. If on_frame is given,
+        it is called with each decoded frame in order. Return the frame count."""
+        extension = FRAME_FORMATS[self.frame_format][0]
+        video_capture = cv2.VideoCapture(video_path)
+        if not video_capture.isOpened():
+            raise IOError(f"Could not open video {video_path}")
+        if self.frame_index is not None:
+            self.frame_index.reset(output_folder)
+        store = None
+        frame_count = 0
+        try:
+            while True:
+                ret, frame = video_capture.read()
+                if not ret:
+                    break
+                frame_count += 1
+                if self.frame_format == "store":
+                    if store is None:
+                        store = FrameStore.create(
+                            store_path(output_folder), frame.shape
+                        )
+                    store.append(frame)
+                    path = store_frame_path(output_folder, frame_count)
+                else:
+                    path = f"{output_folder}/{frame_count}{extension}"
+                    write_frame(path, frame, self.frame_format)
+                self.record(path)
+                if on_frame is not None:
+                    on_frame(frame)
+        finally:
+            video_capture.release()
+            if store is not None:
+                store.close()
+        return frame_count
+
+    def extract_frames(
+        self, video_path, frame_numbers, output_folder, transform=None
+    ):
+        """
+        Decode only the frames with the given (1-based) numbers into output_folder.
+
+        The numbers are visited in sorted order: short gaps are skipped with grab()
+        and long gaps by seeking, so each frame of the video is decoded at most once.
+        Numbers past the end of the video are ignored. If transform is given, it is
+        applied to each frame before it is written. Return the number of frames
+        written.
+        """
+        extension = FRAME_FORMATS[self.frame_format][0]
+        video_capture = cv2.VideoCapture(video_path)
+        if not video_capture.isOpened():
+            raise IOError(f"Could not open video {video_path}")
+        written = 0
+        # Position of the frame the next read() returns
+        position = 0
+        try:
+            for number in sorted(set(frame_numbers)):
+                target = number - 1
+                if target - position > SEEK_DISTANCE:
+                    video_capture.set(cv2.CAP_PROP_POS_FRAMES, target)
+                    position = target
+                while position < target and video_capture.grab():
+                    position += 1
+                if position < target:
+                    break
+                ret, frame = video_capture.read()
+                if not ret:
+                    break
+                position += 1
+                if transform is not None:
+                    frame = transform(frame)
+                path = f"{output_folder}/{number}{extension}"
+                write_frame(path, frame, self.frame_format)
+                self.record(path)
+                written += 1
+        finally:
+            video_capture.release()
+        return written
+
+    def extract_keyframes(self, keyframe_numbers):
+        """Decode the background and alpha-white keyframes into the keyframe
+        folders, both videos concurrently."""
+        directories = self.config.get("directories")
+        jobs = {
+            "background": (
+                self.config.get("bg_vid"),
+                directories["keyframes_original_background"],
+            ),
+            "alpha white": (
+                self.config.get("alpha_white_vid"),
+                directories["keyframes_original_alpha_white_out"],
+            ),
+        }
+        transforms = {}
+        if derives_alpha_white(self.config):
+            lut = config_alpha_white_lut(self.config)
+            jobs["alpha white"] = (
+                self.config.get("alpha_vid"),
+                directories["keyframes_original_alpha_white_out"],
+            )
+            transforms["alpha white"] = lambda frame: derive_alpha_white(frame, lut)
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = {
+                name: pool.submit(
+                    self.extract_frames,
+                    video_path,
+                    keyframe_numbers,
+                    output_folder,
+                    transforms.get(name),
+                )
+                for name, (video_path, output_folder) in jobs.items()
+            }
+            for name, future in futures.items():
+                self.log.write(f"Extracted {future.result()} {name} keyframes")
+
+    def extract_input_frames(self, alpha_consumer=None):
+        """
+        Extract the frames of the background, alpha and alpha-white videos
+        concurrently. Derived alpha-white frames are made per keyframe by
+        Project.store_keyframes instead.
+
+        If alpha_consumer is given, it is called on the calling thread with an
+        iterator over the decoded alpha frames while the extraction runs, and its
+        return value is returned. The consumer may stop iterating early; the
+        remaining alpha frames are still written to disk.
+        """
+        directories = self.config.get("directories")
+        jobs = {
+            "background": (
+                self.config.get("bg_vid"),
+                directories["frames_original_background_raw"],
+            ),
+            "alpha": (
+                self.config.get("alpha_vid"),
+                directories["frames_original_alpha_raw"],
+            ),
+            "alpha white": (
+                self.config.get("alpha_white_vid"),
+                directories["frames_original_alpha_white_out"],
+            ),
+        }
+        if derives_alpha_white(self.config):
+            del jobs["alpha white"]
+        alpha_frames = queue.Queue(maxsize=ALPHA_QUEUE_SIZE)
+        consumer_done = threading.Event()
+        end_of_video = object()
+
+        def hand_over(frame):
+            # Blocks while the consumer is behind, but never after it has finished.
+            while not consumer_done.is_set():
+                try:
+                    alpha_frames.put(frame, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def extract_alpha(video_path, output_folder):
+            try:
+                return self.extract_video(video_path, output_folder, hand_over)
+            finally:
+                hand_over(end_of_video)
+
+        def iterate_alpha_frames():
+            while True:
+                frame = alpha_frames.get()
+                if frame is end_of_video:
+                    return
+                yield frame
+
+        result = None
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = {}
+            for name, (video_path, output_folder) in jobs.items():
+                self.log.write(
+                    [f"Extracting {name} frames:", video_path, "to", output_folder]
+                )
+                if name == "alpha" and alpha_consumer is not None:
+                    futures[name] = pool.submit(
+                        extract_alpha, video_path, output_folder
+                    )
+                else:
+                    futures[name] = pool.submit(
+                        self.extract_video, video_path, output_folder
+                    )
+            try:
+                if alpha_consumer is not None:
+                    result = alpha_consumer(iterate_alpha_frames())
+            finally:
+                consumer_done.set()
+            for name, future in futures.items():
+                self.log.write(f"Extracted {future.result()} {name} frames")
+        return result
@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import threading
+from project_manager.frame_store import (
+    STORE_NAME,
+    FrameStore,
+    is_store_frame_path,
+    split_store_frame_path,
+    store_path,
+)
+
+
+def frame_number(name):
+    """Return the frame number of a frame file name such as "12.png"."""
+    return int(name.split(".")[0])
+
+
+def path_frame_number(path):
+    """Return the frame number of a frame path, or of a store frame path."""
+    if is_store_frame_path(path):
+        return split_store_frame_path(path)[1]
+    return frame_number(os.path.basename(path))
+
+
+class FrameIndex:
+    """
+    Index of the numbered frame files (1.png, 2.png, ...) in a project's frame
+    folders, kept in frame-index.json in the project folder.
+
+    For each folder the index maps frame numbers to file name, size and
+    modification time. Stages that write frames record them as they go, so stages
+    that read frames resolve paths and counts from the index instead of listing and
+    sorting directories with many thousands of files.
+
+    The first time a folder is read in a process, its modification time is compared
+    with the one recorded when the index was last saved. If they differ (files were
+    added or removed by something else, e.g., an external upscaler) or the folder
+    was never indexed, the folder is scanned once and its entry rebuilt. Otherwise
+    each frame file's size and modification time are checked, since overwriting a
+    file in place does not change the folder's modification time (see verify).
+
+    Frames in a folder's FrameStore are indexed under their store frame paths'
+    names ("frames.store#12"), with the store's modification time and no size. A
+    store takes precedence over numbered files left in the same folder by an
+    earlier run with another format. A store keeps the slots of deleted frames, so
+    the numbers of discarded store frames are kept in the folder's entry, and
+    scanning the folder again does not bring them back until they are recorded.
+
+    record may be called from several threads. Call save once a stage is done.
+
+    Attributes:
+        path (str): Path of the index file.
+        folders (dict): Folder path to {"mtime_ns": ..., "frames": {number: [name,
+            size, mtime_ns]}, "discarded": [number, ...]}. Frame numbers are
+            strings, as they read back from JSON.
+    """
+
+    def __init__(self, config):
+        self.path = (
+            config.get("projects_folder")
+            + "/"
+            + config.get("project_name")
+            + "/frame-index.json"
+        )
+        self.lock = threading.Lock()
+        # Folders checked against the disk, or written, in this process
+        self.verified = set()
+        self.folders = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as index_file:
+            return json.load(index_file)
+
+    def save(self):
+        """Write the index atomically, recording each folder's modification time."""
+        with self.lock:
+            for folder, entry in self.folders.items():
+                if os.path.isdir(folder):
+                    entry["mtime_ns"] = os.stat(folder).st_mtime_ns
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as index_file:
+                json.dump(self.folders, index_file)
+            os.replace(temporary_path, self.path)
+
+    def scan(self, folder):
+        """Rebuild a folder's entry from the files in it."""
+        frames = {}
+        discarded = self.folders.get(folder, {}).get("discarded", [])
+        if os.path.isdir(folder):
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if not entry.name.split(".")[0].isdigit():
+                        continue
+                    stat = entry.stat()
+                    frames[str(frame_number(entry.name))] = [
+                        entry.name,
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                    ]
+            if os.path.exists(store_path(folder)):
+                store = FrameStore.open(store_path(folder))
+                mtime_ns = os.stat(store.path).st_mtime_ns
+                for number in range(1, store.count + 1):
+                    if number not in discarded:
+                        frames[str(number)] = [
+                            f"{STORE_NAME}#{number}",
+                            None,
+                            mtime_ns,
+                        ]
+                store.close()
+        self.folders[folder] = {
+            "mtime_ns": None,
+            "frames": frames,
+            "discarded": discarded,
+        }
+
+    def verify(self, folder):
+        """
+        Check a folder's entry against the disk. Return False if the folder must be
+        scanned again: it was never indexed, or files were added or removed.
+
+        Frame files overwritten in place get their new size and modification time.
+        Slots of a store cannot be told apart, so if the store was written after
+        its last recorded frame, all its frames get the store's modification time.
+        """
+        entry = self.folders.get(folder)
+        if (
+            entry is None
+            or not os.path.isdir(folder)
+            or entry["mtime_ns"] != os.stat(folder).st_mtime_ns
+        ):
+            return False
+        store_frames = []
+        for frame in entry["frames"].values():
+            name, size, mtime_ns = frame
+            if is_store_frame_path(name):
+                store_frames.append(frame)
+                continue
+            try:
+                stat = os.stat(f"{folder}/{name}")
+            except FileNotFoundError:
+                return False
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                frame[1:] = [stat.st_size, stat.st_mtime_ns]
+        if store_frames:
+            try:
+                store_mtime_ns = os.stat(store_path(folder)).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if store_mtime_ns > max(frame[2] for frame in store_frames):
+                for frame in store_frames:
+                    frame[2] = store_mtime_ns
+        return True
+
+    def frames(self, folder):
+        """Return the frame entries of a folder, scanning it if the index is out of
+        date."""
+        with self.lock:
+            if folder not in self.verified:
+                if not self.verify(folder):
+                    self.scan(folder)
+                self.verified.add(folder)
+            return self.folders[folder]["frames"]
+
+    def reset(self, folder):
+        """Forget a folder's frames, e.g., before it is extracted again."""
+        with self.lock:
+            self.folders[folder] = {"mtime_ns": None, "frames": {}}
+            self.verified.add(folder)
+
+    def record(self, path):
+        """Add or update the frame file, or store frame, at path, which has just
+        been written."""
+        if is_store_frame_path(path):
+            file_path, number = split_store_frame_path(path)
+        else:
+            file_path, number = path, frame_number(os.path.basename(path))
+        folder, name = os.path.split(path)
+        stat = os.stat(file_path)
+        with self.lock:
+            if folder not in self.folders:
+                self.folders[folder] = {"mtime_ns": None, "frames": {}}
+            entry = self.folders[folder]
+            entry["frames"][str(number)] = [
+                name,
+                None if file_path != path else stat.st_size,
+                stat.st_mtime_ns,
+            ]
+            if number in entry.get("discarded", ()):
+                entry["discarded"].remove(number)
+
+    def discard(self, path):
+        """Forget the frame file, or store frame, at path, e.g., after deleting it."""
+        folder = os.path.dirname(path)
+        number = path_frame_number(path)
+        # Read first, so that the folder is not scanned again afterwards
+        self.frames(folder)
+        with self.lock:
+            entry = self.folders[folder]
+            entry["frames"].pop(str(number), None)
+            if is_store_frame_path(path):
+                discarded = entry.setdefault("discarded", [])
+                if number not in discarded:
+                    discarded.append(number)
+
+    def contains(self, path):
+        """Whether the frame file, or store frame, at path is indexed."""
+        return str(path_frame_number(path)) in self.frames(os.path.dirname(path))
+
+    def fingerprint(self, folder):
+        """Return a hash of a folder's frame entries, which changes when any frame
+        in it is written or deleted."""
+        frames = self.frames(folder)
+        return hashlib.sha1(
+            json.dumps(frames, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def numbers(self, folder):
+        """Return the frame numbers in a folder, in order."""
+        return sorted(int(number) for number in self.frames(folder))
+
+    def count(self, folder):
+        return len(self.frames(folder))
+
+    def frame_path(self, folder, number):
+        """Return the path of a frame in a folder, or None if it is not there."""
+        entry = self.frames(folder).get(str(number))
+        if entry is None:
+            return None
+        return f"{folder}/{entry[0]}"
+
+    def frame_paths(self, folder):
+        """Return the paths of the frames in a folder, in frame order."""
+        frames = self.frames(folder)
+        return [f"{folder}/{frames[str(number)][0]}" for number in self.numbers(folder)]
@@ -0,0 +1,240 @@
+import os
+import struct
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+# File name of the store inside a frame folder
+STORE_NAME = "frames.store"
+# Header: magic, version, height, width, channels, frame count. The frames follow
+# at HEADER_SIZE, so frame n (1-based) starts at HEADER_SIZE + (n - 1) * frame size.
+STORE_MAGIC = b"FRMSTORE"
+STORE_VERSION = 1
+HEADER_FORMAT = "<8sIIIIQ"
+HEADER_SIZE = 64
+# Stores each process keeps open for read_store_frame and write_store_frame
+STORE_CACHE_SIZE = 8
+
+
+def store_path(folder):
+    return f"{folder}/{STORE_NAME}"
+
+
+def store_frame_path(folder, number):
+    """Return the path that addresses frame number (1-based) of a folder's store,
+    e.g., frames/original/background/raw/frames.store#12."""
+    return f"{store_path(folder)}#{number}"
+
+
+def is_store_frame_path(path):
+    return f"{STORE_NAME}#" in path
+
+
+def split_store_frame_path(path):
+    """Return the store path and frame number of a store frame path."""
+    path, number = path.rsplit("#", 1)
+    return path, int(number)
+
+
+class FrameStore:
+    """
+    Fixed-shape uint8 frames in a single file, the alternative to a folder of
+    numbered image files used when frame_extraction.format is "store".
+
+    The file holds a small header and the raw BGR frames back to back, so a frame
+    is read with an offset calculation instead of opening and decoding a file.
+    Frames are read as views of a read-only memory map, and written with pwrite,
+    so several processes can fill different frames of a preallocated store.
+
+    Stages address stored frames with store frame paths ("{folder}/frames.store#12",
+    see store_frame_path), which read_frame and write_frame in frame_extractor
+    understand, so code that passes frame paths around does not need to know about
+    stores. export writes frames out as images where files are needed, e.g., the
+    keyframes for Stable Diffusion.
+
+    Attributes:
+        path (str): Path of the store file.
+        shape (tuple): (height, width, channels) of every frame.
+        count (int): Number of frames in the store.
+    """
+
+    def __init__(self, path, shape, count, writable=False):
+        self.path = path
+        self.shape = tuple(shape)
+        self.count = count
+        self.frame_size = int(np.prod(self.shape))
+        self.file = open(path, "r+b" if writable else "rb")
+        self.map = None
+
+    @staticmethod
+    def write_header(store_file, shape, count):
+        header = struct.pack(HEADER_FORMAT, STORE_MAGIC, STORE_VERSION, *shape, count)
+        os.pwrite(store_file.fileno(), header.ljust(HEADER_SIZE, b"\0"), 0)
+
+    @classmethod
+    def create(cls, path, shape, count=0):
+        """Create an empty store with room for count frames, replacing any store at
+        path. Unwritten frames read as black."""
+        with open(path, "wb") as store_file:
+            cls.write_header(store_file, shape, count)
+            store_file.truncate(HEADER_SIZE + count * int(np.prod(shape)))
+        return cls(path, shape, count, writable=True)
+
+    @staticmethod
+    def read_header(path):
+        """Return the (height, width, channels) shape and frame count of the store
+        at path."""
+        with open(path, "rb") as store_file:
+            header = store_file.read(struct.calcsize(HEADER_FORMAT))
+        magic, version, height, width, channels, count = struct.unpack(
+            HEADER_FORMAT, header
+        )
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise IOError(f"{path} is not a frame store")
+        return (height, width, channels), count
+
+    @classmethod
+    def open(cls, path, writable=False):
+        shape, count = cls.read_header(path)
+        return cls(path, shape, count, writable)
+
+    def refresh(self):
+        """Read the frame count from the header again, e.g., after another process
+        added frames. Return False if the store was recreated with another frame
+        shape, in which case it must be opened again."""
+        shape, count = self.read_header(self.path)
+        if shape != self.shape:
+            return False
+        if count != self.count:
+            self.count = count
+            self.map = None
+        return True
+
+    def offset(self, number):
+        return HEADER_SIZE + (number - 1) * self.frame_size
+
+    def write(self, number, frame):
+        """Write frame number (1-based), which must be within the store."""
+        if not 1 <= number <= self.count:
+            raise IndexError(f"Frame {number} is outside {self.path}")
+        if frame.shape != self.shape:
+            raise ValueError(
+                f"Frame of shape {frame.shape} does not fit {self.path} {self.shape}"
+            )
+        os.pwrite(
+            self.file.fileno(),
+            memoryview(np.ascontiguousarray(frame, dtype=np.uint8)).cast("B"),
+            self.offset(number),
+        )
+
+    def append(self, frame):
+        """Add a frame after the last one. The header's count is updated by
+        close."""
+        self.count += 1
+        os.pwrite(
+            self.file.fileno(),
+            memoryview(np.ascontiguousarray(frame, dtype=np.uint8)).cast("B"),
+            self.offset(self.count),
+        )
+
+    def frames(self):
+        """Return all frames as a read-only (count, height, width, channels)
+        array backed by the file."""
+        if self.map is None:
+            self.map = np.memmap(
+                self.path,
+                dtype=np.uint8,
+                mode="r",
+                offset=HEADER_SIZE,
+                shape=(self.count,) + self.shape,
+            )
+        return self.map
+
+    def frame(self, number):
+        """Return frame number (1-based) as a read-only view."""
+        if not 1 <= number <= self.count:
+            raise IndexError(f"Frame {number} is outside {self.path}")
+        return self.frames()[number - 1]
+
+    def export(self, folder, numbers=None, extension=".png"):
+        """Write frames (all, or the given numbers) to folder as {number}{extension}
+        image files. Return their paths."""
+        paths = []
+        for number in numbers if numbers is not None else range(1, self.count + 1):
+            path = f"{folder}/{number}{extension}"
+            if not cv2.imwrite(path, np.asarray(self.frame(number))):
+                raise IOError(f"Could not write frame to {path}")
+            paths.append(path)
+        return paths
+
+    def close(self):
+        if self.file.writable():
+            self.write_header(self.file, self.shape, self.count)
+        self.release()
+
+    def release(self):
+        """Close the file without writing the header. Views returned by frame
+        stay readable."""
+        self.map = None
+        self.file.close()
+
+
+# (path, writable) -> (FrameStore, inode, size), least recently used first
+open_stores = OrderedDict()
+
+
+def open_cached_store(path, writable=False):
+    """
+    FrameStore.open, cached per process by path, so frames are read and written
+    without opening the store each time.
+
+    A store whose file was replaced (another inode) is opened again, and its header
+    is read again when the file's size changes. Stores evicted from the cache are
+    released.
+    """
+    stat = os.stat(path)
+    key = (path, writable)
+    entry = open_stores.pop(key, None)
+    store = None
+    if entry is not None:
+        store, inode, size = entry
+        if inode != stat.st_ino or (size != stat.st_size and not store.refresh()):
+            store.release()
+            store = None
+    if store is None:
+        store = FrameStore.open(path, writable)
+    open_stores[key] = (store, stat.st_ino, stat.st_size)
+    while len(open_stores) > STORE_CACHE_SIZE:
+        open_stores.popitem(last=False)[1][0].release()
+    return store
+
+
+def release_cached_stores():
+    """Release every store opened by open_cached_store."""
+    while open_stores:
+        open_stores.popitem()[1][0].release()
+
+
+def open_store_frame(path, writable=False):
+    """Return the cached store and frame number addressed by a store frame path. A
+    frame past the store's count is looked up in the header again, as the store may
+    have grown."""
+    path, number = split_store_frame_path(path)
+    store = open_cached_store(path, writable)
+    if number > store.count and not store.refresh():
+        open_stores.pop((path, writable))
+        store.release()
+        store = open_cached_store(path, writable)
+    return store, number
+
+
+def read_store_frame(path):
+    """Read a frame addressed by a store frame path, as a read-only view."""
+    store, number = open_store_frame(path)
+    return store.frame(number)
+
+
+def write_store_frame(path, frame):
+    """Write a frame to the preallocated store addressed by a store frame path."""
+    store, number = open_store_frame(path, writable=True)
+    store.write(number, frame)
@@ -0,0 +1,30 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Forking a process that runs threads (e.g., a batch's jobs) can copy a lock held
+# by another thread into the child, so workers are started from a fork server
+START_METHOD = (
+    "forkserver"
+    if "forkserver" in multiprocessing.get_all_start_methods()
+    else "spawn"
+)
+
+
+def pool_size(workers, max_workers=None):
+    """Return the number of processes of a pool: workers (one per CPU if null), no
+    more than max_workers if given."""
+    workers = workers or os.cpu_count() or 1
+    if max_workers is not None:
+        workers = min(workers, max_workers)
+    return max(1, workers)
+
+
+def process_pool(workers, **kwargs):
+    """Return a ProcessPoolExecutor of workers processes, started from a fork
+    server (or spawned where there is none). kwargs are passed to it."""
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(START_METHOD),
+        **kwargs,
+    )
@@ -1,14 +1,34 @@
 import os
 import os.path
-import shutil
+import subprocess
+from project_manager.frame_extractor import (
+    FrameExtractor,
+    config_alpha_white_lut,
+    derive_alpha_white,
+    derives_alpha_white,
+    frame_extension,
+    link_or_copy,
+    read_frame,
+    write_frame,
+)
+from project_manager.frame_index import FrameIndex
+from project_manager.frame_store import FrameStore, is_store_frame_path, store_path
+from project_manager.video_encoder import VideoEncoder
 
 
 class Project:
     def __init__(self, config, log, shell_command_handler):
-        """Initialize the project object."""
+        """Initialize the project object. Frame folders are listed through the
+        project's FrameIndex."""
         self.config = config
         self.shell_command_handler = shell_command_handler
         self.log = log
+        self.frame_index = FrameIndex(config)
+        if config.get("upscaling")["output_alpha_channel"]["enabled"]:
+            # Nothing upscales or outputs the alpha channel yet
+            log.warning(
+                "Upscaling: output_alpha_channel is not supported, it is ignored"
+            )
 
     def path(self):
         """Return the current path to this project."""
@@ -16,54 +36,186 @@ class Project:
             self.config.get("projects_folder") + "/" + self.config.get("project_name")
         )
 
-    def extract_input_frames(self, fps):
-        """Extract the input frames from the original and masked videos."""
-        system_calls = [
-            f"ffmpeg -i {self.config.get('bg_vid')} -vf fps={fps} {self.config.get('directories')['frames_original_background_raw']}/%d.png",
-            f"ffmpeg -i {self.config.get('alpha_vid')} -vf fps={fps} {self.config.get('directories')['frames_original_alpha_raw']}/%d.png",
-            f"ffmpeg -i {self.config.get('alpha_white_vid')} -vf fps={fps} {self.config.get('directories')['frames_original_alpha_white_out']}/%d.png",
-        ]
-        for call in system_calls:
-            self.log.write(["System call:", call])
-            completed_process = self.shell_command_handler(call)
-            self.log.write(["Process stdout:", completed_process.stdout.decode("utf-8")])
+    def extract_input_frames(self, alpha_consumer=None):
+        """Extract the input frames from the original and masked videos. The three
+        videos are decoded concurrently, once each. If alpha_consumer is given, it is
+        called with an iterator over the decoded alpha frames (e.g., to run keyframe
+        analysis on the same decode) and its return value is returned."""
+        try:
+            return FrameExtractor(
+                self.config, self.log, self.frame_index
+            ).extract_input_frames(alpha_consumer)
+        finally:
+            self.frame_index.save()
+
+    def has_frame_dump(self):
+        """Whether background frames were already extracted to disk. The dump may
+        be partial, e.g., if an extraction was interrupted."""
+        return bool(
+            self.frame_index.count(
+                self.config.get("directories")["frames_original_background_raw"]
+            )
+        )
 
     def store_keyframes(self, keyframe_indices):
+        """Put the background and alpha-white keyframes into the keyframe folders.
+
+        If frames were already extracted, the keyframes are hardlinked from the
+        frame folders. Otherwise, and for keyframes missing from a partial frame
+        dump, only the keyframes are decoded from the videos. Derived alpha-white
+        keyframes are made from the alpha keyframes."""
         if self.config.get("upscaling")["original"]["enabled"]:
             scale = "upscaled"
         else:
             scale = "raw"
+        keyframe_indices = sorted(set(keyframe_indices))
 
-        for i in range(
-            len(
-                os.listdir(
-                    self.config.get("directories")[
-                        f"frames_original_background_{scale}"
-                    ]
-                )
+        if not self.has_frame_dump():
+            FrameExtractor(self.config, self.log, self.frame_index).extract_keyframes(
+                keyframe_indices
             )
-        ):
-            if i in keyframe_indices:
-                shutil.copy(
-                    self.config.get("directories")[
-                        f"frames_original_background_{scale}"
-                    ]
-                    + f"/{i}.png",
-                    f"{self.config.get('directories')['keyframes_original_background']}/{i}.png",
-                )
-                shutil.copy(
-                    self.config.get("directories")[f"frames_original_alpha_white_out"]
-                    + f"/{i}.png",
-                    f"{self.config.get('directories')['keyframes_original_alpha_white_out']}/{i}.png",
-                )
+            self.frame_index.save()
+            return
 
-    def stitch_output_frames(self, fps=30, verbose=False, raw=False):
-        """Stitch the output frames together into a video."""
-        system_call = f"ffmpeg -r {fps} -i {self.project_path}/frames/output/{'raw' if raw else 'upscaled'}/%d.png -vcodec libx264 -crf 25 -pix_fmt yuv420p {self.project_path}/output.mp4"
-        self.log.write(f"System call: {system_call}")
+        derive = derives_alpha_white(self.config)
+        folders = [
+            (
+                self.config.get("directories")[f"frames_original_background_{scale}"],
+                self.config.get("directories")["keyframes_original_background"],
+                None,
+            ),
+            (
+                self.config.get("directories")[
+                    "frames_original_alpha_raw"
+                    if derive
+                    else "frames_original_alpha_white_out"
+                ],
+                self.config.get("directories")["keyframes_original_alpha_white_out"],
+                config_alpha_white_lut(self.config) if derive else None,
+            ),
+        ]
+        missing = {
+            i
+            for i in keyframe_indices
+            if any(
+                self.frame_index.frame_path(source_folder, i) is None
+                for source_folder, _, _ in folders
+            )
+        }
+        if missing:
+            self.log.warning(
+                f"{len(missing)} keyframes are missing from the frame dump, "
+                "decoding them from the videos"
+            )
+            FrameExtractor(self.config, self.log, self.frame_index).extract_keyframes(
+                missing
+            )
+        for source_folder, keyframe_folder, lut in folders:
+            for i in keyframe_indices:
+                if i in missing:
+                    continue
+                source = self.frame_index.frame_path(source_folder, i)
+                if lut is not None:
+                    target = f"{keyframe_folder}/{i}{frame_extension(self.config)}"
+                    write_frame(
+                        target,
+                        derive_alpha_white(read_frame(source), lut),
+                        self.config.get("frame_extraction")["format"],
+                    )
+                elif is_store_frame_path(source):
+                    # Stable Diffusion needs image files
+                    target = f"{keyframe_folder}/{i}{frame_extension(self.config)}"
+                    write_frame(target, read_frame(source))
+                else:
+                    target = f"{keyframe_folder}/{os.path.basename(source)}"
+                    link_or_copy(source, target)
+                self.frame_index.record(target)
+        self.frame_index.save()
+
+    def output_video_path(self):
+        return f"{self.config.get('directories')['output_videos']}/output.mp4"
+
+    def output_frames_folder(self, raw=False, interpolated=False):
+        """Return the folder of the frames stitch_output_frames stitches."""
+        if interpolated:
+            return self.config.get("directories")["frames_composite_interpolated"]
+        return self.config.get("directories")[
+            f"frames_composite_all_{'raw' if raw else 'upscaled'}"
+        ]
+
+    def stitch_output_frames(
+        self, fps=30, verbose=False, raw=False, interpolated=False
+    ):
+        """Stitch the composited frames on disk together into a video. With
+        interpolated, the frames of the interpolate stage are stitched instead."""
+        frames_folder = self.output_frames_folder(raw, interpolated)
+        if self.config.get("frame_extraction")["format"] == "store":
+            # Composites in a FrameStore are piped to the encoder from the memory
+            # map, skipping frames that were never composited
+            store = FrameStore.open(store_path(frames_folder))
+            try:
+                self.stitch_frames(
+                    (store.frame(n) for n in self.frame_index.numbers(frames_folder)),
+                    fps,
+                )
+            finally:
+                store.close()
+            return
+        numbers = self.frame_index.numbers(frames_folder)
+        if frame_extension(self.config) != ".png" or numbers != list(
+            range(1, len(numbers) + 1)
+        ):
+            # ffmpeg cannot read other frame formats, e.g., npy, and its %d pattern
+            # stops at the first missing frame, e.g., of a keyframe group deleted
+            # by validation, so those frames are piped instead
+            frame_paths = self.frame_index.frame_paths(frames_folder)
+            self.stitch_frames((read_frame(path) for path in frame_paths), fps)
+            return
+        # An argument list, so paths with spaces or shell characters are passed
+        # through as they are
+        system_call = [
+            "ffmpeg",
+            "-y",
+            "-r",
+            str(fps),
+            "-i",
+            f"{frames_folder}/%d.png",
+            "-vcodec",
+            "libx264",
+            "-crf",
+            str(self.config.get("stitching")["crf"]),
+            "-pix_fmt",
+            "yuv420p",
+            self.output_video_path(),
+        ]
+        self.log.write(f"System call: {subprocess.list2cmdline(system_call)}")
         if verbose:
-            print(f"System call: {system_call}")
+            print(f"System call: {subprocess.list2cmdline(system_call)}")
         completed_process = self.shell_command_handler(system_call)
         self.log.write(f"Process stdout: {completed_process.stdout}")
         if verbose:
             print(f"{completed_process.stdout}")
+
+    def stitch_frames(self, frames, fps):
+        """Encode an iterable of BGR frames, in order, straight into the output video
+        through a single ffmpeg process, without writing them to disk first. Return
+        the number of frames encoded."""
+        # Time spent waiting for the next frame is time spent producing it, e.g.,
+        # compositing it
+        produce = self.log.profiler.section("composite")
+        encode = self.log.profiler.section("encode")
+        frames = iter(frames)
+        with VideoEncoder(
+            self.output_video_path(), fps, self.config.get("stitching")["crf"]
+        ) as encoder:
+            while True:
+                with produce:
+                    frame = next(frames, None)
+                if frame is None:
+                    break
+                with encode:
+                    encoder.write(frame)
+        self.log.write(
+            f"Encoded {encoder.frame_count} frames to {self.output_video_path()}"
+        )
+        return encoder.frame_count
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+
+# Item fingerprints are written out in batches of this many, rather than rewriting
+# the manifest for every item
+ITEM_SAVE_INTERVAL = 64
+
+
+def hash_file(path):
+    """Return the SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalize(value):
+    """Return value as it reads back from JSON, so tuples and lists compare equal."""
+    return json.loads(json.dumps(value))
+
+
+class StageManifest:
+    """
+    Record of the pipeline stages that have run for a project, kept in
+    manifest.json in the project folder.
+
+    For each stage the manifest holds the content hashes of its input files, the
+    parameters it ran with, its outputs and whether it completed. A stage is
+    current, and can be skipped, if it completed with the same inputs and
+    parameters. Stages made of independent items, such as keyframe groups, can
+    also record a fingerprint per item as each one finishes (see record_item), so
+    a rerun only redoes the items that changed or never finished.
+
+    Attributes:
+        config (dict): The project's config dictionary.
+        path (str): Path of the manifest file.
+        manifest (dict): The manifest contents.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.path = (
+            self.config.get("projects_folder")
+            + "/"
+            + self.config.get("project_name")
+            + "/manifest.json"
+        )
+        self.manifest = self.load()
+        self.unsaved_items = 0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {"stages": {}, "files": {}}
+        with open(self.path) as manifest_file:
+            return json.load(manifest_file)
+
+    def save(self):
+        """Write the manifest atomically, so a crash never leaves it half written."""
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=4)
+        os.replace(temporary_path, self.path)
+        self.unsaved_items = 0
+
+    def flush(self):
+        """Save the item fingerprints recorded since the last save, if any."""
+        if self.unsaved_items:
+            self.save()
+
+    def file_hash(self, path):
+        """Return the content hash of a file, reusing the cached hash if the file's
+        size and modification time have not changed."""
+        stat = os.stat(path)
+        cached = self.manifest["files"].get(path)
+        if (
+            cached is not None
+            and cached["size"] == stat.st_size
+            and cached["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return cached["sha256"]
+        sha256 = hash_file(path)
+        self.manifest["files"][path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256,
+        }
+        return sha256
+
+    def input_hashes(self, inputs):
+        return {path: self.file_hash(path) for path in inputs}
+
+    def stage(self, name):
+        """Return the record of a stage, or None if it never ran."""
+        return self.manifest["stages"].get(name)
+
+    def is_current(self, name, inputs=(), parameters=None):
+        """Whether the stage completed with the same input files and parameters."""
+        record = self.stage(name)
+        return (
+            record is not None
+            and record["status"] == "complete"
+            and record["parameters"] == normalize(parameters)
+            and record["inputs"] == self.input_hashes(inputs)
+        )
+
+    def start(self, name, inputs=(), parameters=None):
+        """Mark a stage as running with the given inputs and parameters. Item
+        fingerprints recorded by an earlier run are kept only if the inputs and
+        parameters are unchanged."""
+        record = self.stage(name)
+        inputs = self.input_hashes(inputs)
+        parameters = normalize(parameters)
+        items = {}
+        if (
+            record is not None
+            and record["inputs"] == inputs
+            and record["parameters"] == parameters
+        ):
+            items = record["items"]
+        self.manifest["stages"][name] = {
+            "status": "running",
+            "inputs": inputs,
+            "parameters": parameters,
+            "outputs": None,
+            "items": items,
+        }
+        self.save()
+
+    def finish(self, name, outputs=None):
+        """Mark a started stage as complete and record its outputs."""
+        record = self.stage(name)
+        record["status"] = "complete"
+        record["outputs"] = normalize(outputs)
+        self.save()
+
+    def item_is_current(self, name, item, fingerprint):
+        """Whether an item of a stage finished with the same fingerprint."""
+        return self.stage(name)["items"].get(str(item)) == normalize(fingerprint)
+
+    def record_item(self, name, item, fingerprint):
+        """Record that an item of a running stage finished. The manifest is saved
+        once every ITEM_SAVE_INTERVAL items; call flush when the items are done."""
+        self.stage(name)["items"][str(item)] = normalize(fingerprint)
+        self.unsaved_items += 1
+        if self.unsaved_items >= ITEM_SAVE_INTERVAL:
+            self.save()
@@ -0,0 +1,82 @@
+import subprocess
+import numpy as np
+
+
+class VideoEncoder:
+    """
+    A long-lived ffmpeg process that encodes frames written to it as raw video over
+    stdin, so finished frames never have to be written to disk and decoded again.
+
+    ffmpeg is started when the first frame arrives, since the frame size is only
+    known then. Frames are BGR uint8 arrays (as OpenCV produces them) and are sent
+    as bgr24, so no color conversion happens before the encoder.
+
+    Use as a context manager: on normal exit the stream is closed and the encoder
+    waited for, on error the ffmpeg process is killed.
+
+    Attributes:
+        output_path (str): Path of the video to write.
+        fps (float): Frame rate of the output video.
+        crf (int): x264 constant rate factor.
+        frame_count (int): Number of frames written so far.
+    """
+
+    def __init__(self, output_path, fps, crf=25):
+        self.output_path = output_path
+        self.fps = fps
+        self.crf = crf
+        self.frame_count = 0
+        self.process = None
+        self.command = None
+
+    def start(self, width, height):
+        self.command = [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(self.fps),
+            "-i",
+            "-",
+            "-vcodec",
+            "libx264",
+            "-crf",
+            str(self.crf),
+            "-pix_fmt",
+            "yuv420p",
+            self.output_path,
+        ]
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        """Send the next frame to the encoder."""
+        if self.process is None:
+            self.start(frame.shape[1], frame.shape[0])
+        self.process.stdin.write(memoryview(np.ascontiguousarray(frame)))
+        self.frame_count += 1
+
+    def close(self):
+        """Finish the stream and wait for the encoder. Raise if ffmpeg failed."""
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.command)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.process is not None:
+            self.process.kill()
+            self.process.wait()
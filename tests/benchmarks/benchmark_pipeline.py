@@ -0,0 +1,215 @@
+"""Benchmark the pipeline stages on synthetic clips.
+
+Run from the root directory:
+    python tests/benchmarks/benchmark_pipeline.py --resolution 1280x720 --frames 240
+    python tests/benchmarks/benchmark_pipeline.py --save-baseline
+    python tests/benchmarks/benchmark_pipeline.py --threshold 0.2
+
+Generates background, alpha and alpha-white clips (see synthetic_clips.py), creates
+a project for them and times, in order: keyframe analysis (KeyFrames), keyframe
+extraction (Project.store_keyframes, before any frame dump exists), full frame
+extraction (Project.extract_input_frames), compositing (Blender.blend) and streaming
+stitch (Project.stitch_frames, skipped if ffmpeg is not installed).
+
+Each stage runs in its own process so its peak RSS (the larger of the process and
+its worker processes) is measured on its own. Wall time, frames per second and peak
+RSS are written to a JSON results file. With a baseline recorded for the same clip
+parameters on the same machine, the run fails if any stage is slower than the
+baseline by more than --threshold.
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, f"{ROOT}/src")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from config_utils.config import Config
+from frame_analysis.keyframe_extractor import KeyFrames
+from image_compositing.image_layer_blender import Blender
+from log_utils.log import Log
+from main import create_new_proj
+from project_manager.project import Project
+from synthetic_clips import write_alpha_layers, write_clips
+
+STAGES = ["analyze", "store_keyframes", "extract", "blend", "stitch"]
+PROJECT_NAME = "benchmark"
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process or its largest child, in MB."""
+    peak_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak_kb / 1024
+
+
+def create_project(workdir, parameters):
+    width, height = parameters["width"], parameters["height"]
+    clips = write_clips(
+        workdir, width, height, parameters["frames"], parameters["coverage"]
+    )
+    config = json.load(open(f"{ROOT}/config/config.json"))
+    config["keyframe_determination"]["analysis_cache"] = True
+    create_new_proj(
+        workdir,
+        PROJECT_NAME,
+        config,
+        (clips["background"], clips["alpha"], clips["alpha_white"]),
+    )
+    with open(f"{workdir}/parameters.json", "w") as parameters_file:
+        json.dump(parameters, parameters_file)
+
+
+def run_stage(name, workdir):
+    """Run one stage in this process and return its measurements."""
+    config = Config(f"{workdir}/{PROJECT_NAME}/config.json")
+    log = Log(config)
+    project = Project(config, log, None)
+    parameters = json.load(open(f"{workdir}/parameters.json"))
+    directories = config.get("directories")
+    frames = None
+    if name in ("store_keyframes", "blend", "stitch"):
+        # Loaded from the analysis cache written by the analyze stage
+        frames = KeyFrames(config, log)
+    if name in ("blend", "stitch"):
+        write_alpha_layers(
+            directories["keyframes_output_alpha"],
+            len(frames.get_keyframe_original_indices()),
+            parameters["width"],
+            parameters["height"],
+        )
+    if name == "stitch" and shutil.which("ffmpeg") is None:
+        return {"skipped": "ffmpeg not found"}
+
+    start = time.perf_counter()
+    if name == "analyze":
+        frames = KeyFrames(config, log)
+        frame_count = frames.get_frame_count()
+    elif name == "store_keyframes":
+        project.store_keyframes(frames.get_keyframe_original_indices())
+        frame_count = 2 * len(frames.get_keyframe_original_indices())
+    elif name == "extract":
+        project.extract_input_frames()
+        frame_count = 3 * parameters["frames"]
+    elif name == "blend":
+        blender = Blender(
+            config, frames.get_frame_objects(), frames.get_keyframe_objects()
+        )
+        frame_count = blender.blend()
+    elif name == "stitch":
+        blender = Blender(
+            config, frames.get_frame_objects(), frames.get_keyframe_objects()
+        )
+        frame_count = project.stitch_frames(blender.stream(), frames.get_fps())
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "frames": frame_count,
+        "fps": frame_count / seconds if seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return a list of regression messages for stages slower than the baseline."""
+    if baseline["parameters"] != results["parameters"]:
+        print("Baseline was recorded with different parameters, not comparing")
+        return []
+    regressions = []
+    for name, stage in results["stages"].items():
+        reference = baseline["stages"].get(name, {})
+        if "seconds" not in stage or "seconds" not in reference:
+            continue
+        limit = reference["seconds"] * (1 + threshold)
+        if stage["seconds"] > limit:
+            regressions.append(
+                f"{name}: {stage['seconds']:.2f} s, baseline "
+                f"{reference['seconds']:.2f} s (limit {limit:.2f} s)"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--resolution", default="1280x720")
+    parser.add_argument("--frames", type=int, default=240)
+    parser.add_argument("--coverage", type=float, default=0.1)
+    parser.add_argument("--workdir", help="folder for clips and the project")
+    parser.add_argument(
+        "--output", default=f"{ROOT}/tests/benchmarks/results.json"
+    )
+    parser.add_argument(
+        "--baseline", default=f"{ROOT}/tests/benchmarks/baseline.json"
+    )
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="allowed slowdown per stage as a fraction of the baseline",
+    )
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    arguments = parser.parse_args(argv)
+
+    if arguments.run_stage:
+        print(json.dumps(run_stage(arguments.run_stage, arguments.workdir)))
+        return 0
+
+    width, height = (int(x) for x in arguments.resolution.split("x"))
+    parameters = {
+        "width": width,
+        "height": height,
+        "frames": arguments.frames,
+        "coverage": arguments.coverage,
+    }
+    workdir = arguments.workdir or tempfile.mkdtemp(prefix="keckley-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    create_project(workdir, parameters)
+
+    results = {"parameters": parameters, "stages": {}}
+    for name in STAGES:
+        completed = subprocess.run(
+            [sys.executable, __file__, "--run-stage", name, "--workdir", workdir],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        stage = json.loads(completed.stdout.strip().splitlines()[-1])
+        results["stages"][name] = stage
+        if "skipped" in stage:
+            print(f"{name:>16}  skipped: {stage['skipped']}")
+        else:
+            print(
+                f"{name:>16}  {stage['seconds']:8.2f} s  {stage['fps']:9.1f} frames/s"
+                f"  {stage['peak_rss_mb']:8.1f} MB"
+            )
+    if not arguments.workdir:
+        shutil.rmtree(workdir)
+
+    with open(arguments.output, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        return 0
+    if os.path.exists(arguments.baseline):
+        with open(arguments.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), arguments.threshold)
+        for regression in regressions:
+            print("Regression:", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
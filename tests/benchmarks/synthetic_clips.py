@@ -0,0 +1,72 @@
+"""Generate synthetic background, alpha and alpha-white clips for benchmarks.
+
+The background is a drifting texture. The masked subject is an ellipse that moves
+across the frame and covers roughly the requested fraction of it; the alpha clip
+shows the background inside the ellipse and black elsewhere, and the alpha-white
+clip shows the ellipse in white. Every few seconds the texture changes, so keyframe
+analysis finds scene cuts.
+"""
+
+import math
+import cv2
+import numpy as np
+
+
+def texture(rng, width, height):
+    noise = rng.integers(0, 256, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    return cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+def subject_mask(width, height, coverage, progress):
+    """White ellipse covering about coverage of the frame, moving with progress."""
+    mask = np.zeros((height, width), dtype=np.uint8)
+    # Area of an ellipse with axes a = 1.5 b is 1.5 pi b^2
+    minor = math.sqrt(coverage * width * height / (1.5 * math.pi))
+    axes = (max(1, int(1.5 * minor)), max(1, int(minor)))
+    center = (
+        int(axes[0] + (width - 2 * axes[0]) * progress),
+        int(height / 2 + height / 8 * math.sin(progress * 2 * math.pi)),
+    )
+    cv2.ellipse(mask, center, axes, 0, 0, 360, 255, -1)
+    return mask
+
+
+def write_clips(folder, width, height, frame_count, coverage, fps=24, cut_every=96):
+    """Write background.mp4, alpha.mp4 and alpha_white.mp4 to folder and return
+    their paths."""
+    paths = {
+        name: f"{folder}/{name}.mp4" for name in ("background", "alpha", "alpha_white")
+    }
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+    writers = {
+        name: cv2.VideoWriter(path, fourcc, fps, (width, height))
+        for name, path in paths.items()
+    }
+    rng = np.random.default_rng(0)
+    background = texture(rng, width, height)
+    for index in range(frame_count):
+        if index and index % cut_every == 0:
+            background = texture(rng, width, height)
+        frame = np.roll(background, 2 * index, axis=1)
+        mask = subject_mask(width, height, coverage, index / max(1, frame_count - 1))
+        writers["background"].write(frame)
+        writers["alpha"].write(cv2.bitwise_and(frame, frame, mask=mask))
+        writers["alpha_white"].write(cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR))
+    for writer in writers.values():
+        writer.release()
+    return paths
+
+
+def write_alpha_layers(folder, keyframe_count, width, height):
+    """Write stand-ins for the inpainted keyframe layers (1.png, 2.png, ...):
+    RGBA images with a soft-edged opaque center."""
+    rng = np.random.default_rng(1)
+    alpha = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(
+        alpha, (width // 2, height // 2), (width // 4, height // 4), 0, 0, 360, 255, -1
+    )
+    alpha = cv2.GaussianBlur(alpha, (0, 0), max(1, width / 100))
+    for number in range(1, keyframe_count + 1):
+        layer = cv2.cvtColor(texture(rng, width, height), cv2.COLOR_BGR2BGRA)
+        layer[:, :, 3] = alpha
+        cv2.imwrite(f"{folder}/{number}.png", layer)
@@ -0,0 +1,51 @@
+import json
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, f"{ROOT}/src")
+sys.path.insert(0, f"{ROOT}/tests/benchmarks")
+
+from config_utils.config import Config
+from log_utils.log import Log
+from main import create_new_proj
+from synthetic_clips import write_clips
+
+# Small enough to analyze in well under a second, with two scene cuts
+CLIP_SIZE = (160, 90)
+CLIP_FRAMES = 120
+CLIP_CUT_EVERY = 48
+
+
+@pytest.fixture(scope="session")
+def clips(tmp_path_factory):
+    """Paths of the synthetic background, alpha and alpha-white clips."""
+    folder = tmp_path_factory.mktemp("clips")
+    return write_clips(
+        str(folder), *CLIP_SIZE, CLIP_FRAMES, 0.3, cut_every=CLIP_CUT_EVERY
+    )
+
+
+@pytest.fixture
+def make_project(tmp_path, clips):
+    """Return a function creating a project for the synthetic clips, with the
+    given keyframe_determination options, and returning its Config and Log."""
+    projects = 0
+
+    def make(**keyframe_determination):
+        nonlocal projects
+        projects += 1
+        config = json.load(open(f"{ROOT}/config/config.json"))
+        config["keyframe_determination"].update(keyframe_determination)
+        name = f"project{projects}"
+        create_new_proj(
+            str(tmp_path),
+            name,
+            config,
+            (clips["background"], clips["alpha"], clips["alpha_white"]),
+        )
+        project_config = Config(f"{tmp_path}/{name}/config.json")
+        return project_config, Log(project_config)
+
+    return make
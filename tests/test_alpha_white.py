@@ -0,0 +1,64 @@
+import json
+import numpy as np
+import pytest
+from config_utils.config import Config
+from project_manager.frame_extractor import (
+    alpha_white_lut,
+    derive_alpha_white,
+    derives_alpha_white,
+)
+
+
+def test_lut_thresholds_noise_to_black_and_the_rest_to_white():
+    lut = alpha_white_lut(16)
+
+    assert lut.dtype == np.uint8
+    assert (lut[:17] == 0).all()
+    assert (lut[17:] == 255).all()
+
+
+@pytest.mark.parametrize("gamma", [2.2, 100])
+def test_lut_with_gamma_keeps_soft_edges(gamma):
+    lut = alpha_white_lut(16, gamma)
+
+    assert (lut[:17] == 0).all()
+    assert lut[255] == 255
+    assert (np.diff(lut[17:].astype(int)) >= 0).all()
+    expected = np.round(255 * (np.arange(17, 256) / 255) ** (1 / gamma))
+    np.testing.assert_array_equal(lut[17:], expected)
+
+
+def test_derived_mask_maps_the_brightest_channel():
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (20, 30, 3), dtype=np.uint8)
+    frame[:5] = rng.integers(0, 17, (5, 30, 3), dtype=np.uint8)
+    lut = alpha_white_lut(16, 2.2)
+
+    mask = derive_alpha_white(frame, lut)
+
+    assert mask.shape == (20, 30)
+    np.testing.assert_array_equal(mask, lut[frame.max(axis=2)])
+    assert not mask[:5].any()
+    gray = frame[:, :, 0]
+    np.testing.assert_array_equal(derive_alpha_white(gray, lut), lut[gray])
+
+
+@pytest.mark.parametrize(
+    "project, derived",
+    [
+        ({"alpha_white_vid": "alpha-white.mp4"}, False),
+        ({"alpha_white_vid": None}, True),
+        (
+            {
+                "alpha_white_vid": "alpha-white.mp4",
+                "frame_extraction": {"alpha_white": {"source": "derived"}},
+            },
+            True,
+        ),
+    ],
+)
+def test_older_projects_keep_their_alpha_white_video(tmp_path, project, derived):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps(project))
+
+    assert derives_alpha_white(Config(str(path))) == derived
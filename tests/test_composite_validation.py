@@ -0,0 +1,82 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from frame_analysis.keyframe_extractor import KeyFrames
+from image_compositing.composite_validation import CompositeValidator
+from project_manager.frame_extractor import write_frame
+from project_manager.frame_index import FrameIndex
+
+THRESHOLDS = {"motion_threshold": -6, "color_threshold": -6}
+
+
+@pytest.fixture
+def validator(make_project):
+    """A validator of composites that are exactly the alpha frames, so every
+    group follows the original clip."""
+    config, log = make_project(analysis_cache=False, **THRESHOLDS)
+    frames = KeyFrames(config, log)
+    frame_index = FrameIndex(config)
+    directories = config.get("directories")
+    background_folder = directories["frames_original_background_raw"]
+    # Only the frame numbers of the backgrounds are read
+    for number in range(1, frames.get_frame_count() + 3):
+        open(f"{background_folder}/{number}.png", "wb").close()
+
+    capture = cv2.VideoCapture(config.get("alpha_vid"))
+    alpha_frames = []
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        alpha_frames.append(frame)
+    capture.release()
+
+    validator = CompositeValidator(config, log, frames, frame_index)
+    config.get("validation").update(workers=1, flag_threshold=1.0)
+    for _, paths, indices in validator.group_tasks():
+        for path, index in zip(paths, indices):
+            # Array index 0 is position 2 of the video
+            write_frame(path, alpha_frames[index + 2])
+    return validator
+
+
+def test_validation_ranks_the_deviating_group_first(validator):
+    tasks = validator.group_tasks()
+    # A group long enough to deviate on average, away from the ends
+    bad = max(range(1, len(tasks) - 1), key=lambda k: len(tasks[k][1]))
+    rng = np.random.default_rng(0)
+    for path in tasks[bad][1]:
+        write_frame(path, rng.integers(0, 256, (90, 160, 3), dtype=np.uint8))
+
+    report = validator.validate()
+
+    bad_keyframe = tasks[bad][0]["keyframe_index"]
+    next_keyframe = tasks[bad + 1][0]["keyframe_index"]
+    groups = {group["keyframe_index"]: group for group in report["groups"]}
+    assert report["groups"][0]["keyframe_index"] == bad_keyframe
+    assert bad_keyframe in report["flagged"]
+    # The next group only deviates at its first frame, compared with the bad group
+    assert groups[next_keyframe]["boundary_deviation"] == pytest.approx(
+        groups[next_keyframe]["max_deviation"]
+    )
+    for keyframe, group in groups.items():
+        if keyframe not in (bad_keyframe, next_keyframe):
+            assert group["deviation"] < groups[bad_keyframe]["deviation"] / 2
+    assert os.path.exists(validator.report_path())
+
+
+def test_validation_deletes_flagged_composites(validator):
+    tasks = validator.group_tasks()
+    bad = len(tasks) // 2
+    for path in tasks[bad][1]:
+        write_frame(path, np.full((90, 160, 3), 255, dtype=np.uint8))
+    validator.config.get("validation").update(delete_flagged=True)
+
+    report = validator.validate()
+
+    assert report["deleted"]
+    assert tasks[bad][0]["keyframe_index"] in report["flagged"]
+    for path in tasks[bad][1]:
+        assert not os.path.exists(path)
+        assert not validator.frame_index.contains(path)
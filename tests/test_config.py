@@ -0,0 +1,76 @@
+import json
+import os
+import pytest
+from config_utils.config import Config
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({"project_name": "project", "log_level": "debug"}))
+    return str(path)
+
+
+def saved(path):
+    with open(path) as config_file:
+        return json.load(config_file)
+
+
+def test_project_config_is_loaded_on_top_of_the_defaults(config_path):
+    config = Config(config_path)
+
+    assert config.get("log_level") == "debug"
+    # An option the project file lacks
+    assert "keyframe_determination" in config.config
+    assert config.analysis_parameters().max_keyframe_group_size > 0
+
+
+def test_transaction_saves_once_at_the_end(config_path):
+    config = Config(config_path)
+    with config.transaction():
+        config.set("log_level", "info")
+        with config.transaction():
+            config.set("project_name", "renamed")
+        assert saved(config_path)["log_level"] == "debug"
+
+    assert saved(config_path)["log_level"] == "info"
+    assert saved(config_path)["project_name"] == "renamed"
+
+
+def test_failed_transaction_discards_its_changes(config_path):
+    config = Config(config_path)
+    with pytest.raises(RuntimeError):
+        with config.transaction():
+            config.set("log_level", "info")
+            raise RuntimeError
+
+    assert config.get("log_level") == "debug"
+    assert saved(config_path)["log_level"] == "debug"
+
+
+def test_set_invalidates_parameter_snapshots(config_path):
+    config = Config(config_path)
+    section = dict(config.get("keyframe_determination"), motion_weight=0.5)
+    config.set("keyframe_determination", section)
+
+    assert config.analysis_parameters().motion_weight == 0.5
+
+
+def test_failed_save_leaves_the_file_and_no_temporary_file(config_path):
+    config = Config(config_path)
+    with pytest.raises(TypeError):
+        config.set("log_level", object())
+
+    assert saved(config_path)["log_level"] == "debug"
+    assert os.listdir(os.path.dirname(config_path)) == ["config.json"]
+
+
+def test_reload_if_changed(config_path):
+    config = Config(config_path)
+    assert not config.reload_if_changed()
+    other = Config(config_path)
+    other.set("log_level", "info")
+    os.utime(config_path, ns=(0, config.mtime_ns + 1))
+
+    assert config.reload_if_changed()
+    assert config.get("log_level") == "info"
@@ -0,0 +1,63 @@
+import pytest
+from frame_interpolation.frame_interpolator import interpolation_pairs
+
+
+def outputs(pairs):
+    """Return (output number, previous, following, t) of every output frame."""
+    return [
+        (number, previous, following, t)
+        for previous, following, frames in pairs
+        for number, t in frames
+    ]
+
+
+def test_unchanged_rate_without_gaps_keeps_every_frame():
+    assert interpolation_pairs([1, 2, 3], 1.0) == [
+        (1, 2, [(1, 0.0)]),
+        (2, 3, [(2, 0.0)]),
+        (3, None, [(3, 0.0)]),
+    ]
+
+
+def test_gaps_are_filled_between_the_frames_around_them():
+    assert outputs(interpolation_pairs([1, 2, 5, 6], 1.0)) == [
+        (1, 1, 2, 0.0),
+        (2, 2, 5, 0.0),
+        (3, 2, 5, pytest.approx(1 / 3)),
+        (4, 2, 5, pytest.approx(2 / 3)),
+        (5, 5, 6, 0.0),
+        (6, 6, None, 0.0),
+    ]
+
+
+def test_doubled_rate_adds_midpoints():
+    assert outputs(interpolation_pairs([1, 2, 3], 2.0)) == [
+        (1, 1, 2, 0.0),
+        (2, 1, 2, 0.5),
+        (3, 2, 3, 0.0),
+        (4, 2, 3, 0.5),
+        (5, 3, None, 0.0),
+    ]
+
+
+def test_fractional_rate_lands_on_frames_without_rounding_drift():
+    # 24 to 30 fps: every fourth input frame falls exactly on an output frame
+    pairs = interpolation_pairs(list(range(1, 26)), 30 / 24)
+    on_frames = [
+        (number, previous) for number, previous, _, t in outputs(pairs) if t == 0.0
+    ]
+
+    assert len(outputs(pairs)) == 31
+    assert on_frames == [(1 + 5 * k, 1 + 4 * k) for k in range(7)]
+    assert pairs[-1] == (25, None, [(31, 0.0)])
+
+
+def test_output_starts_at_the_first_frame():
+    pairs = interpolation_pairs([3, 4, 6], 1.0)
+
+    assert outputs(pairs) == [
+        (1, 3, 4, 0.0),
+        (2, 4, 6, 0.0),
+        (3, 4, 6, 0.5),
+        (4, 6, None, 0.0),
+    ]
@@ -0,0 +1,221 @@
+import os
+import numpy as np
+import pytest
+from project_manager import frame_store
+from project_manager.frame_extractor import read_frame, write_frame
+from project_manager.frame_index import FrameIndex
+from project_manager.frame_store import (
+    FrameStore,
+    open_cached_store,
+    release_cached_stores,
+    store_frame_path,
+    store_path,
+)
+
+SHAPE = (6, 8, 3)
+
+
+class ProjectConfig:
+    def __init__(self, folder):
+        self.values = {"projects_folder": str(folder), "project_name": "project"}
+
+    def get(self, key):
+        return self.values[key]
+
+
+def frame(value):
+    return np.full(SHAPE, value, dtype=np.uint8)
+
+
+@pytest.fixture(autouse=True)
+def cached_stores():
+    yield
+    release_cached_stores()
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path / "project" / "frames"
+    folder.mkdir(parents=True)
+    return str(folder)
+
+
+@pytest.fixture
+def frame_index(tmp_path):
+    return FrameIndex(ProjectConfig(tmp_path))
+
+
+def test_store_round_trip(folder):
+    store = FrameStore.create(store_path(folder), SHAPE, 3)
+    store.write(2, frame(7))
+    store.close()
+
+    store = FrameStore.open(store_path(folder))
+    assert store.shape == SHAPE
+    assert store.count == 3
+    np.testing.assert_array_equal(store.frame(1), frame(0))
+    np.testing.assert_array_equal(store.frame(2), frame(7))
+    with pytest.raises(IndexError):
+        store.frame(4)
+    store.close()
+
+
+def test_store_append_updates_count_on_close(folder):
+    store = FrameStore.create(store_path(folder), SHAPE)
+    for value in range(1, 4):
+        store.append(frame(value))
+    store.close()
+
+    store = FrameStore.open(store_path(folder))
+    assert store.count == 3
+    np.testing.assert_array_equal(store.frames()[:, 0, 0, 0], [1, 2, 3])
+    store.close()
+
+
+def test_store_rejects_bad_writes(folder):
+    store = FrameStore.create(store_path(folder), SHAPE, 2)
+    with pytest.raises(IndexError):
+        store.write(3, frame(1))
+    with pytest.raises(ValueError):
+        store.write(1, np.zeros((2, 2, 3), dtype=np.uint8))
+    store.close()
+
+
+def test_store_frame_paths_through_read_and_write_frame(folder):
+    FrameStore.create(store_path(folder), SHAPE, 2).close()
+    write_frame(store_frame_path(folder, 2), frame(9))
+
+    np.testing.assert_array_equal(read_frame(store_frame_path(folder, 2)), frame(9))
+    np.testing.assert_array_equal(read_frame(store_frame_path(folder, 1)), frame(0))
+
+
+def test_cached_store_follows_a_growing_store(folder):
+    store = FrameStore.create(store_path(folder), SHAPE)
+    store.append(frame(1))
+    store.close()
+    cached = open_cached_store(store_path(folder))
+    np.testing.assert_array_equal(read_frame(store_frame_path(folder, 1)), frame(1))
+
+    store = FrameStore.open(store_path(folder), writable=True)
+    store.append(frame(2))
+    store.close()
+    np.testing.assert_array_equal(read_frame(store_frame_path(folder, 2)), frame(2))
+    # Grown in place, not opened again
+    assert open_cached_store(store_path(folder)) is cached
+
+
+def test_cached_store_reopens_a_recreated_store(folder):
+    FrameStore.create(store_path(folder), SHAPE, 2).close()
+    read_frame(store_frame_path(folder, 1))
+
+    store = FrameStore.create(store_path(folder), (3, 4, 3), 2)
+    store.write(1, np.full((3, 4, 3), 5, dtype=np.uint8))
+    store.close()
+    assert read_frame(store_frame_path(folder, 1)).shape == (3, 4, 3)
+
+
+def test_cached_stores_are_released_on_eviction(tmp_path):
+    paths = []
+    for index in range(frame_store.STORE_CACHE_SIZE + 1):
+        paths.append(str(tmp_path / f"{index}.store"))
+        FrameStore.create(paths[-1], SHAPE, 1).close()
+    first = open_cached_store(paths[0])
+    for path in paths[1:]:
+        open_cached_store(path)
+
+    assert first.file.closed
+    assert len(frame_store.open_stores) <= frame_store.STORE_CACHE_SIZE
+
+
+def test_index_scans_numbered_files(folder, frame_index):
+    for number in (1, 2, 10):
+        write_frame(f"{folder}/{number}.png", frame(number))
+    open(f"{folder}/notes.txt", "w").close()
+
+    assert frame_index.numbers(folder) == [1, 2, 10]
+    assert frame_index.frame_path(folder, 10) == f"{folder}/10.png"
+    assert frame_index.frame_path(folder, 3) is None
+    assert frame_index.frame_paths(folder) == [
+        f"{folder}/{number}.png" for number in (1, 2, 10)
+    ]
+
+
+def test_index_records_and_reloads(tmp_path, folder, frame_index):
+    frame_index.reset(folder)
+    write_frame(f"{folder}/1.png", frame(1))
+    frame_index.record(f"{folder}/1.png")
+    frame_index.save()
+
+    reloaded = FrameIndex(ProjectConfig(tmp_path))
+    assert reloaded.folders[folder]["mtime_ns"] == os.stat(folder).st_mtime_ns
+    assert reloaded.numbers(folder) == [1]
+    assert reloaded.contains(f"{folder}/1.png")
+
+
+def test_index_rescans_folders_changed_on_disk(tmp_path, folder, frame_index):
+    write_frame(f"{folder}/1.png", frame(1))
+    assert frame_index.count(folder) == 1
+    frame_index.save()
+    write_frame(f"{folder}/2.png", frame(2))
+
+    assert FrameIndex(ProjectConfig(tmp_path)).numbers(folder) == [1, 2]
+
+
+def test_index_lists_store_frames(folder, frame_index):
+    FrameStore.create(store_path(folder), SHAPE, 3).close()
+
+    assert frame_index.numbers(folder) == [1, 2, 3]
+    assert frame_index.frame_path(folder, 2) == store_frame_path(folder, 2)
+
+
+def test_discarded_store_frames_stay_out_of_rescans(tmp_path, folder, frame_index):
+    FrameStore.create(store_path(folder), SHAPE, 3).close()
+    frame_index.discard(store_frame_path(folder, 2))
+    frame_index.save()
+    assert not frame_index.contains(store_frame_path(folder, 2))
+    # Any file added to the folder makes the next index rescan it
+    open(f"{folder}/notes.txt", "w").close()
+
+    rescanned = FrameIndex(ProjectConfig(tmp_path))
+    assert rescanned.numbers(folder) == [1, 3]
+    write_frame(store_frame_path(folder, 2), frame(2))
+    rescanned.record(store_frame_path(folder, 2))
+    assert rescanned.numbers(folder) == [1, 2, 3]
+    assert rescanned.folders[folder]["discarded"] == []
+
+
+def test_fingerprint_changes_with_frames(folder, frame_index):
+    write_frame(f"{folder}/1.png", frame(1))
+    before = frame_index.fingerprint(folder)
+    assert frame_index.fingerprint(folder) == before
+
+    write_frame(f"{folder}/2.png", frame(2))
+    frame_index.record(f"{folder}/2.png")
+    assert frame_index.fingerprint(folder) != before
+
+
+def test_index_follows_frames_overwritten_in_place(tmp_path, folder, frame_index):
+    write_frame(f"{folder}/1.png", frame(1))
+    before = frame_index.fingerprint(folder)
+    frame_index.save()
+    folder_mtime_ns = os.stat(folder).st_mtime_ns
+    write_frame(f"{folder}/1.png", np.full(SHAPE, 200, dtype=np.uint8))
+    # The rewritten file may have the same size, and, on a coarse clock, time
+    os.utime(f"{folder}/1.png", ns=(0, 1))
+
+    assert os.stat(folder).st_mtime_ns == folder_mtime_ns
+    assert FrameIndex(ProjectConfig(tmp_path)).fingerprint(folder) != before
+
+
+def test_index_follows_store_frames_written_in_place(tmp_path, folder, frame_index):
+    FrameStore.create(store_path(folder), SHAPE, 2).close()
+    before = frame_index.fingerprint(folder)
+    frame_index.save()
+    store = FrameStore.open(store_path(folder), writable=True)
+    store.write(1, frame(1))
+    store.close()
+    # On a coarse clock the write may keep the store's time
+    mtime_ns = os.stat(store_path(folder)).st_mtime_ns
+    os.utime(store_path(folder), ns=(mtime_ns, mtime_ns + 1))
+
+    assert FrameIndex(ProjectConfig(tmp_path)).fingerprint(folder) != before
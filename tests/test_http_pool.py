@@ -0,0 +1,209 @@
+import asyncio
+import pytest
+from image_inpainting.http_pool import ConnectionPool, HTTPError
+from image_inpainting.sd_client import IMG2IMG_PATH, InpaintingClient
+
+
+class Server:
+    """Local HTTP server answering every request with the next of its responses
+    (status, body), closing each connection after close_after responses without
+    telling the client, as servers closing idle keep-alive connections do. The
+    first truncated responses are cut off halfway and their connection closed."""
+
+    def __init__(self, responses, close_after=None, chunked=False, truncated=0):
+        self.responses = list(responses)
+        self.close_after = close_after
+        self.chunked = chunked
+        self.truncated = truncated
+        self.requests = []
+        self.writers = []
+
+    @property
+    def connections(self):
+        return len(self.writers)
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        served = 0
+        while True:
+            if self.close_after is not None and served >= self.close_after:
+                writer.close()
+                return
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                # The client closed the connection
+                return
+            lines = head.decode("latin-1").split("\r\n")
+            headers = dict(line.lower().split(": ", 1) for line in lines[1:] if line)
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            self.requests.append((lines[0], body))
+            status, data = self.responses.pop(0)
+            if self.chunked:
+                framing = b"Transfer-Encoding: chunked\r\n\r\n"
+                half = len(data) // 2
+                data = b"".join(
+                    b"%x\r\n%s\r\n" % (len(part), part)
+                    for part in (data[:half], data[half:], b"")
+                )
+            else:
+                framing = b"Content-Length: %d\r\n\r\n" % len(data)
+            response = b"HTTP/1.1 %d OK\r\n" % status + framing + data
+            if self.truncated:
+                self.truncated -= 1
+                writer.write(response[: -len(data) // 2])
+                await writer.drain()
+                writer.close()
+                return
+            writer.write(response)
+            await writer.drain()
+            served += 1
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/sdapi"
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_requests_reuse_connections():
+    server = Server([(200, b'{"a": 1}'), (200, b'{"b": 2}')])
+
+    async def requests():
+        async with server as url:
+            pool = ConnectionPool(url, 2, 5)
+            first = await pool.request("POST", "/v1/img2img", b"{}")
+            second = await pool.request("GET", "/v1/options")
+            await pool.close_all()
+            return first, second, pool.connections_opened
+
+    first, second, opened = run(requests())
+    assert first == (200, b'{"a": 1}')
+    assert second == (200, b'{"b": 2}')
+    assert opened == 1
+    assert server.requests == [
+        ("POST /sdapi/v1/img2img HTTP/1.1", b"{}"),
+        ("GET /sdapi/v1/options HTTP/1.1", b""),
+    ]
+
+
+def test_stale_reused_connection_is_retried():
+    server = Server([(200, b"first"), (200, b"second")], close_after=1)
+
+    async def requests():
+        async with server as url:
+            pool = ConnectionPool(url, 1, 5)
+            await pool.request("GET", "/one")
+            # Let the server's close reach the idle connection
+            await asyncio.sleep(0.05)
+            response = await pool.request("GET", "/two")
+            await pool.close_all()
+            return response, pool.connections_opened
+
+    response, opened = run(requests())
+    assert response == (200, b"second")
+    assert opened == 2
+    assert server.connections == 2
+
+
+def test_failure_on_a_new_connection_is_raised():
+    server = Server([], close_after=0)
+
+    async def request():
+        async with server as url:
+            pool = ConnectionPool(url, 1, 5)
+            await pool.request("GET", "/")
+
+    with pytest.raises((ConnectionError, asyncio.IncompleteReadError)):
+        run(request())
+    assert server.connections == 1
+
+
+def test_chunked_response():
+    server = Server([(200, b"chunked body")], chunked=True)
+
+    async def request():
+        async with server as url:
+            pool = ConnectionPool(url, 1, 5)
+            response = await pool.request("GET", "/")
+            await pool.close_all()
+            return response
+
+    assert run(request()) == (200, b"chunked body")
+
+
+@pytest.mark.parametrize("status, retryable", [(503, True), (429, True), (404, False)])
+def test_error_status_raises(status, retryable):
+    server = Server([(status, b"error")])
+
+    async def request():
+        async with server as url:
+            pool = ConnectionPool(url, 1, 5)
+            try:
+                await pool.request("GET", "/")
+            finally:
+                await pool.close_all()
+
+    with pytest.raises(HTTPError) as error:
+        run(request())
+    assert error.value.status == status
+    assert error.value.retryable == retryable
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_truncated_response_on_a_new_connection_is_raised(chunked):
+    server = Server([(200, b"truncated body")], chunked=chunked, truncated=1)
+
+    async def request():
+        async with server as url:
+            pool = ConnectionPool(url, 1, 5)
+            await pool.request("GET", "/")
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        run(request())
+
+
+class Config:
+    def __init__(self, stable_diffusion):
+        self.values = {"stable_diffusion": stable_diffusion}
+
+    def get(self, key):
+        return self.values[key]
+
+
+class Log:
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_client_retries_truncated_responses(chunked):
+    server = Server([(200, b'{"images": []}')] * 3, chunked=chunked, truncated=2)
+    log = Log()
+    client = InpaintingClient(
+        Config({"retries": 2, "retry_backoff": 0}), log, frame_index=None
+    )
+
+    async def post():
+        async with server as url:
+            pool = ConnectionPool(url, 1, 5)
+            response = await client.post(pool, b"{}")
+            await pool.close_all()
+            return response, pool.connections_opened
+
+    response, opened = run(post())
+    assert response == (200, b'{"images": []}')
+    assert opened == 3
+    assert len(log.warnings) == 2
+    assert server.requests[-1] == (f"POST /sdapi{IMG2IMG_PATH} HTTP/1.1", b"{}")
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from image_compositing.image_layer_blender import (
+    alpha_over,
+    cross_fade_over,
+    premultiplied_layer,
+)
+
+LEVELS = np.arange(256, dtype=np.uint8)
+
+
+def test_alpha_over_matches_float_reference():
+    # Every foreground level (rows) with every alpha level (columns)
+    foreground = np.repeat(LEVELS[:, np.newaxis, np.newaxis], 256, axis=1)
+    foreground = np.repeat(foreground, 3, axis=2)
+    alpha = np.repeat(LEVELS[np.newaxis, :], 256, axis=0)
+    for level in range(256):
+        background = np.full_like(foreground, level)
+        expected = np.round(
+            (
+                foreground.astype(np.float64) * alpha[:, :, np.newaxis]
+                + background.astype(np.float64) * (255 - alpha[:, :, np.newaxis])
+            )
+            / 255
+        )
+        np.testing.assert_array_equal(
+            alpha_over(foreground, alpha, background), expected
+        )
+
+
+def random_layer(rng, shape=(64, 96)):
+    foreground = rng.integers(0, 256, shape + (3,), dtype=np.uint8)
+    alpha = rng.integers(0, 256, shape, dtype=np.uint8)
+    # Fully transparent and opaque pixels too
+    alpha[: shape[0] // 4] = 0
+    alpha[-shape[0] // 4 :] = 255
+    return foreground, alpha
+
+
+@pytest.mark.parametrize("weight", [0.0, 0.001, 0.25, 0.5, 1 / 3, 0.9, 1.0])
+def test_cross_fade_over_matches_float_reference(weight):
+    rng = np.random.default_rng(0)
+    first = random_layer(rng)
+    second = random_layer(rng)
+    background = rng.integers(0, 256, first[0].shape, dtype=np.uint8)
+
+    blended = cross_fade_over(
+        premultiplied_layer(*first), premultiplied_layer(*second), weight, background
+    )
+
+    # The weight is quantized to 1/256 steps
+    weight = round(weight * 256) / 256
+    (first_color, first_alpha), (second_color, second_alpha) = (
+        (color.astype(np.float64), alpha.astype(np.float64)[:, :, np.newaxis])
+        for color, alpha in (first, second)
+    )
+    coverage = (1 - weight) * first_alpha + weight * second_alpha
+    color = (1 - weight) * first_color * first_alpha
+    color += weight * second_color * second_alpha
+    expected = np.floor((color + background * (255 - coverage)) / 255 + 0.5)
+    np.testing.assert_array_equal(blended, expected)
+
+
+def test_cross_fade_over_ends_are_alpha_over():
+    rng = np.random.default_rng(1)
+    first = random_layer(rng)
+    second = random_layer(rng)
+    background = rng.integers(0, 256, first[0].shape, dtype=np.uint8)
+    layers = premultiplied_layer(*first), premultiplied_layer(*second)
+
+    np.testing.assert_array_equal(
+        cross_fade_over(*layers, 0.0, background), alpha_over(*first, background)
+    )
+    np.testing.assert_array_equal(
+        cross_fade_over(*layers, 1.0, background), alpha_over(*second, background)
+    )
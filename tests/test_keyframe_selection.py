@@ -0,0 +1,233 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from frame_analysis.analysis_cache import AnalysisCache
+from frame_analysis.frame_features import FeatureCache, FeatureOptions
+from frame_analysis.keyframe_extractor import KeyFrames
+from frame_analysis.parallel_analysis import (
+    FIRST_SCORED_POSITION,
+    frame_ranges,
+    video_keyframes,
+)
+
+# Keyframes every few frames of the synthetic clip; the defaults make every frame
+# one
+THRESHOLDS = {"motion_threshold": -6, "color_threshold": -6}
+
+
+def color_difference(frame1, frame2):
+    hist1 = cv2.calcHist(
+        [cv2.cvtColor(frame1, cv2.COLOR_BGR2GRAY)], [0], None, [256], [0, 256]
+    )
+    hist2 = cv2.calcHist(
+        [cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY)], [0], None, [256], [0, 256]
+    )
+    return cv2.compareHist(hist1, hist2, cv2.HISTCMP_CHISQR)
+
+
+def motion_difference(frame1, frame2):
+    return cv2.absdiff(
+        cv2.cvtColor(frame1, cv2.COLOR_BGR2GRAY),
+        cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY),
+    ).sum()
+
+
+def baseline_keyframes(video_path, options):
+    """Return the keyframe original indices and combined threshold of the
+    original analysis: decoded frames kept in a list and selected one at a time
+    against the previous keyframe."""
+    capture = cv2.VideoCapture(video_path)
+    decoded = []
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        decoded.append(frame)
+    capture.release()
+
+    # The second frame is only read as the previous frame of the third
+    frames = []
+    motion_diffs = []
+    color_diffs = []
+    for index in range(2, len(decoded)):
+        motion_diffs.append(
+            motion_difference(decoded[index], decoded[index - 1])
+            * options["motion_weight"]
+        )
+        color_diffs.append(
+            color_difference(decoded[index], decoded[index - 1])
+            * options["color_weight"]
+        )
+        frames.append({"frame_index_original": index - 1, "frame": decoded[index]})
+
+    combined_threshold = (
+        sum(motion_diffs) / len(motion_diffs) - min(motion_diffs)
+    ) * (1 - options["motion_threshold"]) + (
+        sum(color_diffs) / len(color_diffs) - min(color_diffs)
+    ) * (1 - options["color_threshold"])
+
+    keyframes = [frames[0]]
+    children = 0
+    for frame in frames[1:]:
+        keyframe = keyframes[-1]["frame"]
+        score = (
+            motion_difference(frame["frame"], keyframe) * options["motion_weight"]
+            + color_difference(frame["frame"], keyframe) * options["color_weight"]
+        )
+        if score > combined_threshold or children > options["max_keyframe_group_size"]:
+            keyframes.append(frame)
+            children = 0
+        else:
+            children += 1
+    return [frame["frame_index_original"] for frame in keyframes], combined_threshold
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+@pytest.mark.parametrize("threshold", [-6, -12])
+@pytest.mark.parametrize("max_keyframe_group_size", [60, 8])
+def test_selection_matches_baseline(
+    make_project, streaming, threshold, max_keyframe_group_size
+):
+    config, log = make_project(
+        streaming=streaming,
+        analysis_cache=False,
+        motion_threshold=threshold,
+        color_threshold=threshold,
+        max_keyframe_group_size=max_keyframe_group_size,
+    )
+    keyframes = KeyFrames(config, log)
+    indices, combined_threshold = baseline_keyframes(
+        config.get("alpha_vid"), config.get("keyframe_determination")
+    )
+
+    assert 1 < len(indices) < keyframes.get_frame_count()
+    assert keyframes.combined_threshold == pytest.approx(combined_threshold)
+    assert keyframes.get_keyframe_original_indices() == indices
+
+
+def test_group_boundaries_cover_every_frame(make_project):
+    config, log = make_project(
+        analysis_cache=False, max_keyframe_group_size=8, **THRESHOLDS
+    )
+    keyframes = KeyFrames(config, log)
+    starts, ends = keyframes.get_group_boundaries()
+
+    assert starts[0] == 0
+    assert ends[-1] == keyframes.get_frame_count()
+    np.testing.assert_array_equal(starts[1:], ends[:-1])
+    assert (ends - starts).max() <= 8 + 2
+    children = [
+        len(keyframe["keyframe_children_indices"])
+        for keyframe in keyframes.get_keyframe_objects()
+    ]
+    np.testing.assert_array_equal(np.array(children) + 1, ends - starts)
+
+
+def test_video_keyframes(clips):
+    keyframes, frame_count = video_keyframes(clips["alpha"])
+
+    assert frame_count == 120
+    assert keyframes[0] == 0
+    # Chunks shorter than the GOP start between keyframes
+    assert len(keyframes) > 1 and np.diff(keyframes).min() > 5
+
+
+@pytest.mark.parametrize("frame_count", [2, 3, 100, 101, 102])
+def test_frame_ranges_cover_every_position(frame_count):
+    ranges = frame_ranges(frame_count, 25)
+
+    assert ranges[0][0] == FIRST_SCORED_POSITION
+    assert ranges[-1][1] is None
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+
+
+@pytest.mark.parametrize("analysis_chunk_size", [25, 5])
+def test_parallel_analysis_matches_streaming(make_project, analysis_chunk_size):
+    config, log = make_project(analysis_cache=False, **THRESHOLDS)
+    streaming = KeyFrames(config, log)
+    config, log = make_project(
+        analysis_cache=False,
+        analysis_workers=3,
+        analysis_chunk_size=analysis_chunk_size,
+        **THRESHOLDS,
+    )
+    parallel = KeyFrames(config, log)
+
+    np.testing.assert_array_equal(parallel.raw_motion_diffs, streaming.raw_motion_diffs)
+    np.testing.assert_array_equal(parallel.raw_color_diffs, streaming.raw_color_diffs)
+    np.testing.assert_array_equal(parallel.keyframe_indices, streaming.keyframe_indices)
+    assert parallel.get_fps() == streaming.get_fps()
+
+
+@pytest.mark.parametrize("analysis_workers", [1, 3])
+def test_reduced_planes_match_full_resolution(make_project, analysis_workers):
+    config, log = make_project(analysis_cache=False, **THRESHOLDS)
+    full = KeyFrames(config, log)
+    config, log = make_project(
+        analysis_cache=False,
+        analysis_workers=analysis_workers,
+        analysis_chunk_size=25,
+        feature_plane_width=40,
+        # Rescores most frames at full resolution
+        proxy_refine_margin=0.5,
+        **THRESHOLDS,
+    )
+    reduced = KeyFrames(config, log)
+
+    assert reduced.feature_cache.plane_shape == (22, 40)
+    assert reduced.feature_cache.full_plane_shape == (90, 160)
+    np.testing.assert_array_equal(reduced.raw_motion_diffs, full.raw_motion_diffs)
+    np.testing.assert_array_equal(reduced.keyframe_indices, full.keyframe_indices)
+
+
+@pytest.mark.parametrize("directory", [None, "tmp"])
+def test_feature_cache_keeps_reduced_roi(clips, tmp_path, directory):
+    feature_cache = FeatureCache(
+        tmp_path if directory else None,
+        FeatureOptions(mask_roi=True, roi_padding=2),
+        plane_width=40,
+    )
+    capture = cv2.VideoCapture(clips["alpha"])
+    for _ in range(10):
+        feature_cache.add(capture.read()[1])
+    capture.release()
+
+    assert feature_cache.is_reduced()
+    for index in range(len(feature_cache)):
+        features = feature_cache[index]
+        x0, y0, x1, y1 = features.roi
+        assert 0 <= x0 < x1 <= 40 and 0 <= y0 < y1 <= 22
+        outside = np.array(features.gray)
+        outside[y0:y1, x0:x1] = 0
+        assert not outside.any()
+    feature_cache.close()
+
+
+def test_cached_analysis_matches_decoded(make_project):
+    config, log = make_project(analysis_cache=True, **THRESHOLDS)
+    decoded = KeyFrames(config, log)
+    # Loaded from the cache written by the first analysis
+    cached = KeyFrames(config, log)
+
+    assert cached.analysis_cache.load() is not None
+    np.testing.assert_array_equal(cached.raw_motion_diffs, decoded.raw_motion_diffs)
+    np.testing.assert_array_equal(cached.keyframe_indices, decoded.keyframe_indices)
+
+
+def test_analysis_cache_follows_the_video(make_project):
+    config, log = make_project(analysis_cache=True, **THRESHOLDS)
+    KeyFrames(config, log)
+    cache = AnalysisCache(config)
+    assert cache.load() is not None
+
+    video_path = config.get("alpha_vid")
+    stat = os.stat(video_path)
+    os.utime(video_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert AnalysisCache(config).load() is None
+    os.utime(video_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    # Other weights and thresholds share the cache, other features do not
+    parameters = config.analysis_parameters()
+    assert AnalysisCache(config, parameters._replace(motion_threshold=-12)).load()
+    assert not AnalysisCache(config, parameters._replace(mask_roi=True)).load()
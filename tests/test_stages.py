@@ -0,0 +1,65 @@
+import os
+from types import SimpleNamespace
+import pytest
+from main import streams_output
+from project_manager.project import Project
+
+
+class Log:
+    def __init__(self):
+        self.warnings = []
+
+    def write(self, message):
+        pass
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+
+@pytest.mark.parametrize(
+    "section, path",
+    [
+        ("validation", ["enabled"]),
+        ("upscaling", ["output_composite", "enabled"]),
+        ("upscaling", ["video", "frame_interpolation", "enabled"]),
+    ],
+)
+def test_streaming_falls_back_to_disk_for_stages_on_composites(
+    make_project, section, path
+):
+    config, _ = make_project()
+    project = SimpleNamespace(config=config, log=Log())
+    assert not streams_output(project)
+    config.get("stitching")["streaming"] = True
+    assert streams_output(project)
+    assert not project.log.warnings
+
+    options = config.get(section)
+    for key in path[:-1]:
+        options = options[key]
+    options[path[-1]] = True
+
+    assert not streams_output(project)
+    assert len(project.log.warnings) == 1
+
+
+def test_store_keyframes_decodes_keyframes_missing_from_a_partial_dump(make_project):
+    config, _ = make_project()
+    project = Project(config, Log(), None)
+    project.extract_input_frames()
+    directories = config.get("directories")
+    # An interrupted extraction left frames 50 onwards out of the dump
+    background = directories["frames_original_background_raw"]
+    for number in range(50, project.frame_index.count(background) + 1):
+        path = project.frame_index.frame_path(background, number)
+        os.remove(path)
+        project.frame_index.discard(path)
+
+    project.store_keyframes([1, 40, 60, 100])
+
+    assert len(project.log.warnings) == 1
+    for folder in (
+        directories["keyframes_original_background"],
+        directories["keyframes_original_alpha_white_out"],
+    ):
+        assert project.frame_index.numbers(folder) == [1, 40, 60, 100]
@@ -0,0 +1,69 @@
+import shutil
+import pytest
+from image_upscaling.upscaler import Upscaler, check_model
+from project_manager.frame_index import FrameIndex
+from project_manager.project import Project
+from project_manager.stage_manifest import StageManifest
+
+STAGE = "upscale_original"
+MODEL = "RealESRGAN_x2plus"
+
+
+@pytest.fixture
+def upscale_stage(make_project):
+    """An Upscaler of a project whose background frames are extracted, and the
+    project's manifest with the upscale_original stage started."""
+    config, log = make_project()
+    Project(config, log, None).extract_input_frames()
+    manifest = StageManifest(config)
+    manifest.start(STAGE)
+    return Upscaler(config, log, FrameIndex(config)), manifest
+
+
+def frame_tasks(upscaler, manifest):
+    directories = upscaler.config.get("directories")
+    return upscaler.frame_tasks(
+        directories["frames_original_background_raw"],
+        directories["frames_original_background_upscaled"],
+        STAGE,
+        MODEL,
+        2,
+        manifest,
+    )
+
+
+def upscale(upscaler, manifest, tasks):
+    """Stand in for the workers: copy the inputs to the outputs and record them."""
+    for input_path, output_path, fingerprint in tasks:
+        shutil.copy(input_path, output_path)
+        upscaler.frame_index.record(output_path)
+        manifest.record_item(STAGE, output_path, fingerprint)
+
+
+def test_upscaled_frames_are_skipped_until_an_option_changes(upscale_stage):
+    upscaler, manifest = upscale_stage
+    tasks = frame_tasks(upscaler, manifest)
+    assert len(tasks) == upscaler.frame_index.count(
+        upscaler.config.get("directories")["frames_original_background_raw"]
+    )
+    upscale(upscaler, manifest, tasks[:10])
+    assert frame_tasks(upscaler, manifest) == tasks[10:]
+
+    upscaler.config.get("upscaling")["tile_size"] += 1
+    assert len(frame_tasks(upscaler, manifest)) == len(tasks)
+
+
+def test_frames_whose_input_changed_are_redone(upscale_stage):
+    upscaler, manifest = upscale_stage
+    tasks = frame_tasks(upscaler, manifest)
+    upscale(upscaler, manifest, tasks)
+    input_path = tasks[4][0]
+    shutil.copy(tasks[5][0], input_path)
+    upscaler.frame_index.record(input_path)
+
+    assert [task[0] for task in frame_tasks(upscaler, manifest)] == [input_path]
+
+
+def test_missing_model_fails_with_a_clear_message(tmp_path):
+    with pytest.raises((ImportError, FileNotFoundError), match="pip install|not found"):
+        check_model(MODEL, str(tmp_path))